@@ -12,10 +12,15 @@ out_lines = []
 out_imports = []
 
 py_files = ["common",
+            "vici",
+            "crypto_profile",
             "config",
             "certificate_handler",
             "args_handler",
             "file_lock",
+            "sa_metrics",
+            "path_mtu",
+            "mount_watcher",
             "timer_handler",
             "metadata",
             "renew_certs",
@@ -20,6 +20,17 @@ SECURE_OPTION = 'secure'
 SECURE_ARG = 'true'
 SBIN_SCRIPT = "/sbin/mount.ibmshare"
 TEARDOWN_APP = "-TEARDOWN_APP"
+WATCH_MOUNTS = "-WATCH_MOUNTS"
+MOUNT_BATCH = "-MOUNT_BATCH"
+MOUNT_ALL = "-MOUNT_ALL"
+SA_STATUS = "-SA_STATUS"
+MTU_CHECK = "-MTU_CHECK"
+FSTAB_FILE = "/etc/fstab"
+FSTAB_TYPE = "ibmshare"
+FSTAB_NOAUTO = "noauto"
+# fstab options only used by mount and systemd
+FSTAB_SKIP_OPTIONS = ["defaults", "auto", "noauto", "nofail", "_netdev",
+                      "user", "nouser", "users", "owner", "group"]
 
 
 class AppRunType(object):
@@ -27,6 +38,11 @@ class AppRunType(object):
     TEARDOWN = "TDN"
     RENEW = "REN"
     MOUNT = "MNT"
+    WATCH = "WCH"
+    BATCH = "BAT"
+    MOUNT_ALL = "ALL"
+    STATUS = "STS"
+    MTU_CHECK = "MTU"
 
     def __init__(self, value):
         self.value = value
@@ -43,6 +59,21 @@ class AppRunType(object):
     def is_mount(self):
         return self.value == self.MOUNT
 
+    def is_watch(self):
+        return self.value == self.WATCH
+
+    def is_batch(self):
+        return self.value == self.BATCH
+
+    def is_mount_all(self):
+        return self.value == self.MOUNT_ALL
+
+    def is_status(self):
+        return self.value == self.STATUS
+
+    def is_mtu_check(self):
+        return self.value == self.MTU_CHECK
+
 
 class ArgsHandler(MountHelperBase):
     """Class to process nfs mount command arguments."""
@@ -71,15 +102,18 @@ class ArgsHandler(MountHelperBase):
         args, _ = parser.parse_known_args()
         if is_error:
             return False
-        self.mount_source = args.Source
-        self.mount_point = args.Destination
+        return self.set_args(args.Source, args.Destination, args.o)
+
+    def set_args(self, source, mount_point, opts):
+        self.mount_source = source
+        self.mount_point = mount_point
         self.ip_address, self.mount_path = NfsMount.extract_source(
             self.mount_source)
         if not self.ip_address or not self.mount_path:
             return self.LogError('Provide the mount source as <nfs_host>:<path>(' + self.mount_source + ').')
         if len(self.mount_point) <= 0:
             return self.LogError("Provide the mount point to mount on local host.")
-        self.options, self.is_secure = self.get_mount_options(args.o)
+        self.options, self.is_secure = self.get_mount_options(opts)
         return True
 
     @staticmethod
@@ -87,6 +121,112 @@ class ArgsHandler(MountHelperBase):
         args = ArgsHandler()
         return args if args.parse() else None
 
+    # mount.ibmshare -MOUNT_BATCH [-o options] [-f manifest] [source mount_point ...]
+    def parse_batch(self):
+        is_error = False
+
+        def parse_error(errmsg):
+            nonlocal is_error
+            is_error = True
+            self.LogError(errmsg)
+        parser = argparse.ArgumentParser()
+        parser.error = parse_error
+        parser.add_argument(MOUNT_BATCH, action='store_true')
+        parser.add_argument('-f', dest='manifest', default=None)
+        parser.add_argument('-o', default="")
+        parser.add_argument('Shares', nargs='*')  # nfs_host:path mount_point
+        args, _ = parser.parse_known_args()
+        if is_error:
+            return None
+        if len(args.Shares) % 2 != 0:
+            return self.LogError("Provide each share as <nfs_host>:<path> <mount_point>.")
+
+        shares = []
+        for pos in range(0, len(args.Shares), 2):
+            shares.append((args.Shares[pos], args.Shares[pos + 1], args.o))
+        if args.manifest:
+            entries = self.read_manifest(args.manifest)
+            if entries is None:
+                return None
+            shares += entries
+        return self.new_share_args(shares)
+
+    # one share per line: <nfs_host>:<path> <mount_point> [options]
+    def read_manifest(self, fname):
+        data = self.ReadFile(fname)
+        if data is None:
+            self.LogError("Could not read share list: " + fname)
+            return None
+        shares = []
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith("#"):
+                continue
+            if len(fields) < 2:
+                self.LogError("Invalid share list entry: " + line)
+                return None
+            shares.append((fields[0], fields[1],
+                           fields[2] if len(fields) > 2 else ""))
+        return shares
+
+    # ibmshare entries in fstab: <nfs_host>:<path> <mount_point> ibmshare <options>
+    def read_fstab(self, fname):
+        data = self.ReadFile(fname)
+        if data is None:
+            self.LogError("Could not read fstab: " + fname)
+            return None
+        shares = []
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) < 3 or fields[0].startswith("#"):
+                continue
+            if fields[2] != FSTAB_TYPE:
+                continue
+            options = fields[3].split(",") if len(fields) > 3 else []
+            if FSTAB_NOAUTO in options:
+                self.LogDebug("Skipping noauto share: " + fields[1])
+                continue
+            options = [opt for opt in options
+                       if opt not in FSTAB_SKIP_OPTIONS and not opt.startswith("x-")]
+            shares.append((unescape_mount_field(fields[0]),
+                           unescape_mount_field(fields[1]), ",".join(options)))
+        return shares
+
+    def parse_fstab(self):
+        shares = self.read_fstab(FSTAB_FILE)
+        if shares is None:
+            return None
+        if len(shares) == 0:
+            self.LogInfo("No ibmshare entries found in: " + FSTAB_FILE)
+            return []
+        # one unresolved host must not hold back the other boot mounts
+        return self.new_share_args(shares, skip_invalid=True)
+
+    def new_share_args(self, shares, skip_invalid=False):
+        if len(shares) == 0:
+            return self.LogError("No shares found to mount.")
+        # resolve all the nfs hosts together
+        hosts = [NfsMount.split_source(share[0])[0] for share in shares]
+        HostResolver.get().resolve_all([host for host in hosts if host])
+        out = []
+        for source, mount_point, opts in shares:
+            args = ArgsHandler()
+            if not args.set_args(source, mount_point, opts):
+                if not skip_invalid:
+                    return None
+                self.LogError("Skipping share: %s %s" % (source, mount_point))
+                continue
+            out.append(args)
+        return out
+
+    @staticmethod
+    def get_batch_mount_args():
+        return ArgsHandler().parse_batch()
+
+    @staticmethod
+    def get_fstab_mount_args():
+        return ArgsHandler().parse_fstab()
+
     @staticmethod
     def is_renew_certificate():
         return SysApp.has_arg(RENEW_CERTIFICATE_FLAG)
@@ -99,9 +239,35 @@ class ArgsHandler(MountHelperBase):
     def is_app_teardown():
         return SysApp.has_arg(TEARDOWN_APP)
 
+    @staticmethod
+    def is_watch_mounts():
+        return SysApp.has_arg(WATCH_MOUNTS)
+
+    @staticmethod
+    def is_batch_mount():
+        return SysApp.has_arg(MOUNT_BATCH)
+
+    @staticmethod
+    def is_mount_all():
+        return SysApp.has_arg(MOUNT_ALL)
+
+    @staticmethod
+    def is_sa_status():
+        return SysApp.has_arg(SA_STATUS)
+
+    @staticmethod
+    def is_mtu_check():
+        return SysApp.has_arg(MTU_CHECK)
+
     def get_renew_certificate_cmd_line(self):
         return SBIN_SCRIPT + " " + RENEW_CERTIFICATE_FLAG
 
+    def get_watch_mounts_cmd_line(self):
+        return SBIN_SCRIPT + " " + WATCH_MOUNTS
+
+    def get_mount_all_cmd_line(self):
+        return SBIN_SCRIPT + " " + MOUNT_ALL
+
     @staticmethod
     def is_debug_enabled():
         args = str(SysApp.argv())
@@ -116,6 +282,16 @@ class ArgsHandler(MountHelperBase):
             run_type = AppRunType.TEARDOWN
         elif ArgsHandler.is_renew_certificate():
             run_type = AppRunType.RENEW
+        elif ArgsHandler.is_watch_mounts():
+            run_type = AppRunType.WATCH
+        elif ArgsHandler.is_batch_mount():
+            run_type = AppRunType.BATCH
+        elif ArgsHandler.is_mount_all():
+            run_type = AppRunType.MOUNT_ALL
+        elif ArgsHandler.is_sa_status():
+            run_type = AppRunType.STATUS
+        elif ArgsHandler.is_mtu_check():
+            run_type = AppRunType.MTU_CHECK
         return AppRunType(run_type)
 
     @staticmethod
@@ -7,8 +7,21 @@
 
 from datetime import datetime, timezone
 from common import *
+import base64
+import binascii
 
 RSA_KEY_LENGTH = 4096
+# share.conf key_algorithm=<name>: genpkey options
+KEY_ALGORITHMS = {
+    "rsa": ["-algorithm", "RSA", "-pkeyopt", "rsa_keygen_bits:" + str(RSA_KEY_LENGTH)],
+    "ecdsa-p256": ["-algorithm", "EC", "-pkeyopt", "ec_paramgen_curve:P-256",
+                   "-pkeyopt", "ec_param_enc:named_curve"],
+    "ecdsa-p384": ["-algorithm", "EC", "-pkeyopt", "ec_paramgen_curve:P-384",
+                   "-pkeyopt", "ec_param_enc:named_curve"],
+}
+KEY_ALGORITHM_DEFAULT = "rsa"
+# holds a configured key algorithm the service rejected, rsa is used until it changes
+KEY_REJECTED_FILE = LocalInstall.make_filename("key_rejected")
 CERT_VALID_LIFE_REMAINS = 0.3
 OPENSSL_CSR_SUBJECT = "/C=US/ST=IL/L=Chicago/O=IBM Corporation/OU=IBM Software Group"
 ALERT_CA_BEFORE = 270
@@ -39,6 +52,188 @@ class CryptoX509:
         return self.not_before and self.not_after
 
 
+# Reads the validity, subject and issuer of a PEM or DER certificate
+# without openssl, the names are shown the way openssl x509 shows them.
+class X509Reader:
+    SEQUENCE = 0x30
+    SET = 0x31
+    OID = 0x06
+    UTC_TIME = 0x17
+    GENERALIZED_TIME = 0x18
+    VERSION = 0xa0
+    PEM_BEGIN = "-----BEGIN %s-----"
+    PEM_END = "-----END %s-----"
+    DATE_FORMAT = "%b %d %H:%M:%S %Y GMT"
+    OID_NAMES = {"2.5.4.3": "CN", "2.5.4.4": "SN", "2.5.4.5": "serialNumber",
+                 "2.5.4.6": "C", "2.5.4.7": "L", "2.5.4.8": "ST", "2.5.4.9": "street",
+                 "2.5.4.10": "O", "2.5.4.11": "OU", "2.5.4.12": "title",
+                 "2.5.4.17": "postalCode", "2.5.4.42": "GN",
+                 "1.2.840.113549.1.9.1": "emailAddress",
+                 "0.9.2342.19200300.100.1.1": "UID",
+                 "0.9.2342.19200300.100.1.25": "DC"}
+    # PKCS#8 (algorithm, parameters) oids: key algorithm name
+    KEY_OIDS = {("1.2.840.113549.1.1.1", None): "rsa",
+                ("1.2.840.10045.2.1", "1.2.840.10045.3.1.7"): "ecdsa-p256",
+                ("1.2.840.10045.2.1", "1.3.132.0.34"): "ecdsa-p384"}
+    # string tag: codec
+    STRING_CODECS = {0x0c: "utf-8", 0x13: "ascii", 0x14: "latin-1", 0x16: "ascii",
+                     0x1c: "utf-32-be", 0x1e: "utf-16-be"}
+    # openssl quotes names holding these (RFC 2253), " and \\ are escaped
+    QUOTE_CHARS = ",+<>;"
+
+    @staticmethod
+    def to_der(data, label="CERTIFICATE"):
+        if isinstance(data, bytes):
+            if not data.lstrip().startswith(b"-----"):
+                return data
+            data = data.decode("ascii", errors="replace")
+        begin = X509Reader.PEM_BEGIN % label
+        start = data.find(begin)
+        end = data.find(X509Reader.PEM_END % label, start)
+        if start < 0 or end < 0:
+            raise ValueError("PEM %s not found" % label.lower())
+        body = data[start + len(begin):end]
+        try:
+            return base64.b64decode("".join(body.split()), validate=True)
+        except ValueError:
+            raise ValueError("PEM %s base64 invalid" % label.lower())
+
+    # tag, value start, value end
+    @staticmethod
+    def read_tlv(data, pos, end=None):
+        end = len(data) if end is None else end
+        if pos + 2 > end:
+            raise ValueError("ASN.1 element truncated")
+        tag = data[pos]
+        size = data[pos + 1]
+        pos += 2
+        if size & 0x80:
+            count = size & 0x7f
+            if count == 0 or count > 4 or pos + count > end:
+                raise ValueError("ASN.1 length invalid")
+            size = int.from_bytes(data[pos:pos + count], "big")
+            pos += count
+        if pos + size > end:
+            raise ValueError("ASN.1 element truncated")
+        return tag, pos, pos + size
+
+    @staticmethod
+    def expect(data, pos, end, tag):
+        rtag, start, stop = X509Reader.read_tlv(data, pos, end)
+        if rtag != tag:
+            raise ValueError("ASN.1 tag %d expected, found %d" % (tag, rtag))
+        return start, stop
+
+    @staticmethod
+    def read_oid(value):
+        if len(value) == 0:
+            raise ValueError("ASN.1 oid empty")
+        parts = [value[0] // 40 if value[0] < 80 else 2, 0]
+        parts[1] = value[0] - parts[0] * 40
+        num = 0
+        for byte in value[1:]:
+            num = (num << 7) | (byte & 0x7f)
+            if not byte & 0x80:
+                parts.append(num)
+                num = 0
+        return ".".join(str(part) for part in parts)
+
+    @staticmethod
+    def read_time(tag, value):
+        text = value.decode("ascii")
+        if tag == X509Reader.UTC_TIME:
+            year = int(text[:2])
+            text = ("19" if year >= 50 else "20") + text
+        elif tag != X509Reader.GENERALIZED_TIME:
+            raise ValueError("ASN.1 time invalid: %d" % tag)
+        dt = datetime.strptime(text, "%Y%m%d%H%M%SZ")
+        return dt.strftime(X509Reader.DATE_FORMAT)
+
+    @staticmethod
+    def escape(text):
+        out = ""
+        quote = len(text) > 0 and (text[0] in "# " or text[-1] == " ")
+        for char in text:
+            if char in X509Reader.QUOTE_CHARS:
+                quote = True
+                out += char
+            elif char in '"\\':
+                out += "\\" + char
+            elif ord(char) < 0x20 or ord(char) > 0x7e:
+                out += "".join("\\%02X" % byte for byte in char.encode("utf-8"))
+            else:
+                out += char
+        return '"%s"' % out if quote else out
+
+    @staticmethod
+    def read_value(tag, value):
+        codec = X509Reader.STRING_CODECS.get(tag)
+        if codec is None:
+            # openssl dumps unknown types as hex
+            return "#" + binascii.hexlify(value).decode().upper()
+        return X509Reader.escape(value.decode(codec, errors="replace"))
+
+    # "C = US, O = IBM, CN = name", multi valued RDNs joined with " + "
+    @staticmethod
+    def read_name(data, pos, end):
+        rdns = []
+        while pos < end:
+            start, stop = X509Reader.expect(data, pos, end, X509Reader.SET)
+            pos = stop
+            attrs = []
+            while start < stop:
+                astart, astop = X509Reader.expect(data, start, stop, X509Reader.SEQUENCE)
+                start = astop
+                ostart, ostop = X509Reader.expect(data, astart, astop, X509Reader.OID)
+                oid = X509Reader.read_oid(data[ostart:ostop])
+                tag, vstart, vstop = X509Reader.read_tlv(data, ostop, astop)
+                attrs.append("%s = %s" % (X509Reader.OID_NAMES.get(oid, oid),
+                                          X509Reader.read_value(tag, data[vstart:vstop])))
+            rdns.append(" + ".join(attrs))
+        return ", ".join(rdns)
+
+    # [not before, not after, subject, issuer] as openssl x509 -dates -subject -issuer
+    @staticmethod
+    def parse(data):
+        der = X509Reader.to_der(data)
+        start, end = X509Reader.expect(der, 0, len(der), X509Reader.SEQUENCE)
+        pos, end = X509Reader.expect(der, start, end, X509Reader.SEQUENCE)
+        tag, _, stop = X509Reader.read_tlv(der, pos, end)
+        if tag == X509Reader.VERSION:
+            pos = stop
+        # serial number, signature algorithm
+        for _ in range(2):
+            _, _, pos = X509Reader.read_tlv(der, pos, end)
+        start, pos = X509Reader.expect(der, pos, end, X509Reader.SEQUENCE)
+        issuer = X509Reader.read_name(der, start, pos)
+        start, pos = X509Reader.expect(der, pos, end, X509Reader.SEQUENCE)
+        dates = []
+        while start < pos:
+            tag, vstart, start = X509Reader.read_tlv(der, start, pos)
+            dates.append(X509Reader.read_time(tag, der[vstart:start]))
+        if len(dates) != 2:
+            raise ValueError("Certificate validity invalid")
+        start, pos = X509Reader.expect(der, pos, end, X509Reader.SEQUENCE)
+        subject = X509Reader.read_name(der, start, pos)
+        return [dates[0], dates[1], subject, issuer]
+
+    # key algorithm name of a PKCS#8 private key, None if not known
+    @staticmethod
+    def read_key_algorithm(data):
+        der = X509Reader.to_der(data, "PRIVATE KEY")
+        start, end = X509Reader.expect(der, 0, len(der), X509Reader.SEQUENCE)
+        # version
+        _, _, pos = X509Reader.read_tlv(der, start, end)
+        start, end = X509Reader.expect(der, pos, end, X509Reader.SEQUENCE)
+        ostart, ostop = X509Reader.expect(der, start, end, X509Reader.OID)
+        params = None
+        if ostop < end:
+            tag, pstart, pstop = X509Reader.read_tlv(der, ostop, end)
+            if tag == X509Reader.OID:
+                params = X509Reader.read_oid(der[pstart:pstop])
+        return X509Reader.KEY_OIDS.get((X509Reader.read_oid(der[ostart:ostop]), params))
+
+
 class CertificateHandler(MountHelperBase):
     """Class to handle certificate expiration."""
 
@@ -76,22 +271,46 @@ class CertificateHandler(MountHelperBase):
     def load_root_ca_certificate(self):
         return self.load_certificate_by_filename(self.root_ca_filename())
 
-    def run_openssl(self, cmd, descr):
+    # key and cert data go through stdin/stdout, never a file
+    def run_openssl(self, cmd, descr, input=None):
         openssl_cmd = ["openssl"] + cmd
-        return self.RunCmd(openssl_cmd, descr)
+        return self.RunCmd(openssl_cmd, descr, input=input)
+
+    def read_cert_fields(self, data):
+        try:
+            return X509Reader.parse(data)
+        except (ValueError, UnicodeError) as ex:
+            self.LogError("Certificate could not be read (%s)" % str(ex))
+        return None
+
+    def set_cert_fields(self, fields):
+        crt = CryptoX509()
+        if crt.set_dates(fields[0], fields[1]):
+            crt.set_subject(fields[2])
+            crt.set_issuer(fields[3])
+            self.crypto_x509 = crt
+        return self.is_loaded()
 
+    # fields cached by file stamp and content hash, write_cert drops them
     def load_certificate_by_filename(self, fpath):
         self.crypto_x509 = None
         if self.FileExists(fpath):
-            out = self.run_openssl(["x509", "-in", fpath, "-noout", "-dates","-subject","-issuer"],
-                                   "LoadCert")
-            if out:
-                crt = CryptoX509()
-                if crt.set_dates(out.get_stdout_val("notBefore=", True),
-                                 out.get_stdout_val("notAfter=", True)):
-                    crt.set_subject(out.get_stdout_val("subject=", True))
-                    crt.set_issuer(out.get_stdout_val("issuer=", True))
-                    self.crypto_x509 = crt
+            try:
+                with open(fpath, "rb") as fd:
+                    data = fd.read()
+            except OSError as ex:
+                self.LogError("Certificate could not be read: %s (%s)" % (fpath, str(ex)))
+                return False
+            key = StateCache.file_key("x509", fpath)
+            digest = StateCache.content_hash(data)
+            val = StateCache.get().lookup(key, fpath)
+            if val is not None:
+                fields = val.split("\n")
+                if fields[0] == digest:
+                    return self.set_cert_fields(fields[1:])
+            fields = self.read_cert_fields(data)
+            if fields and self.set_cert_fields(fields):
+                StateCache.get().store(key, fpath, "\n".join([digest] + fields))
         return self.is_loaded()
 
     def get_subject(self):
@@ -101,12 +320,9 @@ class CertificateHandler(MountHelperBase):
         return self.crypto_x509.issuer
 
     def load_cert(self, data):
-        try:
-            with TempFile(data) as cert:
-                return self.load_certificate_by_filename(cert.filename)
-        except Exception as ex:
-            self.LogException('LoadX509Certificate', ex)
-        return None
+        self.crypto_x509 = None
+        fields = self.read_cert_fields(data)
+        return self.set_cert_fields(fields) if fields else False
 
     def get_certificate_not_after_date(self):
         if not self.is_loaded():
@@ -179,52 +395,169 @@ class CertificateHandler(MountHelperBase):
 
         return rdate
 
-    def load_private_key(self, data):
+    def is_private_key_checked(self, data, fpath):
+        if not fpath:
+            return False
+        val = StateCache.get().lookup(StateCache.file_key("pkey", fpath), fpath)
+        return val == StateCache.content_hash(data)
+
+    # share.conf key_algorithm, rsa unless set
+    def key_algorithm(self):
+        name = ShareConfig(None, show_error=False).get_str("key_algorithm",
+                                                          KEY_ALGORITHM_DEFAULT).lower()
+        if name not in KEY_ALGORITHMS:
+            self.LogError("Key algorithm unknown: %s, using: %s" % (name, KEY_ALGORITHM_DEFAULT))
+            return KEY_ALGORITHM_DEFAULT
+        if name != KEY_ALGORITHM_DEFAULT and name == self.rejected_key_algorithm():
+            return KEY_ALGORITHM_DEFAULT
+        return name
+
+    def rejected_key_algorithm(self):
+        if not self.FileExists(KEY_REJECTED_FILE):
+            return None
+        val = self.ReadFile(KEY_REJECTED_FILE, log=False)
+        return val.strip() if val else None
+
+    def set_rejected_key_algorithm(self, name):
+        if LocalInstall.exists():
+            self.WriteFile(KEY_REJECTED_FILE, name)
+
+    def private_key_algorithm(self, data):
+        try:
+            return X509Reader.read_key_algorithm(data)
+        except (ValueError, UnicodeError):
+            return None
+
+    # data read from fpath skips the check while the file is unchanged
+    def load_private_key(self, data, fpath=None):
         try:
             if not is_empty(data):
-                with TempFile(data) as key:
-                    if self.run_openssl(["rsa", "-in", key.filename, "-check"],
-                                        "LoadPrivateKey"):
-                        return key
+                if self.is_private_key_checked(data, fpath):
+                    self.LogDebug("Private key already checked: " + fpath)
+                    return True
+                algorithm = self.private_key_algorithm(data) or KEY_ALGORITHM_DEFAULT
+                check = "rsa" if algorithm == "rsa" else "ec"
+                if self.run_openssl([check, "-check", "-noout"], "LoadPrivateKey", input=data):
+                    if fpath:
+                        StateCache.get().store(StateCache.file_key("pkey", fpath), fpath,
+                                               StateCache.content_hash(data))
+                    return True
         except Exception as ex:
             self.LogException('LoadX509PrivateKey', ex)
         return None
 
-    def generate_private_key(self):
-        with TempFile() as key:
-            out = self.run_openssl(["genpkey",
-                                    "-algorithm", "RSA",
-                                   "-out", key.filename,
-                                    "-outform", "PEM",
-                                    "-pkeyopt", "rsa_keygen_bits:" + str(RSA_KEY_LENGTH)],
-                                   "GenPrivateKey")
-            if out:
-                return key.read()
+    @staticmethod
+    def genpkey_args(algorithm=KEY_ALGORITHM_DEFAULT):
+        return ["genpkey", "-outform", "PEM"] + KEY_ALGORITHMS[algorithm]
+
+    def generate_private_key(self, algorithm=None):
+        algorithm = algorithm or self.key_algorithm()
+        out = self.run_openssl(self.genpkey_args(algorithm), "GenPrivateKey")
+        if out:
+            return out.stdout
         return None
 
     # a helper function to check csr is ok
     def validate_csr(self, csr_txt):
         csr_txt = csr_txt.replace("\\n", "\n")
-        with TempFile(csr_txt) as csr:
-            cmd = ["req", "-in", csr.filename, "-text", "-noout", "-verify"]
-            out = self.run_openssl(cmd, "CheckCSR")
-            return out is not None
+        cmd = ["req", "-text", "-noout", "-verify"]
+        out = self.run_openssl(cmd, "CheckCSR", input=csr_txt)
+        return out is not None
 
     def get_digest(self):
         return "-sha256"
 
+    # the csr self-signature is verified as it is generated
     def generate_csr(self, private_key):
-        # openssl req -out server.csr -key server.key -new
+        # openssl req -new -key /dev/stdin -verify < server.key > server.csr
         digest = self.get_digest()
-        with TempFile(private_key) as key:
-            with TempFile() as csr:
-                cmd = ["req", "-nodes", digest, "-new",
-                       "-subj", OPENSSL_CSR_SUBJECT,
-                       "-out", csr.filename,
-                       "-key", key.filename]
-                out = self.run_openssl(cmd, "GenCSR")
-                if out:
-                    csr_txt = csr.read()
-                    csr_txt = csr_txt.replace("\n", "\\n")
-                    return csr_txt
+        cmd = ["req", "-nodes", digest, "-new",
+               "-subj", OPENSSL_CSR_SUBJECT,
+               "-key", "/dev/stdin", "-verify"]
+        out = self.run_openssl(cmd, "GenCSR", input=private_key)
+        if out:
+            csr_txt = out.stdout
+            csr_txt = csr_txt.replace("\n", "\\n")
+            return csr_txt
         return None
+
+
+# The next private key, generated in the background at idle cpu and io
+# priority so a renewal or the first mount does not wait for genpkey.
+# share.conf key_rotate_renewals=<n> takes a new key every n renewals.
+class KeyPool(MountHelperBase):
+    KEY_FILE = LocalInstall.make_filename("next.key")
+    RENEWALS_FILE = LocalInstall.make_filename("key_renewals")
+    # a fill still running after this is assumed dead
+    FILL_TIMEOUT_SECS = 600
+    NICE_CMD = ["nice", "-n", "19"]
+    IONICE_CMD = ["ionice", "-c", "3"]
+    # the key is moved in place only once openssl has written all of it
+    FILL_SCRIPT = ('f=$1; shift; umask 077 && : > "$f.tmp" && '
+                   '"$@" -out "$f.tmp" && mv -f "$f.tmp" "$f" || rm -f "$f.tmp"')
+
+    def tmp_filename(self):
+        return self.KEY_FILE + ".tmp"
+
+    def is_filling(self):
+        try:
+            return time.time() - os.path.getmtime(self.tmp_filename()) < self.FILL_TIMEOUT_SECS
+        except OSError:
+            return False
+
+    def fill_cmd(self):
+        cmd = ["sh", "-c", self.FILL_SCRIPT, "sh", self.KEY_FILE]
+        for prio in [self.NICE_CMD, self.IONICE_CMD]:
+            if shutil.which(prio[0]):
+                cmd += prio
+        algorithm = CertificateHandler().key_algorithm()
+        return cmd + ["openssl"] + CertificateHandler.genpkey_args(algorithm)
+
+    def fill(self):
+        if not LocalInstall.exists() or self.FileExists(self.KEY_FILE) or self.is_filling():
+            return False
+        self.LogDebug("Generating the next private key in background")
+        try:
+            subprocess.Popen(self.fill_cmd(), stdin=subprocess.DEVNULL,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+            return True
+        except OSError as ex:
+            self.LogDebug("Private key generation not started (%s)" % str(ex))
+        return False
+
+    # the pooled key or None, refilled when keys are rotated - the rename
+    # hands the key to one process only
+    def take(self):
+        fname = "%s.%d" % (self.KEY_FILE, os.getpid())
+        try:
+            os.rename(self.KEY_FILE, fname)
+        except OSError:
+            return None
+        data = self.ReadFile(fname)
+        self.RemoveFile(fname)
+        self.LogDebug("Using pooled private key")
+        if self.rotate_every() > 0:
+            self.fill()
+        return data
+
+    def rotate_every(self):
+        return ShareConfig(None, show_error=False).get_int("key_rotate_renewals", 0)
+
+    def renewals(self):
+        val = None
+        if self.FileExists(self.RENEWALS_FILE):
+            val = self.ReadFile(self.RENEWALS_FILE, log=False)
+        return int(val) if val and val.strip().isdigit() else 0
+
+    def is_rotation_due(self):
+        every = self.rotate_every()
+        return every > 0 and self.renewals() >= every
+
+    # count renewals done with the same key
+    def renewed(self, new_key):
+        count = 0 if new_key else self.renewals() + 1
+        if LocalInstall.exists():
+            self.WriteFile(self.RENEWALS_FILE, str(count))
+        if self.rotate_every() > 0:
+            self.fill()
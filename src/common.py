@@ -7,16 +7,23 @@
 
 import copy
 import glob
+import hashlib
+import json
+import mmap
 import os
 import re
 import sys
 import socket
 import subprocess
 import shutil
+import struct
 import tempfile
 import time
+import uuid
 import logging
 import logging.handlers
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 
 
@@ -385,15 +392,19 @@ class SubProcess(MountHelperLogger):
             self.LogException(ex, "Stream")
         return None
 
-    def run(self):
+    # input is piped to stdin
+    def run(self, input=None):
+        if isinstance(input, str):
+            input = input.encode()
         if sys.version_info[:2] < (3, 5):
             proc = subprocess.Popen(
-                self.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (stdout, stderr) = proc.communicate()
+                self.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                stdin=subprocess.PIPE if input is not None else None)
+            (stdout, stderr) = proc.communicate(input)
             return self.set_output(proc.returncode, stdout, stderr)
 
         out = subprocess.run(self.cmd, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE, input=input)
         return self.set_output(out.returncode, out.stdout, out.stderr)
 
 
@@ -481,7 +492,7 @@ class MountHelperBase(MountHelperLogger):
         out = SubProcess(cmd).run()
         return out
 
-    def RunCmd(self, cmd, descr, ret_out=False):
+    def RunCmd(self, cmd, descr, ret_out=False, input=None):
         proc = SubProcess(cmd)
 
         try:
@@ -489,7 +500,7 @@ class MountHelperBase(MountHelperLogger):
             if not is_empty(descr):
                 msg = "%s (%s)" % (descr, msg)
             self.LogDebug("RunCmd: " + msg)
-            output = proc.run()
+            output = proc.run(input)
             if output.is_error():
                 self.LogError(output.get_error())
                 if ret_out:
@@ -563,6 +574,300 @@ class SystemCtl(MountHelperBase):
         return self.RunCmd(cmd, "")
 
 
+def unescape_mount_field(val):
+    # mountinfo escapes space, tab, newline and backslash as \ooo
+    if "\\" not in val:
+        return val
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), val)
+
+
+class HostResolver(MountHelperBase):
+    CACHE_FILE = LocalInstall.make_filename("host_cache.json")
+    CACHE_TTL_SECS = 300
+    CACHE_MAX_ENTRIES = 256
+    MAX_WORKERS = 8
+    resolver_obj = None
+
+    def __init__(self):
+        self.cache = None  # host: [ip, expires_at]
+        self.changed = False
+
+    @staticmethod
+    def get():
+        if not HostResolver.resolver_obj:
+            HostResolver.resolver_obj = HostResolver()
+        return HostResolver.resolver_obj
+
+    @staticmethod
+    def is_ip(host):
+        try:
+            socket.inet_pton(socket.AF_INET, host)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def load(self):
+        if self.cache is not None:
+            return self.cache
+        self.cache = {}
+        try:
+            if os.path.exists(self.CACHE_FILE):
+                with open(self.CACHE_FILE, "r") as fd:
+                    data = json.load(fd)
+                now = time.time()
+                for host, entry in data.items():
+                    if entry[1] > now:
+                        self.cache[host] = entry
+        except Exception as ex:
+            self.LogDebug("HostCache ignored (%s)" % str(ex))
+        return self.cache
+
+    def save(self):
+        if not self.changed or not LocalInstall.exists():
+            return False
+        # keep the entries that expire last
+        if len(self.cache) > self.CACHE_MAX_ENTRIES:
+            hosts = sorted(self.cache, key=lambda h: self.cache[h][1])
+            for host in hosts[:len(hosts) - self.CACHE_MAX_ENTRIES]:
+                del self.cache[host]
+        tmp_file = "%s.%d" % (self.CACHE_FILE, os.getpid())
+        try:
+            with open(tmp_file, "w") as fd:
+                json.dump(self.cache, fd)
+            os.replace(tmp_file, self.CACHE_FILE)
+            self.changed = False
+            return True
+        except Exception as ex:
+            self.LogDebug("HostCache not saved (%s)" % str(ex))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return False
+
+    # cached or literal ip only - no dns call
+    def lookup(self, host):
+        if HostResolver.is_ip(host):
+            return host
+        entry = self.load().get(host)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def add(self, host, ip):
+        self.load()[host] = [ip, time.time() + self.CACHE_TTL_SECS]
+        self.changed = True
+
+    def gethostbyname(self, host):
+        try:
+            return socket.gethostbyname(host)
+        except Exception:
+            self.LogDebug("Could not resolve host: " + host)
+        return None
+
+    def resolve(self, host):
+        ip = self.lookup(host)
+        if not ip:
+            ip = self.gethostbyname(host)
+            if ip:
+                self.add(host, ip)
+                self.save()
+        return ip
+
+    # resolve all unknown hosts together
+    def resolve_all(self, hosts):
+        resolved = {}
+        pending = []
+        for host in hosts:
+            if host not in resolved:
+                resolved[host] = self.lookup(host)
+                if not resolved[host]:
+                    pending.append(host)
+        if len(pending) > 0:
+            self.LogDebug("Resolving hosts:" + str(len(pending)))
+            workers = min(len(pending), self.MAX_WORKERS)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                ips = list(pool.map(self.gethostbyname, pending))
+            for host, ip in zip(pending, ips):
+                resolved[host] = ip
+                if ip:
+                    self.add(host, ip)
+            self.save()
+        return resolved
+
+
+# Fixed layout state file shared by all the helper runs, each fact is
+# stored with the stamp of the file it was taken from so a stale entry
+# is never used. Readers map the file, writers replace it.
+class StateCache(MountHelperBase):
+    CACHE_FILE = LocalInstall.make_filename("state.bin")
+    BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+    MAGIC = b"IBMS"
+    VERSION = 1
+    SLOTS = 16
+    VALUE_SIZE = 472
+    # magic, version, slots, boot id
+    HEADER = struct.Struct("<4sHH16s")
+    # key hash, inode, size, mtime_ns, stored at, value
+    SLOT = struct.Struct("<QQQqd%ds" % VALUE_SIZE)
+    state_obj = None
+
+    def __init__(self):
+        self.boot_id = None
+
+    @staticmethod
+    def get():
+        if not StateCache.state_obj:
+            StateCache.state_obj = StateCache()
+        return StateCache.state_obj
+
+    def get_boot_id(self):
+        if self.boot_id is None:
+            try:
+                with open(self.BOOT_ID_FILE, "r") as fd:
+                    self.boot_id = uuid.UUID(fd.read().strip()).bytes
+            except (OSError, ValueError):
+                self.boot_id = bytes(16)
+        return self.boot_id
+
+    @staticmethod
+    def key_hash(key):
+        digest = hashlib.sha1(key.encode()).digest()
+        return int.from_bytes(digest[:8], "little") or 1
+
+    # key of a result derived from the content of fname
+    @staticmethod
+    def file_key(kind, fname):
+        return "%s:%s" % (kind, fname)
+
+    @staticmethod
+    def content_hash(data):
+        if isinstance(data, str):
+            data = data.encode()
+        return hashlib.sha1(data).hexdigest()
+
+    @staticmethod
+    def file_stamp(fname):
+        try:
+            st = os.stat(fname)
+            return (st.st_ino, st.st_size, st.st_mtime_ns)
+        except OSError:
+            return None
+
+    def file_size(self):
+        return self.HEADER.size + self.SLOTS * self.SLOT.size
+
+    def slot_offset(self, index):
+        return self.HEADER.size + index * self.SLOT.size
+
+    # linear probing from the slot of khash, keys sharing a slot both stay
+    def probe(self, khash):
+        return [(khash + i) % self.SLOTS for i in range(self.SLOTS)]
+
+    # (slot index, entry) holding khash, (None, None) if not stored
+    def find_slot(self, data, khash):
+        for index in self.probe(khash):
+            entry = self.SLOT.unpack_from(data, self.slot_offset(index))
+            if entry[0] == khash:
+                return index, entry
+        return None, None
+
+    # slot of khash, else the first free slot, else the oldest entry
+    def store_slot(self, data, khash):
+        index, _ = self.find_slot(data, khash)
+        if index is not None:
+            return index
+        oldest = None
+        for index in self.probe(khash):
+            entry = self.SLOT.unpack_from(data, self.slot_offset(index))
+            if entry[0] == 0:
+                return index
+            if oldest is None or entry[4] < oldest[1]:
+                oldest = (index, entry[4])
+        return oldest[0]
+
+    def is_valid(self, data):
+        if len(data) != self.file_size():
+            return False
+        magic, version, slots, boot_id = self.HEADER.unpack_from(data, 0)
+        return (magic == self.MAGIC and version == self.VERSION and
+                slots == self.SLOTS and boot_id == self.get_boot_id())
+
+    def read_slot(self, khash):
+        try:
+            with open(self.CACHE_FILE, "rb") as fd:
+                with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if self.is_valid(data):
+                        return self.find_slot(data, khash)[1]
+        except (OSError, ValueError):
+            pass
+        return None
+
+    # the value stored for key, if fname has not changed since
+    def lookup(self, key, fname, max_age=None):
+        stamp = StateCache.file_stamp(fname)
+        if not stamp:
+            return None
+        khash = StateCache.key_hash(key)
+        entry = self.read_slot(khash)
+        if not entry or tuple(entry[1:4]) != stamp:
+            return None
+        if max_age is not None and time.time() - entry[4] > max_age:
+            return None
+        return entry[5].rstrip(b"\0").decode()
+
+    def load_data(self):
+        try:
+            with open(self.CACHE_FILE, "rb") as fd:
+                data = bytearray(fd.read())
+            if self.is_valid(data):
+                return data
+        except OSError:
+            pass
+        data = bytearray(self.file_size())
+        self.HEADER.pack_into(data, 0, self.MAGIC, self.VERSION,
+                              self.SLOTS, self.get_boot_id())
+        return data
+
+    def store(self, key, fname, value):
+        if not LocalInstall.exists():
+            return False
+        stamp = StateCache.file_stamp(fname)
+        value = value.encode()
+        if not stamp or len(value) > self.VALUE_SIZE:
+            return False
+        khash = StateCache.key_hash(key)
+        data = self.load_data()
+        self.SLOT.pack_into(data, self.slot_offset(self.store_slot(data, khash)), khash,
+                            stamp[0], stamp[1], stamp[2], time.time(), value)
+        return self.save_data(data)
+
+    def remove(self, key):
+        khash = StateCache.key_hash(key)
+        if not self.read_slot(khash):
+            return False
+        data = self.load_data()
+        index, _ = self.find_slot(data, khash)
+        offset = self.slot_offset(index)
+        data[offset:offset + self.SLOT.size] = bytes(self.SLOT.size)
+        return self.save_data(data)
+
+    def save_data(self, data):
+        tmp_file = "%s.%d" % (self.CACHE_FILE, os.getpid())
+        try:
+            with open(tmp_file, "wb") as fd:
+                fd.write(data)
+            os.replace(tmp_file, self.CACHE_FILE)
+            return True
+        except Exception as ex:
+            self.LogDebug("StateCache not saved (%s)" % str(ex))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return False
+
+
+# compact mount table entry - no per record __dict__
+MountRecord = namedtuple("MountRecord", ["ip", "mount_path", "mounted_at", "host"])
+
+
 class NfsMount(MountHelperBase):
     MOUNT_OUTPUT_FIELDS_SIZE = 5
     MOUNT_TYPE_NFS = 'nfs'
@@ -573,52 +878,178 @@ class NfsMount(MountHelperBase):
     PATH_INDEX = 1
     SOURCE_ARGS_LENGTH = 2
     MOUNT_LIST_NFS_CMD = ["mount", "-t nfs,nfs4"]
+    MOUNT_INFO_FILE = "/proc/self/mountinfo"
+    MOUNT_INFO_SEPARATOR = "-"
+    MOUNT_INFO_MOUNTED_AT = 4
+    MOUNT_INFO_MIN_FIELDS = 10
 
-    def __init__(self, ip=None, mount_path=None, mounted_at=None):
+    def __init__(self, ip=None, mount_path=None, mounted_at=None, host=None):
         self.ip = ip
         self.mount_path = mount_path
         self.mounted_at = mounted_at
+        self.host = host
+
+    # stop_at(mount) - return True to stop reading the mount table
+    def load_nfs_mounts(self, stop_at=None):
+        mounts = self.read_mount_info(stop_at)
+        if mounts is None:
+            mounts = self.run_mount_list(stop_at)
+        if mounts is not None:
+            self.LogDebug("Existing nfs/nfs4 mounts found:" + str(len(mounts)))
+        return mounts
+
+    # mounts with a host not in the resolver cache are resolved
+    # together once the table has been read
+    def add_mounts(self, new_mounts, stop_at):
+        mounts = []
+        pending = []
+        for mount in new_mounts:
+            if not mount:
+                continue
+            if not mount.ip:
+                pending.append(mount)
+                continue
+            mounts.append(mount)
+            if stop_at and stop_at(mount):
+                return mounts
+
+        if len(pending) > 0:
+            ips = HostResolver.get().resolve_all([m.host for m in pending])
+            for mount in pending:
+                mount = mount._replace(ip=ips[mount.host])
+                if mount.ip:
+                    mounts.append(mount)
+                    if stop_at and stop_at(mount):
+                        break
+        return mounts
+
+    def read_mount_info(self, stop_at=None):
+        try:
+            with open(NfsMount.MOUNT_INFO_FILE, "r") as fd:
+                return self.add_mounts(
+                    (self.get_mount_info(line) for line in fd
+                     if NfsMount.MOUNT_TYPE_NFS in line), stop_at)
+        except (IOError, OSError) as ex:
+            self.LogDebug("MountInfo not readable (%s) using: %s" %
+                          (str(ex), " ".join(NfsMount.MOUNT_LIST_NFS_CMD)))
+        return None
+
+    # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - nfs4 host:/path rw,...
+    def get_mount_info(self, line):
+        fields = line.split()
+        if len(fields) < NfsMount.MOUNT_INFO_MIN_FIELDS:
+            return None
+        try:
+            sep = fields.index(NfsMount.MOUNT_INFO_SEPARATOR,
+                               NfsMount.MOUNT_INFO_MOUNTED_AT + 1)
+        except ValueError:
+            return None
+        if len(fields) < sep + 3:
+            return None
+        fstype = fields[sep + 1]
+        if fstype != NfsMount.MOUNT_TYPE_NFS and fstype != NfsMount.MOUNT_TYPE_NFS4:
+            return None
+        return NfsMount.new_mount(unescape_mount_field(fields[sep + 2]),
+                                  unescape_mount_field(fields[NfsMount.MOUNT_INFO_MOUNTED_AT]))
 
-    def load_nfs_mounts(self):
+    def run_mount_list(self, stop_at=None):
         result = self.RunCmd(NfsMount.MOUNT_LIST_NFS_CMD, "ListNfsMounts")
         if not result:
             return None
 
         lines = result.stdout.splitlines()
-        mounts = []
         # Parse mount command output line by line and search for ip address and mount path.
-        for line in lines:
-            mount = self.get_nfs_mount(line)
-            if mount:
-                mounts.append(mount)
-
-        self.LogDebug("Existing nfs/nfs4 mounts found:" + str(len(mounts)))
-        return mounts
+        return self.add_mounts((self.get_nfs_mount(line) for line in lines), stop_at)
 
     def get_nfs_mount(self, line):
         mount_fields = line.split(" ")
         if len(mount_fields) >= NfsMount.MOUNT_OUTPUT_FIELDS_SIZE:
             if NfsMount.MOUNT_TYPE_NFS in mount_fields or NfsMount.MOUNT_TYPE_NFS4 in mount_fields:
-                ip, mount_path = NfsMount.extract_source(
-                    mount_fields[NfsMount.NFS_PATH_INDEX])
-                if ip and mount_path:
-                    return NfsMount(ip, mount_path, mount_fields[NfsMount.MOUNTED_AT])
+                return NfsMount.new_mount(mount_fields[NfsMount.NFS_PATH_INDEX],
+                                          mount_fields[NfsMount.MOUNTED_AT])
         return None
 
+    # ip is only set if known without a dns call
     @ staticmethod
-    def extract_source(src):
+    def new_mount(src, mounted_at):
+        host, mount_path = NfsMount.split_source(src)
+        if host and mount_path:
+            ip = HostResolver.get().lookup(host)
+            return MountRecord(ip, mount_path, mounted_at, host)
+        return None
+
+    @ staticmethod
+    def split_source(src):
         if len(src) > 0:
             host_path = src.split(":")
             if len(host_path) >= NfsMount.SOURCE_ARGS_LENGTH:
-                mount_path = host_path[NfsMount.PATH_INDEX]
-                try:
-                    ip = socket.gethostbyname(host_path[NfsMount.HOST_INDEX])
-                    return ip, mount_path
-                except:
-                    pass
+                return host_path[NfsMount.HOST_INDEX], host_path[NfsMount.PATH_INDEX]
+        return None, None
+
+    @ staticmethod
+    def extract_source(src):
+        host, mount_path = NfsMount.split_source(src)
+        if host:
+            ip = HostResolver.get().resolve(host)
+            if ip:
+                return ip, mount_path
         return None, None
 
 
+class MountInventory(object):
+    inventory_obj = None
+
+    def __init__(self, mounts=None):
+        self.records = []
+        self.by_ip = {}
+        self.by_source = {}
+        for mount in (mounts if mounts else []):
+            self.add(mount)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def add(self, mount):
+        self.records.append(mount)
+        self.by_ip.setdefault(mount.ip, []).append(mount)
+        self.by_source[(mount.ip, mount.mount_path)] = mount
+
+    def find(self, ip, mount_path):
+        return self.by_source.get((ip, mount_path))
+
+    def has_ip(self, ip):
+        return ip in self.by_ip
+
+    def get_ips(self):
+        return set(self.by_ip)
+
+    # process wide inventory - None if the mount table can't be read,
+    # a table cut short by stop_at(mount) is returned but not kept
+    @staticmethod
+    def load(refresh=False, stop_at=None):
+        if refresh or MountInventory.inventory_obj is None:
+            mounts = NfsMount().load_nfs_mounts(stop_at)
+            inventory = MountInventory(mounts) if mounts is not None else None
+            if stop_at and mounts and stop_at(mounts[-1]):
+                return inventory
+            MountInventory.inventory_obj = inventory
+        return MountInventory.inventory_obj
+
+    # mount table has changed
+    @staticmethod
+    def reset():
+        MountInventory.inventory_obj = None
+
+    @staticmethod
+    def create(mounts):
+        if isinstance(mounts, MountInventory):
+            return mounts
+        return MountInventory(mounts)
+
+
 def extract_version(ver):
     str = ""
     for a in trim(ver):
@@ -761,6 +1192,26 @@ class ShareConfig(ConfigEditor):
             return self.get_val("certificate_duration_seconds", False)
         return None
 
+    def is_enabled(self, name):
+        if self.read():
+            val = self.get_val(name)
+            return val is not None and val.lower() in ["true", "yes", "1"]
+        return False
+
+    def get_int(self, name, default):
+        if self.read():
+            val = self.get_val(name)
+            if val is not None and val.isdigit():
+                return int(val)
+        return default
+
+    def get_str(self, name, default):
+        if self.read():
+            val = self.get_val(name)
+            if not is_empty(val):
+                return val
+        return default
+
     def load_regions(self):
         regions = self.get_region()
         if regions:
@@ -6,18 +6,39 @@
 
 
 import glob
+import hashlib
+import ipaddress
 import os
+import re
 import shutil
+import socket
+from collections import OrderedDict
 from datetime import datetime
 from common import *
+import crypto_profile
+import vici
 
 
 class IpsecConfigBase(MountHelperBase):
     CLEANUP_FILE_MIN_AGE_MINS = 60
+    CONNECTION_PREFIX = "ibmshare-ipsec-to-"
     VERSION = None
+    # share.conf udp_encap value: yes - always, auto - only if NAT is detected
+    ENCAP_MODES = ["yes", "auto"]
+    ENCAP_DEFAULT = "yes"
+    # rekeys are spread by a fixed per connection offset below the rekey
+    # time and charon's random rand_time on top
+    MACHINE_ID_FILE = "/etc/machine-id"
+    REKEY_TIME_SECS = 3600
+    REKEY_SPREAD_SECS = 600
+    REKEY_RAND_SECS = 300
 
     def __init__(self):
         self.is_reload = False
+        self.is_full_reload = False
+        self.conn_changes = {}  # ip: load(True)/unload(False)
+        self.crypto = None
+        self.subnets = None
 
     def private_key_filename(self):
         name = "type_ibmshare.key"
@@ -67,29 +88,163 @@ class IpsecConfigBase(MountHelperBase):
     def get_config_file_parts(self):
         return self.IPSEC_CONFIG_PATH, "type_ibmshare_", ".conf"
 
+    # the config key of ip - a server config written before its subnet
+    # was set keeps its own file and connection
+    def file_key(self, ip):
+        if self.FileExists(self.get_config_template_file(ip)):
+            return ip
+        return self.config_key(ip)
+
     def get_config(self, ip):
-        fname = self.get_config_template_file(ip)
+        fname = self.get_config_template_file(self.file_key(ip))
         return fname if self.FileExists(fname) else None
 
-    def remove_config(self, ip):
-        fname = self.get_config(ip)
-        if fname:
+    # shared: the subnet config goes too, no server of it is mounted
+    def remove_config(self, ip, shared=False):
+        key = self.file_key(ip)
+        if key != ip and not shared:
+            self.LogDebug("Subnet config shared, kept for: " + ip)
+            return
+        fname = self.get_config_template_file(key)
+        if self.FileExists(fname):
             self.LogDebug("Removing unused config file: "+fname)
             self.RemoveFile(fname)
-            self.is_reload = True
+            self.set_conn_changed(key, False)
+
+    # share.conf ipsec_subnets=<cidr>,... - one connection per subnet
+    def get_subnets(self):
+        if self.subnets is None:
+            self.subnets = []
+            share_conf = ShareConfig(None, show_error=False)
+            for val in share_conf.get_str("ipsec_subnets", "").split(","):
+                if len(val) == 0:
+                    continue
+                try:
+                    self.subnets.append(ipaddress.ip_network(val, strict=False))
+                except ValueError:
+                    self.LogError("Invalid ipsec_subnets entry: " + val)
+        return self.subnets
+
+    @staticmethod
+    def key_network(key):
+        if "_" not in key:
+            return None
+        return ipaddress.ip_network(key.replace("_", "/"))
+
+    # the ip or <network>_<prefix> of its subnet, names the config file and connection
+    def config_key(self, ip):
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return ip
+        for net in self.get_subnets():
+            if addr in net:
+                return "%s_%d" % (net.network_address, net.prefixlen)
+        return ip
+
+    # a server of the connection is in ips
+    def is_key_in_use(self, key, ips):
+        net = IpsecConfigBase.key_network(key)
+        if net is None:
+            return key in ips
+        for ip in ips:
+            try:
+                if ipaddress.ip_address(ip) in net:
+                    return True
+            except ValueError:
+                pass
+        return False
 
     def connection_name(self, ip):
-        return "ibmshare-ipsec-to-" + ip.replace(".", "-")
+        return self.key_connection_name(self.config_key(ip))
+
+    def key_connection_name(self, key):
+        return self.CONNECTION_PREFIX + key.replace(".", "-").replace("_", "-")
+
+    def set_conn_changed(self, key, load=True):
+        self.conn_changes[key] = load
+        self.is_reload = True
+
+    # all the connections are already loaded in the ipsec daemon
+    def is_connection_loaded(self, ips):
+        names = self.get_loaded_connections()
+        if names is None:
+            return False
+        for ip in ips:
+            if self.connection_name(ip) not in names:
+                return False
+        return True
+
+    # configs unchanged - load the ones charon lost eg after a restart,
+    # the key and certs went with them so everything is loaded
+    def load_missing_connections(self, ips):
+        ips = [ip for ip in ips if self.config_key(ip) not in self.conn_changes]
+        if len(ips) > 0 and not self.is_connection_loaded(ips):
+            for ip in ips:
+                self.set_conn_changed(self.config_key(ip))
+            self.is_full_reload = True
+
+    def get_crypto_settings(self):
+        if self.crypto is None:
+            self.crypto = crypto_profile.CryptoProfile().get_settings()
+        return self.crypto
+
+    # udp_encap=yes|auto, udp_encap_hosts=<ip>:<mode>,... for single servers
+    def is_encap(self, ip):
+        share_conf = ShareConfig(None, show_error=False)
+        mode = share_conf.get_str("udp_encap", self.ENCAP_DEFAULT)
+        for host in share_conf.get_str("udp_encap_hosts", "").split(","):
+            if host.startswith(ip + ":"):
+                mode = host[len(ip) + 1:]
+        mode = mode.lower()
+        if mode not in self.ENCAP_MODES:
+            self.LogError("Invalid udp_encap: %s, using: %s" % (mode, self.ENCAP_DEFAULT))
+            mode = self.ENCAP_DEFAULT
+        return mode == "yes"
+
+    # same offset each run so the config file is unchanged, differs per host
+    def rekey_offset(self, name):
+        host = self.ReadFile(self.MACHINE_ID_FILE, log=False) or socket.gethostname()
+        digest = hashlib.sha1(("%s:%s" % (host.strip(), name)).encode()).digest()
+        return int.from_bytes(digest[:4], "big") % self.REKEY_SPREAD_SECS
+
+    # share.conf rekey_bytes=<bytes> adds a volume limit to the child SA
+    def get_rekey_bytes(self):
+        return ShareConfig(None, show_error=False).get_int("rekey_bytes", 0)
+
+    # optional child settings, one per line
+    def get_child_options(self, crypto, rekey_bytes=0):
+        options = []
+        if rekey_bytes > 0:
+            options.append("rand_bytes = %d" % (rekey_bytes // 10))
+        if crypto.replay_window:
+            options.append("replay_window = %d" % crypto.replay_window)
+        if crypto.hw_offload:
+            options.append("hw_offload = auto")
+        return options
 
     def create_config(self, ip):
         tags = {}
+        crypto = self.get_crypto_settings()
+        key = self.config_key(ip)
+        net = IpsecConfigBase.key_network(key)
 
-        tags["REMOTE_IP"] = ip
-        tags["CONNECTION_NAME"] = self.connection_name(ip)
+        tags["REMOTE_IP"] = str(net) if net else ip
+        tags["CONNECTION_NAME"] = self.connection_name(key)
         tags["CLIENT_CERT_FILE"] = self.cert_filename()
+        tags["ESP_PROPOSALS"] = ",".join(crypto.esp_proposals)
+        tags["IKE_PROPOSALS"] = ",".join(crypto.ike_proposals)
+        tags["ENCAP"] = "yes" if self.is_encap(key) else "no"
+        name = tags["CONNECTION_NAME"]
+        rekey_bytes = self.get_rekey_bytes()
+        tags["IKE_REKEY_TIME"] = str(self.REKEY_TIME_SECS - self.rekey_offset(name + ":ike"))
+        tags["CHILD_REKEY_TIME"] = str(self.REKEY_TIME_SECS - self.rekey_offset(name + ":child"))
+        tags["REKEY_RAND_TIME"] = str(self.REKEY_RAND_SECS)
+        tags["REKEY_BYTES"] = str(rekey_bytes)
+        line_tags = {"CHILD_OPTIONS": self.get_child_options(crypto, rekey_bytes)}
 
         vdata = "# %s - Version %s\n" % (self.NAME, self.VERSION)
-        cfg_path = self.get_config_template_file(ip)
+        cfg_path = self.get_config_template_file(key)
         cfg_data = vdata + self.get_config_template_text()
 
         for name, value in tags.items():
@@ -97,6 +252,12 @@ class IpsecConfigBase(MountHelperBase):
             # assert cfg_data.find(tag) >= 0
             cfg_data = cfg_data.replace(tag, value)
 
+        # tag on its own line - repeat the indent for each value, none drops the line
+        for name, values in line_tags.items():
+            cfg_data = re.sub(r"\n( *)<%s>" % name,
+                              lambda m: "".join("\n" + m.group(1) + val for val in values),
+                              cfg_data)
+
         try:
             # if file exists and data the same
             # update the file modify time so it doesnt get deleted
@@ -109,7 +270,7 @@ class IpsecConfigBase(MountHelperBase):
 
             if self.WriteFile(cfg_path, cfg_data, mkdir=True):
                 self.LogDebug("Config file created ok:" + cfg_path)
-                self.is_reload = True
+                self.set_conn_changed(key)
                 return True
         except Exception as ex:
             self.LogException("CreateConfig"+self.NAME, ex)
@@ -119,7 +280,13 @@ class IpsecConfigBase(MountHelperBase):
     def cleanup_unused_configs(self, mounts,
                                age=None):
         if mounts is None:
-            mounts = NfsMount().load_nfs_mounts()
+            # read again, a retry in the same run must see the mounts gone
+            mounts = MountInventory.load(refresh=True)
+            if mounts is None:
+                self.LogDebug("%s cleanup skipped - mounts unknown" % self.NAME)
+                return True
+        else:
+            mounts = MountInventory.create(mounts)
 
         cfg_path, cfg_prefix, cfg_postfix = self.get_config_file_parts()
 
@@ -147,17 +314,13 @@ class IpsecConfigBase(MountHelperBase):
         files = []
         if os.path.exists(cfg_path):
             files = os.listdir(cfg_path)
+        mounted_ips = mounts.get_ips()
         for file in files:
             inc_cnt(0)
             file_ip = get_filename_ip(file)
             if not file_ip:
                 continue
-            got = False
-            for mount in mounts:
-                if mount.ip == file_ip:
-                    got = True
-                    break
-            if got:
+            if self.is_key_in_use(file_ip, mounted_ips):
                 inc_cnt(1)
             else:
                 fname = make_filename(cfg_path, file)
@@ -177,21 +340,34 @@ class IpsecConfigBase(MountHelperBase):
         hasActiveMounts = cnts[1] != 0 or cnts[3] != 0
         return hasActiveMounts
 
-    def _reload_certs(self, args):
+    def _reload_certs(self, args, vici_func=None):
         if self.is_reload:
-            if not self.IpsecCmd(args, "ReloadCerts"):
+            if not self.IpsecCmd(args, "ReloadCerts", vici_func):
                 return False
             self.is_reload = False
         return True
 
-    def _reload_config(self, args):
+    def _reload_config(self, args, vici_func=None):
         if self.is_reload:
-            if not self.IpsecCmd(args, "ReloadConfig"):
+            if not self.IpsecCmd(args, "ReloadConfig", vici_func):
                 return False
             self.is_reload = False
+            self.is_full_reload = False
+            self.conn_changes = {}
         return True
 
-    def IpsecCmd(self, args, descr=""):
+    # no control socket - the command line tool is used
+    def vici_session(self):
+        return None
+
+    def IpsecCmd(self, args, descr="", vici_func=None):
+        if vici_func:
+            session = self.vici_session()
+            if session:
+                with session:
+                    if vici_func(session):
+                        return True
+                return SysApp.set_code(SysApp.ERR_IPSEC_CFG)
         cmd = self.EXE_PATH + " " + args
         if not self.RunCmd(cmd, descr):
             return SysApp.set_code(SysApp.ERR_IPSEC_CFG)
@@ -211,6 +387,7 @@ class IpsecConfigBase(MountHelperBase):
         self.KEY_FILE_PATH = path
         self.CERT_PATH = path
         self.IPSEC_CONFIG_PATH = path
+        self.SETTINGS_PATH = path
         return True
 
     def remove_all_certs(self,root=False):
@@ -231,7 +408,12 @@ class IpsecConfigBase(MountHelperBase):
         else:
             if not self.WriteFile(fname, data, mkdir=True):
                 return False
+            # results cached for the old file content
+            for kind in ["x509", "pkey"]:
+                StateCache.get().remove(StateCache.file_key(kind, fname))
+            # the connections hold the cert data - reload them all
             self.is_reload = True
+            self.is_full_reload = True
         return True
 
     def write_new_certs(self, cert, private_key, cert_int_ca):
@@ -247,7 +429,12 @@ class IpsecConfigBase(MountHelperBase):
         return ret
 
     def set_version(self):
-        self.VERSION = get_app_version(self.EXE_PATH, self.VERSION_TAG)
+        key = "version:" + self.EXE_PATH
+        self.VERSION = StateCache.get().lookup(key, self.EXE_PATH)
+        if not self.VERSION:
+            self.VERSION = get_app_version(self.EXE_PATH, self.VERSION_TAG)
+            if self.VERSION:
+                StateCache.get().store(key, self.EXE_PATH, self.VERSION)
         if self.VERSION:
             self.LogInfo("IpSec using %s(%s)" % (self.NAME, self.VERSION))
         return self.VERSION
@@ -261,6 +448,23 @@ class StrongSwanConfig(IpsecConfigBase):
             path = "/etc/strongswan/swanctl"
         return path
 
+    def settings_path():
+        path = "/etc/strongswan.d"
+        if not os.path.exists(path):
+            path = "/etc/strongswan/strongswan.d"
+        return path
+
+    # recreated each time charon starts
+    def charon_socket():
+        paths = ["/var/run/charon.vici", "/run/strongswan/charon.vici"]
+        if not os.path.exists("/etc/swanctl"):
+            # on some installs eg (Rocky)
+            paths.reverse()
+        for path in paths:
+            if os.path.exists(path):
+                return path
+        return paths[0]
+
     NAME = "StrongSwan"
     VERSION_TAG = "swanctl"
     EXE_PATH = "/usr/sbin/swanctl"
@@ -270,25 +474,48 @@ class StrongSwanConfig(IpsecConfigBase):
     KEY_FILE_PATH = CONFIG_PATH + '/private'
     CERT_PATH = CONFIG_PATH + '/x509'
     IPSEC_CONFIG_PATH = CONFIG_PATH + '/conf.d'
+    SETTINGS_PATH = settings_path()
+    CHARON_TUNING_FILE = "ibmshare_charon.conf"
+    # charon is sized for this many connections, doubled as they grow
+    TUNING_MIN_CONNECTIONS = 16
+    TUNING_MAX_THREADS = 64
+    TUNING_MAX_TABLE_SIZE = 4096
+    CHARON_TUNING_TEXT = """charon {
+    # sized for <CONNECTIONS> connections and <CPUS> cpus
+    threads = <THREADS>
+    ikesa_table_size = <TABLE_SIZE>
+    ikesa_table_segments = <TABLE_SEGMENTS>
+    # new SA is up before the old one is deleted on reauth
+    make_before_break = yes
+    retransmit_timeout = 2.0
+    retransmit_jitter = 20
+}
+"""
+    CHARON_SOCKET = charon_socket()
+    START_POLL_MIN_SECS = 0.01
+    START_POLL_MAX_SECS = 0.5
     IPSEC_CONFIG_TEXT = """connections {
     <CONNECTION_NAME> {
         children {
             <CONNECTION_NAME> {
-                esp_proposals = aes256gcm16
+                esp_proposals = <ESP_PROPOSALS>
                 mode = transport
                 start_action = trap
                 remote_ts = <REMOTE_IP>[any/any]
                 local_ts = 0.0.0.0/0[any/any]
-                rekey_time = 3600
-                rekey_bytes = 0
+                rekey_time = <CHILD_REKEY_TIME>
+                rand_time = <REKEY_RAND_TIME>
+                rekey_bytes = <REKEY_BYTES>
+                <CHILD_OPTIONS>
             }
         }
         keyingtries = 3
         version = 2
         remote_addrs = <REMOTE_IP>
-        rekey_time = 3600
-        encap = yes
-        proposals = aes256-sha384-ecp384
+        rekey_time = <IKE_REKEY_TIME>
+        rand_time = <REKEY_RAND_TIME>
+        encap = <ENCAP>
+        proposals = <IKE_PROPOSALS>
         local {
             certs = <CLIENT_CERT_FILE>
         }
@@ -308,33 +535,207 @@ class StrongSwanConfig(IpsecConfigBase):
 
         return False
 
+    def vici_session(self):
+        if not os.path.exists(self.CHARON_SOCKET):
+            return None
+        session = vici.ViciSession(self.CHARON_SOCKET)
+        return session if session.connect() else None
+
+    # bring up the IKE SA now rather than on the first nfs packet
+    def connect(self, ip, timeout_ms=0):
+        if self.config_key(ip) != ip:
+            self.LogDebug("Subnet connection, IKE SA started by the first packet: " + ip)
+            return False
+        session = self.vici_session()
+        if not session:
+            return False
+        name = self.connection_name(ip)
+        with session:
+            for sa in session.list_sas(name) or []:
+                if sa.get(name, {}).get("state") == "ESTABLISHED":
+                    return True
+            self.LogDebug("Initiating IKE SA: " + name)
+            return session.initiate(name, name, timeout_ms)
+
+    def vici_ping(self, session):
+        return session.version() is not None
+
+    # the certs and key this helper installs
+    def vici_load_creds(self, session):
+        certs = [(self.cert_filename(), False), (self.int_ca_filename(), True)]
+        certs += [(fname, True) for fname in self.root_cert_filenames()]
+        for fname, is_ca in certs:
+            if self.FileExists(fname):
+                if not session.load_cert(vici.SwanctlConf.read_data(fname), is_ca):
+                    return False
+        fname = self.private_key_filename()
+        if self.FileExists(fname):
+            return session.load_key(vici.SwanctlConf.read_data(fname))
+        return True
+
+    # load the helper config files and unload the connections removed
+    def vici_load_conns(self, session):
+        path, prefix, postfix = self.get_config_file_parts()
+        conns = OrderedDict()
+        for fname in sorted(get_files_in_folder(path, prefix + "*" + postfix)):
+            loaded = vici.SwanctlConf().load_connections(fname)
+            if loaded is None:
+                return False
+            conns.update(loaded)
+        for name, conn in conns.items():
+            if not session.load_conn(name, conn):
+                return False
+        current = session.get_conns()
+        if current is None:
+            return False
+        for name in current:
+            if name.startswith(self.CONNECTION_PREFIX) and name not in conns:
+                if not session.unload_conn(name):
+                    return False
+        return True
+
+    # load or unload just the connections that changed
+    def vici_load_changes(self, session):
+        loaded = None
+        for key, load in sorted(self.conn_changes.items()):
+            if load:
+                fname = self.get_config_template_file(key)
+                conns = vici.SwanctlConf().load_connections(fname)
+                if conns is None:
+                    return False
+                for name, conn in conns.items():
+                    if not session.load_conn(name, conn):
+                        return False
+                continue
+            if loaded is None:
+                loaded = session.get_conns()
+                if loaded is None:
+                    return False
+            name = self.key_connection_name(key)
+            if name in loaded and not session.unload_conn(name):
+                return False
+        return True
+
+    def vici_load_all(self, session):
+        if not self.is_full_reload and len(self.conn_changes) > 0:
+            return self.vici_load_changes(session)
+        return self.vici_load_creds(session) and self.vici_load_conns(session)
+
     def reload_certs(self, root=False):
-        return self._reload_certs("--load-creds")
+        return self._reload_certs("--load-creds", self.vici_load_creds)
 
     def reload_config(self):
-        return self._reload_config("--load-all")
+        is_reload = self.is_reload
+        if not self._reload_config("--load-all", self.vici_load_all):
+            return False
+        # resized as the connections change, the file is the same up to
+        # TUNING_MIN_CONNECTIONS so it is then left alone
+        if is_reload:
+            self.write_charon_tuning(reload=True)
+        return True
 
     def list_connections(self):
-        return self.IpsecCmd("--list-conns")
+        return self.IpsecCmd("--list-conns", vici_func=self.vici_ping)
+
+    # connection names start the line: "<name>: IKEv2, ..."
+    def get_loaded_connections(self):
+        session = self.vici_session()
+        if session:
+            with session:
+                names = session.get_conns()
+            return set(names) if names is not None else None
+        out = self.RunCmd(self.EXE_PATH + " --list-conns", "ListConns")
+        if not out:
+            return None
+        names = set()
+        for line in out.stdout.splitlines():
+            if line and not line[0].isspace() and ":" in line:
+                names.add(line.split(":")[0])
+        return names
+
+    def charon_tuning_filename(self):
+        return make_filename(self.SETTINGS_PATH, self.CHARON_TUNING_FILE)
+
+    def count_connections(self):
+        path, prefix, postfix = self.get_config_file_parts()
+        return len(get_files_in_folder(path, prefix + "*" + postfix))
+
+    @staticmethod
+    def power_of_two(val):
+        out = 1
+        while out < val:
+            out *= 2
+        return out
+
+    def charon_tuning_text(self, conns, cpus):
+        conns = StrongSwanConfig.power_of_two(max(conns, self.TUNING_MIN_CONNECTIONS))
+        table_size = min(StrongSwanConfig.power_of_two(conns * 2), self.TUNING_MAX_TABLE_SIZE)
+        tags = {}
+        tags["CONNECTIONS"] = str(conns)
+        tags["CPUS"] = str(cpus)
+        tags["THREADS"] = str(min(16 + 2 * cpus + conns // 8, self.TUNING_MAX_THREADS))
+        tags["TABLE_SIZE"] = str(table_size)
+        tags["TABLE_SEGMENTS"] = str(min(StrongSwanConfig.power_of_two(cpus), table_size))
+        data = self.CHARON_TUNING_TEXT
+        for name, value in tags.items():
+            data = data.replace("<" + name + ">", value)
+        return data
+
+    def vici_reload_settings(self, session):
+        return session.reload_settings()
+
+    # strongswan.d drop-in, charon reads it when it starts - a reload applies
+    # the retransmit and make before break settings, not threads or table sizes
+    def write_charon_tuning(self, reload=False):
+        if not os.path.exists(self.SETTINGS_PATH):
+            return False
+        fname = self.charon_tuning_filename()
+        data = self.charon_tuning_text(self.count_connections(), os.cpu_count() or 1)
+        if self.FileNoChange(fname, data):
+            return False
+        if not self.WriteFile(fname, data):
+            return False
+        self.LogInfo("Charon settings updated, sizes used when strongswan restarts: " + fname)
+        if reload:
+            self.IpsecCmd("--reload-settings", "ReloadSettings", self.vici_reload_settings)
+        return True
+
+    def remove_all_configs(self, unused=False):
+        if not unused:
+            self.RemoveFile(self.charon_tuning_filename())
+        return super().remove_all_configs(unused)
 
     def setup(self):
+        self.write_charon_tuning()
         return self.start()
 
+    # start pings charon first, a stale socket after a crash restarts it
     def is_running(self):
         return self.start()
 
+    # charon answers a vici ping - no fork when it is already up, swanctl
+    # is asked when the socket is not found eg a custom vici socket setting
+    def is_ready(self):
+        session = self.vici_session()
+        if session:
+            with session:
+                return self.vici_ping(session)
+        return self.list_connections()
+
     def start(self, max_secs=10):
+        if self.is_ready():
+            return True
         ss = SystemCtl("strongswan")
-        secs = 0
-        while secs <= max_secs:
-            if not ss.is_active():
-                self.LogInfo("Starting Strongswan Ipsec")
-                if not ss.enable():
-                    return False
-                time.sleep(1)
-            # just to verify that swanctl is running ok
-            if self.list_connections():
-                return True
-            self.wait(2, "Ipsec starting")
-            secs += 2
-        return self.LogError("Unable to start IPsec, check charon logs")
+        if not ss.is_active():
+            self.LogInfo("Starting Strongswan Ipsec")
+            if not ss.enable():
+                return False
+        # poll for the vici socket with a short backoff
+        end_at = time.time() + max_secs
+        delay = self.START_POLL_MIN_SECS
+        while not self.is_ready():
+            if time.time() >= end_at:
+                return self.LogError("Unable to start IPsec, check charon logs")
+            time.sleep(min(delay, max(0, end_at - time.time())))
+            delay = min(delay * 2, self.START_POLL_MAX_SECS)
+        return True
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+
+from collections import namedtuple
+from common import *
+
+
+CryptoSettings = namedtuple("CryptoSettings", ["name", "esp_proposals", "ike_proposals",
+                                               "replay_window", "hw_offload"])
+
+
+# ESP/IKE settings of the ipsec connections, selected in share.conf with
+# crypto_profile=<name>, "auto" picks one from the cpu capabilities.
+class CryptoProfile(MountHelperBase):
+    CPUINFO_FILE = "/proc/cpuinfo"
+    OPENSSL_EXE = "openssl"
+    # proposals the file share service accepts
+    SERVICE_ESP_PROPOSALS = ["aes256gcm16", "aes128gcm16"]
+    SERVICE_IKE_PROPOSALS = ["aes256-sha384-ecp384"]
+    DEFAULT = "default"
+    AUTO = "auto"
+    # aes-256-gcm faster than this (1000s of bytes/sec) is not the bottleneck
+    BENCH_MIN_KBPS = 1000000
+    BENCH_SECS = 1
+    # multi queue nics reorder more packets than the 32 default allows
+    REPLAY_WINDOW = 1024
+    PROFILES = {
+        DEFAULT: CryptoSettings(DEFAULT, ["aes256gcm16"], ["aes256-sha384-ecp384"], None, False),
+        "aes128": CryptoSettings("aes128", ["aes128gcm16", "aes256gcm16"],
+                                 ["aes256-sha384-ecp384"], REPLAY_WINDOW, True),
+        "aes256": CryptoSettings("aes256", ["aes256gcm16"],
+                                 ["aes256-sha384-ecp384"], REPLAY_WINDOW, True),
+    }
+
+    def cpu_flags(self):
+        data = self.ReadFile(self.CPUINFO_FILE, log=False) or ""
+        for line in data.splitlines():
+            # x86 flags, arm Features
+            if ":" in line and line.split(":")[0].strip() in ["flags", "Features"]:
+                return set(line.split(":", 1)[1].split())
+        return set()
+
+    # aes-256-gcm throughput in 1000s of bytes/sec, cached for the boot
+    def benchmark(self):
+        key = "crypto:aes-256-gcm"
+        cache = StateCache.get()
+        val = cache.lookup(key, self.CPUINFO_FILE)
+        if val is None:
+            out = self.RunSilent([self.OPENSSL_EXE, "speed", "-evp", "aes-256-gcm",
+                                  "-seconds", str(self.BENCH_SECS), "-bytes", "16384"])
+            if out.is_error():
+                self.LogDebug("Crypto benchmark failed: " + out.stderr)
+                return None
+            lines = out.stdout.strip().splitlines()
+            val = lines[-1].split()[-1].rstrip("k") if len(lines) > 0 else ""
+            cache.store(key, self.CPUINFO_FILE, val)
+        try:
+            return float(val)
+        except ValueError:
+            return None
+
+    def auto_profile(self):
+        flags = self.cpu_flags()
+        if "vaes" in flags:
+            # vector aes makes the 256 bit key nearly free
+            return "aes256"
+        if "aes" not in flags:
+            return "aes128"
+        kbps = self.benchmark()
+        self.LogDebug("Crypto benchmark aes-256-gcm: %s kB/s" % kbps)
+        if kbps is not None and kbps >= self.BENCH_MIN_KBPS:
+            return "aes256"
+        return "aes128"
+
+    def get_settings(self, name=None):
+        if name is None:
+            name = ShareConfig(None, show_error=False).get_str("crypto_profile", self.DEFAULT)
+        name = name.lower()
+        if name == self.AUTO:
+            name = self.auto_profile()
+        settings = self.PROFILES.get(name)
+        if settings is None:
+            self.LogError("Crypto profile unknown: %s, using: %s" % (name, self.DEFAULT))
+            return self.PROFILES[self.DEFAULT]
+        esp = [val for val in settings.esp_proposals if val in self.SERVICE_ESP_PROPOSALS]
+        ike = [val for val in settings.ike_proposals if val in self.SERVICE_IKE_PROPOSALS]
+        if len(esp) == 0 or len(ike) == 0:
+            self.LogError("Crypto profile not accepted by the service: " + name)
+            return self.PROFILES[self.DEFAULT]
+        self.LogDebug("Crypto profile: " + name)
+        return settings._replace(esp_proposals=esp, ike_proposals=ike)
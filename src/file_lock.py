@@ -7,19 +7,48 @@
 
 from common import *
 import fcntl
+import glob
 import os
 
 
 class LockHandler(MountHelperBase):
+    IP_LOCK_FILE = '/var/lock/ibm_mount_helper_ip_%s.lck'
 
+    # host wide lock - certs and charon reload
     @staticmethod
     def mount_share_lock():
         return LockHandler('/var/lock/ibm_mount_helper.lck')
 
+    # per nfs server lock - config file and mount
+    # always taken before the host wide lock
+    @staticmethod
+    def mount_ip_lock(ip):
+        return LockHandler(LockHandler.IP_LOCK_FILE % ip)
+
+    # servers with a lock file, a mount to them may be in progress
+    @staticmethod
+    def mount_ip_lock_ips():
+        prefix, postfix = LockHandler.IP_LOCK_FILE.split("%s")
+        return [fname[len(prefix):-len(postfix)]
+                for fname in glob.glob(LockHandler.IP_LOCK_FILE % "*")]
+
+    @staticmethod
+    def is_mount_in_progress():
+        if LockHandler.mount_share_lock().is_locked():
+            return True
+        for fname in glob.glob(LockHandler.IP_LOCK_FILE % "*"):
+            if LockHandler(fname).is_locked():
+                return True
+        return False
+
     @staticmethod
     def renew_cert_lock():
         return LockHandler('/var/lock/ibm_mount_helper_renew.lck')
 
+    @staticmethod
+    def sa_metrics_lock():
+        return LockHandler('/var/lock/ibm_mount_helper_metrics.lck')
+
     def __init__(self, lock_file):
         self.lock_file = lock_file
         self.lock_fd = -1
@@ -54,6 +83,17 @@ class LockHandler(MountHelperBase):
         self.LogError("Failed to get lock")
         return False
 
+    # non blocking and quiet - another process holding it is expected
+    def try_lock(self):
+        try:
+            self._lock(False)
+            return True
+        except Exception:
+            if self.lock_fd >= 0:
+                os.close(self.lock_fd)
+                self.lock_fd = -1
+        return False
+
     # check if file is already locked
     def is_locked(self):
         try:
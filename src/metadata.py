@@ -6,7 +6,7 @@
 
 
 from common import *
-from certificate_handler import CertificateHandler
+from certificate_handler import CertificateHandler, KeyPool
 import json
 import socket
 import ssl
@@ -26,6 +26,8 @@ META_FLAVOUR = "ibm"
 META_TIMEOUT = 20
 META_CERTIFICATE_DURATION_MIN = 300
 META_CERTIFICATE_DURATION_MAX = 3600
+# http status of a signing request the service does not accept
+META_CSR_REJECTED = [400, 422]
 
 
 class JsonRequest(MountHelperBase):
@@ -40,6 +42,7 @@ class JsonRequest(MountHelperBase):
         self.data = None
         self.response = {}
         self.timeout = timeout
+        self.status = None
 
     def set_data(self, data):
         self.data = data
@@ -94,6 +97,7 @@ class JsonRequest(MountHelperBase):
         except socket.timeout:
             self.log_user_error("Request Timeout Error", "Socket Timeout")
         except HTTPError as errh:
+            self.status = errh.code
             msg = "Problem accessing (%s) - Status:%d Reason:%s Headers(%s)" % \
                 (url, errh.code, errh.reason, errh.headers)
             self.log_user_error("Http Error", msg)
@@ -146,6 +150,7 @@ class Metadata(CertificateHandler):
         self.created_at = None
         self.expires_at = None
         self.port = None
+        self.csr_rejected = False
 
     def is_metadata_service_available(self):
         if self.is_port_available(META_IP, META_PORT_HTTP):
@@ -204,6 +209,7 @@ class Metadata(CertificateHandler):
         req = self.new_request(META_URL_CERT, self.token)
         req.set_data('{"csr": "' + self.csr + '", "expires_in": ' + expires_in + '}')
         if not req.post():
+            self.csr_rejected = req.status in META_CSR_REJECTED
             return False
 
         def get_cert(cert):
@@ -221,8 +227,8 @@ class Metadata(CertificateHandler):
 
         return True
 
-    def set_private_key(self, data):
-        if self.load_private_key(data):
+    def set_private_key(self, data, fpath=None):
+        if self.load_private_key(data, fpath):
             self.private_key = data
             return True
         else:
@@ -230,7 +236,12 @@ class Metadata(CertificateHandler):
         return False
 
     def new_private_key(self):
-        private_key = self.generate_private_key()
+        algorithm = self.key_algorithm()
+        private_key = KeyPool().take()
+        if (private_key and self.private_key_algorithm(private_key) == algorithm
+                and self.set_private_key(private_key)):
+            return True
+        private_key = self.generate_private_key(algorithm)
         return self.set_private_key(private_key)
 
     def new_certificate_signing_request(self):
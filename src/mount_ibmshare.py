@@ -6,17 +6,60 @@
 
 
 from args_handler import ArgsHandler
+from certificate_handler import KeyPool
 from common import *
 import file_lock
+import threading
+import mount_watcher
+import path_mtu
+import sa_metrics
 import timer_handler
 from renew_certs import RenewCerts
 from config import LocalInstall, StrongSwanConfig
 
 
+class MountAllService(SystemCtl):
+    SERVICE_FILE = '/etc/systemd/system/mount_helper_mount_all.service'
+
+    # mount the fstab shares before remote-fs-pre.target, the fstab
+    # mount units start after it and find them already mounted
+    SERVICE_CONFIG = """[Unit]
+Description=Mount helper ibmshare fstab mounts
+Wants=network-online.target remote-fs-pre.target
+After=network-online.target strongswan.service
+Before=remote-fs-pre.target
+[Service]
+Type=oneshot
+RemainAfterExit=yes
+ExecStart=%s
+[Install]
+WantedBy=remote-fs.target
+"""
+
+    def __init__(self):
+        super().__init__('mount_helper_mount_all.service')
+
+    def install(self, command_path):
+        data = MountAllService.SERVICE_CONFIG % (command_path)
+        self.WriteFile(MountAllService.SERVICE_FILE, data, chmod=0o744)
+        return self.action("enable")
+
+    def teardown(self):
+        if self.FileExists(MountAllService.SERVICE_FILE):
+            self.action("disable")
+        self.RemoveFile(MountAllService.SERVICE_FILE)
+
+
 class MountIbmshare(MountHelperBase):
+    MAX_MOUNT_WORKERS = 8
+    PRECONNECT_WAIT_SECS = 5
+
     def __init__(self):
         self.mounts = []
         self.lockhandler = file_lock.LockHandler.mount_share_lock()
+        self.ip_locks = []
+        self.preconnects = []
+        self.preconnect_wait = self.PRECONNECT_WAIT_SECS
 
     def set_installed_ipsec(self):
         ss_obj = StrongSwanConfig()
@@ -36,7 +79,10 @@ class MountIbmshare(MountHelperBase):
                 ipsec.remove_all_configs(unused=True)
                 if ipsec.setup():
                     cert_path = SysApp.argv(2)
-                    return RenewCerts().install_root_cert(cert_path)
+                    if RenewCerts().install_root_cert(cert_path):
+                        # ready for the first mount
+                        KeyPool().fill()
+                        return self.setup_watcher() and self.setup_mount_all()
         self.LogError("Installation failed.", code=SysApp.ERR_APP_INSTALL)
         return False
 
@@ -48,9 +94,64 @@ class MountIbmshare(MountHelperBase):
             ipsec.remove_all_configs()
         LocalInstall.teardown()
         timer_handler.TimerHandler().teardown()
+        mount_watcher.MountWatcherService().teardown()
+        MountAllService().teardown()
         self.LogDebug("TearDown complete")
         return True
 
+    # optional service to remove ipsec configs once unmounted
+    def setup_watcher(self):
+        if ShareConfig(None).is_enabled("watch_mounts"):
+            self.LogInfo("Installing nfs unmount watcher")
+            return mount_watcher.MountWatcherService().install(
+                ArgsHandler().get_watch_mounts_cmd_line())
+        return True
+
+    # optional boot service to mount all the fstab shares in one run
+    def setup_mount_all(self):
+        if ShareConfig(None).is_enabled("mount_all_at_boot"):
+            self.LogInfo("Installing fstab mount service")
+            return MountAllService().install(
+                ArgsHandler().get_mount_all_cmd_line())
+        return True
+
+    def watch_mounts(self):
+        ipsec = self.get_ipsec_mgr()
+        if not ipsec:
+            return False
+        # SA events are counted while the mounts are watched
+        metrics = sa_metrics.SaMetrics(ipsec.CONNECTION_PREFIX)
+        thread = threading.Thread(target=metrics.listen, args=[ipsec.CHARON_SOCKET])
+        thread.daemon = True
+        thread.start()
+        return mount_watcher.MountWatcher(ipsec).watch()
+
+    def sa_status(self):
+        ipsec = self.get_ipsec_mgr()
+        if not ipsec:
+            return self.LogError("IPsec is not installed.")
+        session = ipsec.vici_session()
+        if not session:
+            return self.LogError("IPsec is not running.", code=SysApp.ERR_IPSEC_CFG)
+        metrics = sa_metrics.SaMetrics(ipsec.CONNECTION_PREFIX)
+        with session:
+            conns = metrics.poll(session)
+        if conns is None:
+            return SysApp.set_code(SysApp.ERR_IPSEC_CFG)
+        return metrics.show(conns)
+
+    # mount.ibmshare -MTU_CHECK <nfs_host>
+    def mtu_check(self, host):
+        ipsec = self.get_ipsec_mgr()
+        if not ipsec:
+            return self.LogError("IPsec is not installed.")
+        if not host:
+            return self.LogError("Provide the nfs host to check.")
+        ip = HostResolver.get().resolve(host)
+        if not ip:
+            return self.LogError("Could not resolve host: " + host)
+        return path_mtu.PathMtu().show(ip, ipsec.is_encap(ip))
+
     def renew_certs(self):
         return RenewCerts().renew_cert_cmd_line()
 
@@ -60,66 +161,248 @@ class MountIbmshare(MountHelperBase):
     def unlock(self):
         return self.lockhandler.release_lock()
 
+    # server locks are taken in order so batches can't deadlock
+    def lock_servers(self, ips):
+        for ip in sorted(set(ips)):
+            lock = file_lock.LockHandler.mount_ip_lock(ip)
+            if not lock.grab_blocking_lock():
+                self.unlock_servers()
+                return False
+            self.ip_locks.append(lock)
+        return True
+
+    def unlock_servers(self):
+        for lock in self.ip_locks:
+            lock.release_lock()
+        self.ip_locks = []
+
    # Method to check whether nfs share is already mounted.
-    def is_share_mounted(self, ip_address, mount_path):
-        self.mounts = NfsMount().load_nfs_mounts()
+    # early_exit: stop reading the mount table once the share is found
+    def is_share_mounted(self, ip_address, mount_path, early_exit=False):
+        def is_match(mount):
+            return mount.ip == ip_address and mount.mount_path == mount_path
+
+        self.mounts = MountInventory.load(stop_at=is_match if early_exit else None)
         if self.mounts is None:
             return True  # Force app to exit app
-        for mount in self.mounts:
-            if mount.ip == ip_address and mount.mount_path == mount_path:
-                self.LogUser('Share is already mounted at: ' +
-                             mount.mounted_at)
-                return True
+        mount = self.mounts.find(ip_address, mount_path)
+        if mount:
+            self.LogUser('Share is already mounted at: ' +
+                         mount.mounted_at)
+            return True
         return False
 
     def mount(self, args):
-        if self.is_share_mounted(args.ip_address, args.mount_path):
+        if not self.lock_servers([args.ip_address]):
             return False
+        try:
+            if self.is_share_mounted(args.ip_address, args.mount_path, early_exit=True):
+                return False
 
-        if not args.is_secure:
-            self.LogUser("Non-IPsec mount requested.")
-            ipsec = self.get_ipsec_mgr()
-            if ipsec:
-                ipsec.remove_config(args.ip_address)
-                ipsec.reload_config()
-        else:
-            cert = RenewCerts()
-            if not cert.root_cert_installed():
-                self.LogError("Root Certificate must be installed.")
+            if not self.prepare_mounts([args]):
                 return False
 
-            if not cert.load_certificate():
-                if not cert.get_initial_certs():
-                    return False
+            self.wait_preconnect()
+            if not self.run_mount(args):
+                return False
+        finally:
+            self.unlock_servers()
 
-            if cert.is_certificate_eligible_for_renewal():
-                if not cert.renew_cert_now():
-                    if cert.is_certificate_expired():
-                        return False
-                    self.LogWarn("Cert has not expired, so will continue.")
+        MountInventory.reset()
+        self.ca_certs_alert()
+        return True
 
-            ipsec = cert.get_ipsec_mgr()
-            if not ipsec.is_running():
+    # Mount many shares with one certificate check and one ipsec reload.
+    def mount_batch(self, shares):
+        if not self.lock_servers([args.ip_address for args in shares]):
+            return False
+        try:
+            pending = []
+            for args in shares:
+                if not self.is_share_mounted(args.ip_address, args.mount_path):
+                    pending.append(args)
+            if len(pending) == 0:
+                return self.mounts is not None
+
+            if not self.prepare_mounts(pending):
                 return False
-            if not ipsec.create_config(args.ip_address):
+
+            self.wait_preconnect()
+            ret = self.run_mounts(pending)
+        finally:
+            self.unlock_servers()
+
+        MountInventory.reset()
+        self.ca_certs_alert()
+        return ret
+
+    def prepare_certs(self):
+        cert = RenewCerts()
+        if not cert.root_cert_installed():
+            self.LogError("Root Certificate must be installed.")
+            return None
+
+        if not cert.load_certificate():
+            if not cert.get_initial_certs():
+                return None
+
+        if cert.is_certificate_eligible_for_renewal():
+            if not cert.renew_cert_now():
+                if cert.is_certificate_expired():
+                    return None
+                self.LogWarn("Cert has not expired, so will continue.")
+        return cert.get_ipsec_mgr()
+
+    # certs and charon are shared by all mounts - host lock
+    def prepare_ipsec(self):
+        self.lock()
+        try:
+            ipsec = self.prepare_certs()
+            if ipsec and ipsec.is_running():
+                return ipsec
+        finally:
+            self.unlock()
+        return None
+
+    # Write the ipsec configs for all the shares and reload once.
+    def prepare_mounts(self, shares):
+        secure_ips = []
+        plain_ips = []
+        for args in shares:
+            ips = secure_ips if args.is_secure else plain_ips
+            if args.ip_address not in ips:
+                ips.append(args.ip_address)
+
+        # config files are per server - the server lock is held
+        ipsec = self.get_ipsec_mgr()
+        plain_ips = [ip for ip in plain_ips if ip not in secure_ips]
+        if len(plain_ips) > 0:
+            self.LogUser("Non-IPsec mount requested.")
+            if ipsec:
+                for ip in plain_ips:
+                    ipsec.remove_config(ip)
+
+        if len(secure_ips) > 0:
+            # connections charon still has loaded start before the cert check
+            self.preconnect(ipsec, secure_ips, loaded_only=True)
+            ipsec = self.prepare_ipsec()
+            if not ipsec:
                 return False
-            ipsec.cleanup_unused_configs(self.mounts)
-            ipsec.is_reload = True
+            for ip in secure_ips:
+                if not ipsec.create_config(ip):
+                    return False
+
+        if not ipsec:
+            return True
+        self.lock()
+        try:
+            if len(secure_ips) > 0:
+                ipsec.cleanup_unused_configs(self.mounts)
+                # an unused config the watcher removed meanwhile
+                for ip in secure_ips:
+                    if not ipsec.get_config(ip) and not ipsec.create_config(ip):
+                        return False
+                ipsec.load_missing_connections(secure_ips)
             if not ipsec.reload_config():
                 return False
-            # ipsec.connect(args.ip_address)
+        finally:
+            self.unlock()
+        self.preconnect(ipsec, secure_ips)
+        self.record_trap(ipsec, secure_ips)
+        return True
+
+    # optional - the IKE handshake runs while the mount is prepared, a
+    # connection is started once loaded, the rest wait for the reload
+    def preconnect(self, ipsec, ips, loaded_only=False):
+        share_conf = ShareConfig(None, show_error=False)
+        if not ipsec or len(ips) == 0 or not share_conf.is_enabled("preconnect"):
+            return
+        self.preconnect_wait = share_conf.get_int("preconnect_wait_secs",
+                                                  self.PRECONNECT_WAIT_SECS)
+        started = [thread.name for thread in self.preconnects]
+        loaded = ipsec.get_loaded_connections() if loaded_only else None
+        for ip in ips:
+            # subnet connections are started by the trap policy
+            if ipsec.config_key(ip) != ip or ip in started:
+                continue
+            if loaded_only and (loaded is None or ipsec.connection_name(ip) not in loaded):
+                continue
+            thread = threading.Thread(target=self.connect, name=ip,
+                                      args=[ipsec, ip, self.preconnect_wait * 1000])
+            thread.daemon = True
+            thread.start()
+            self.preconnects.append(thread)
 
-        self.unlock()
-        out = self.RunCmd(args.get_mount_cmd_line(), "MountCmd", ret_out=True)
+    def connect(self, ipsec, ip, timeout_ms):
+        started = time.time()
+        ok = ipsec.connect(ip, timeout_ms)
+        metrics = sa_metrics.SaMetrics(ipsec.CONNECTION_PREFIX)
+        metrics.record_connect(ipsec.connection_name(ip), time.time() - started, ok)
+        return ok
+
+    # connections not started here come up with the first nfs packet,
+    # the watcher times them from their SA events
+    def record_trap(self, ipsec, ips):
+        if len(ips) == 0 or not ShareConfig(None, show_error=False).is_enabled("watch_mounts"):
+            return
+        started = [thread.name for thread in self.preconnects]
+        names = set(ipsec.connection_name(ip) for ip in ips if ip not in started)
+        if len(names) > 0:
+            sa_metrics.SaMetrics(ipsec.CONNECTION_PREFIX).record_trap(sorted(names))
+
+    # the mount goes ahead after the wait, the SA is then set up on demand
+    def wait_preconnect(self):
+        if len(self.preconnects) == 0:
+            return True
+        end_at = time.time() + self.preconnect_wait
+        for thread in self.preconnects:
+            thread.join(max(0, end_at - time.time()))
+        pending = len([thread for thread in self.preconnects if thread.is_alive()])
+        self.preconnects = []
+        if pending > 0:
+            self.LogDebug("IKE SA not up in %ds, mounting anyway" % self.preconnect_wait)
+            return False
+        return True
+
+    def run_mount_cmd(self, args):
+        return self.RunCmd(args.get_mount_cmd_line(), "MountCmd", ret_out=True)
+
+    def check_mount(self, args, out):
         if not out or out.is_error():
             # we pass back the mount command exit code
             exit_code = SysApp.ERR_MOUNT + out.returncode if out else SysApp.ERR_MOUNT
-            return self.LogError("Share mount failed.", code=exit_code)
+            return self.LogError("Share mount failed: " + args.mount_source, code=exit_code)
 
-        self.ca_certs_alert()
         self.LogUser("Share successfully mounted:" + out.stdout)
         return True
 
+    def run_mount(self, args):
+        return self.check_mount(args, self.run_mount_cmd(args))
+
+    # The mounts don't depend on each other once ipsec is configured,
+    # the exit code is taken from the first share that failed.
+    def run_mounts(self, shares):
+        if len(shares) == 1:
+            return self.run_mount(shares[0])
+
+        workers = min(len(shares), self.MAX_MOUNT_WORKERS)
+        self.LogDebug("Mounting %d shares, workers(%d)" % (len(shares), workers))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            outs = list(pool.map(self.run_mount_cmd, shares))
+
+        exit_code = None
+        mounted = 0
+        for args, out in zip(shares, outs):
+            if self.check_mount(args, out):
+                mounted += 1
+            elif exit_code is None:
+                exit_code = SysApp.last_error_code
+
+        self.LogUser("Shares mounted: %d of %d" % (mounted, len(shares)))
+        if exit_code is not None:
+            return SysApp.set_code(exit_code)
+        return True
+
     # Check int and root CA certs validity.
     def ca_certs_alert(self):
         cert = RenewCerts()
@@ -148,15 +431,28 @@ class MountIbmshare(MountHelperBase):
             elif rt.is_renew():
                 ret = self.renew_certs()
                 self.ca_certs_alert()
+            elif rt.is_watch():
+                ret = self.watch_mounts()
+            elif rt.is_status():
+                ret = self.sa_status()
+            elif rt.is_mtu_check():
+                ret = self.mtu_check(SysApp.argv(2))
+            elif rt.is_batch():
+                shares = ArgsHandler.get_batch_mount_args()
+                if shares:
+                    ret = self.mount_batch(shares)
+            elif rt.is_mount_all():
+                shares = ArgsHandler.get_fstab_mount_args()
+                if shares is not None:
+                    ret = self.mount_batch(shares)
             elif rt.is_mount():
                 args = ArgsHandler.get_mount_args()
                 if args:
-                    self.lock()
                     ret = self.mount(args)
-                    self.unlock()
         except Exception as ex:
             self.LogException("AppRun", ex)
             self.unlock()
+            self.unlock_servers()
         return ret
 
 
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+
+from common import *
+import file_lock
+import select
+
+
+class MountWatcher(MountHelperBase):
+    MOUNTS_FILE = "/proc/self/mounts"
+    POLL_EVENTS = select.POLLPRI | select.POLLERR
+    # configs kept for a mount in progress are retried after this
+    RETRY_SECS = 30
+
+    def __init__(self, ipsec):
+        self.ipsec = ipsec
+        self.ips = None
+        self.pending = set()
+
+    def load_ips(self):
+        mounts = MountInventory.load(refresh=True)
+        return mounts.get_ips() if mounts is not None else None
+
+    # the servers of the connection a mount could be starting to
+    def connection_servers(self, key):
+        if self.ipsec.key_network(key) is None:
+            return [key]
+        return sorted(ip for ip in file_lock.LockHandler.mount_ip_lock_ips()
+                      if self.ipsec.is_key_in_use(key, [ip]))
+
+    # the server locks, held until the connection is unloaded so a mount
+    # can't find it loaded in between - None to keep the connection
+    def lock_connection(self, ip, ips):
+        key = self.ipsec.file_key(ip)
+        # a subnet connection stays while any server in it is mounted
+        if self.ipsec.is_key_in_use(key, ips) or not self.ipsec.get_config(ip):
+            return None
+        locks = []
+        for server in self.connection_servers(key):
+            lock = file_lock.LockHandler.mount_ip_lock(server)
+            if not lock.try_lock():
+                self.LogDebug("Mount in progress, config kept for: " + key)
+                self.pending.add(ip)
+                for lock in locks:
+                    lock.release_lock()
+                return None
+            locks.append(lock)
+        return locks
+
+    # remove the configs and reload under the host lock, as the mount does
+    def remove_connections(self, ips):
+        host_lock = file_lock.LockHandler.mount_share_lock()
+        if not host_lock.grab_blocking_lock():
+            self.pending |= set(ips)
+            return False
+        try:
+            for ip in ips:
+                self.LogInfo("Last mount removed, removing IPsec config for: " + ip)
+                self.ipsec.remove_config(ip, shared=True)
+            return self.ipsec.reload_config()
+        finally:
+            host_lock.release_lock()
+
+    # diff the nfs servers in use and drop the unused connections
+    def on_change(self):
+        ips = self.load_ips()
+        if ips is None:
+            return False
+        gone = self.pending
+        if self.ips is not None:
+            gone = gone | (self.ips - ips)
+        self.ips = ips
+        self.pending = set()
+        removed = []
+        locks = []
+        try:
+            keys = set()
+            for ip in sorted(gone - ips):
+                key = self.ipsec.file_key(ip)
+                if key in keys:
+                    continue
+                keys.add(key)
+                key_locks = self.lock_connection(ip, ips)
+                if key_locks is not None:
+                    removed.append(ip)
+                    locks += key_locks
+            if len(removed) > 0:
+                return self.remove_connections(removed)
+            return True
+        finally:
+            for lock in locks:
+                lock.release_lock()
+
+    # the configs kept for a mount in progress are retried on a timer
+    def wait_for_change(self, poller, fd):
+        timeout = self.RETRY_SECS * 1000 if len(self.pending) > 0 else None
+        if len(poller.poll(timeout)) == 0:
+            return
+        # reading the file re-arms the poll event
+        fd.seek(0)
+        fd.read()
+
+    def watch(self, max_events=-1):
+        self.LogInfo("Watching for nfs unmounts: " + self.MOUNTS_FILE)
+        with open(self.MOUNTS_FILE, "r") as fd:
+            poller = select.poll()
+            poller.register(fd, self.POLL_EVENTS)
+            fd.read()
+            self.on_change()
+            while max_events != 0:
+                self.wait_for_change(poller, fd)
+                self.on_change()
+                max_events -= 1
+        return True
+
+
+class MountWatcherService(SystemCtl):
+    SERVICE_FILE = '/etc/systemd/system/mount_helper_watch.service'
+
+    SERVICE_CONFIG = """[Unit]
+Description=Mount helper nfs unmount watcher
+After=strongswan.service
+[Service]
+ExecStart=%s
+Restart=on-failure
+[Install]
+WantedBy=multi-user.target
+"""
+
+    def __init__(self):
+        super().__init__('mount_helper_watch.service')
+
+    def install(self, command_path):
+        data = MountWatcherService.SERVICE_CONFIG % (command_path)
+        self.WriteFile(MountWatcherService.SERVICE_FILE, data, chmod=0o744)
+        return self.restart()
+
+    def teardown(self):
+        if self.FileExists(MountWatcherService.SERVICE_FILE):
+            self.disable()
+        self.RemoveFile(MountWatcherService.SERVICE_FILE)
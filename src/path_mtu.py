@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+
+from common import *
+import socket
+
+
+# MTU left for nfs once ESP (and the UDP encapsulation) is added to
+# each packet, from the path MTU the kernel has for the server.
+# Transport mode keeps the original IP header, ESP goes after it.
+class PathMtu(MountHelperBase):
+    NFS_PORT = 2049
+    # linux values, not all are exported by the socket module
+    IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+    IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+    IP_MTU = getattr(socket, "IP_MTU", 14)
+    IP_HEADER = 20
+    UDP_HEADER = 8
+    # esp header, gcm iv and icv, pad length and next header
+    ESP_OVERHEAD = 8 + 8 + 16 + 2
+    ESP_ALIGN = 4
+    # tcp header with timestamps
+    TCP_HEADER = 32
+
+    def path_mtu(self, ip):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, self.IP_MTU_DISCOVER, self.IP_PMTUDISC_DO)
+                sock.connect((ip, self.NFS_PORT))
+                return sock.getsockopt(socket.IPPROTO_IP, self.IP_MTU)
+            finally:
+                sock.close()
+        except OSError as ex:
+            self.LogError("Path MTU unknown: %s (%s)" % (ip, str(ex)))
+        return None
+
+    # largest ip packet that still fits the path once ESP is added
+    def esp_mtu(self, mtu, encap):
+        space = mtu - self.IP_HEADER - self.ESP_OVERHEAD
+        if encap:
+            space -= self.UDP_HEADER
+        # payload plus trailer padded to the esp alignment
+        return (space + 2) // self.ESP_ALIGN * self.ESP_ALIGN - 2 + self.IP_HEADER
+
+    # (path mtu, esp mtu, tcp mss) or None
+    def check(self, ip, encap):
+        mtu = self.path_mtu(ip)
+        if not mtu:
+            return None
+        esp_mtu = self.esp_mtu(mtu, encap)
+        mss = esp_mtu - self.IP_HEADER - self.TCP_HEADER
+        return mtu, esp_mtu, mss
+
+    def show(self, ip, encap):
+        out = self.check(ip, encap)
+        if out is None:
+            return False
+        mtu, esp_mtu, mss = out
+        self.LogUser("Path MTU: %d to %s" % (mtu, ip))
+        self.LogUser("ESP MTU: %d (udp encap %s), tcp mss: %d" % (
+            esp_mtu, "yes" if encap else "no", mss))
+        if not encap:
+            self.LogUser("ESP MTU is %d less if NAT is detected." % self.UDP_HEADER)
+        return True
@@ -6,7 +6,7 @@
 
 
 import args_handler
-from certificate_handler import CertificateHandler
+from certificate_handler import CertificateHandler, KeyPool, KEY_ALGORITHM_DEFAULT
 import metadata
 from common import *
 import file_lock
@@ -21,6 +21,7 @@ class RenewCerts(metadata.Metadata):
 
     def __init__(self):
         super().__init__()
+        self.is_new_key = False
 
     def install_root_cert(self, src):
         if not metadata.USE_METADATA_SERVICE:
@@ -66,8 +67,7 @@ class RenewCerts(metadata.Metadata):
         while cnt < self.RENEW_MAX_RETRIES or self.RENEW_MAX_RETRIES < 0:
             cnt += 1
             # check if mount in progress
-            lockhandler = file_lock.LockHandler.mount_share_lock()
-            if not lockhandler.is_locked():
+            if not file_lock.LockHandler.is_mount_in_progress():
                 hasActiveMounts = self.get_ipsec_mgr().cleanup_unused_configs(None)
                 if not hasActiveMounts:
                     self.LogInfo(
@@ -95,21 +95,46 @@ class RenewCerts(metadata.Metadata):
 
         ipsec = self.get_ipsec_mgr()
         private_key = ipsec.read_private_key()
+        if private_key and KeyPool().is_rotation_due():
+            self.LogInfo("RenewCert:Rotating private key")
+            private_key = None
+        if private_key and self.private_key_algorithm(private_key) not in [None, self.key_algorithm()]:
+            self.LogInfo("RenewCert:Key algorithm changed to " + self.key_algorithm())
+            private_key = None
         if private_key:
             self.LogDebug("RenewCert:Use existing private key")
-            private_key = self.set_private_key(private_key)
+            private_key = self.set_private_key(private_key, ipsec.private_key_filename())
 
+        # the existing key may also have failed its check
+        self.is_new_key = not private_key
         if not private_key:
             self.new_private_key()
 
         if not self.new_certificate_signing_request():
             return self.LogError("Problem with generating signing request.")
 
-        if not self.generate_certs():
+        if not self.generate_certs() and not self.fallback_rsa_key():
             return self.LogError("Generate certs failed.",
                                  code=SysApp.ERR_METADATA_CERT_RENEW)
         return True
 
+    # the service may not take the configured key type, retry once with rsa
+    def fallback_rsa_key(self):
+        if (not self.csr_rejected or
+                self.private_key_algorithm(self.private_key) in [None, KEY_ALGORITHM_DEFAULT]):
+            return False
+        rejected = self.private_key_algorithm(self.private_key)
+        self.LogWarn("Signing request with %s key rejected, using %s" % (
+            rejected, KEY_ALGORITHM_DEFAULT))
+        # later renewals keep rsa instead of being rejected again
+        self.set_rejected_key_algorithm(rejected)
+        self.is_new_key = True
+        if not self.set_private_key(self.generate_private_key(KEY_ALGORITHM_DEFAULT)):
+            return False
+        if not self.new_certificate_signing_request():
+            return False
+        return self.generate_certs()
+
     def metadata_renew_cert(self):
         if not metadata.USE_METADATA_SERVICE:
             self.LogDebug("Checking for local certs in: " +
@@ -121,6 +146,7 @@ class RenewCerts(metadata.Metadata):
 
         ipsec = self.get_ipsec_mgr()
         ipsec.write_new_certs(self.cert, self.private_key, self.cert_int_ca)
+        KeyPool().renewed(self.is_new_key)
         return self.schedule_next_renewal()
 
     def schedule_next_renewal(self):
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+
+from common import *
+import file_lock
+import vici
+
+
+# Per connection IKE/CHILD SA counters, kept in a json file so the
+# watcher, the mounts and the status command can all add to them.
+class SaMetrics(MountHelperBase):
+    METRICS_FILE = LocalInstall.make_filename("sa_stats.json")
+    EVENTS = ["ike-updown", "child-updown", "ike-rekey", "child-rekey"]
+    RETRY_SECS = 5
+    # a trapped connection not up by then was already up or failed
+    TRAP_MAX_SECS = 120
+    COUNTERS = ["ike_up", "ike_down", "failures", "ike_rekeys",
+                "child_rekeys", "connects", "connect_failures"]
+    TRAFFIC = ["bytes_in", "bytes_out", "packets_in", "packets_out"]
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lockhandler = file_lock.LockHandler.sa_metrics_lock()
+
+    def load(self):
+        try:
+            if os.path.exists(self.METRICS_FILE):
+                with open(self.METRICS_FILE, "r") as fd:
+                    return json.load(fd)
+        except Exception as ex:
+            self.LogDebug("SaMetrics ignored (%s)" % str(ex))
+        return {}
+
+    def save(self, conns):
+        if not LocalInstall.exists():
+            return False
+        tmp_file = "%s.%d" % (self.METRICS_FILE, os.getpid())
+        try:
+            with open(tmp_file, "w") as fd:
+                json.dump(conns, fd, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.METRICS_FILE)
+            return True
+        except Exception as ex:
+            self.LogDebug("SaMetrics not saved (%s)" % str(ex))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return False
+
+    # apply func(conns) to the saved metrics
+    def update(self, func):
+        if not self.lockhandler.grab_blocking_lock():
+            return None
+        try:
+            conns = self.load()
+            func(conns)
+            self.save(conns)
+            return conns
+        finally:
+            self.lockhandler.release_lock()
+
+    def get_conn(self, conns, name):
+        if name not in conns:
+            conn = dict((key, 0) for key in self.COUNTERS)
+            conn["connect_ms_last"] = None
+            conn["connect_ms_max"] = None
+            conn["trapped_at"] = None
+            self.clear_state(conn)
+            conns[name] = conn
+        return conns[name]
+
+    def clear_state(self, conn):
+        conn["state"] = "DOWN"
+        conn["established_secs"] = None
+        for key in self.TRAFFIC:
+            conn[key] = 0
+
+    def add_connect(self, conn, secs):
+        msecs = int(secs * 1000)
+        conn["connects"] += 1
+        conn["connect_ms_last"] = msecs
+        conn["connect_ms_max"] = max(msecs, conn["connect_ms_max"] or 0)
+
+    # the child SA a trapped connection waited for is installed
+    def trap_connected(self, conn, up):
+        trapped_at = conn.get("trapped_at")
+        conn["trapped_at"] = None
+        if up and trapped_at:
+            secs = time.time() - trapped_at
+            if 0 <= secs <= self.TRAP_MAX_SECS:
+                self.add_connect(conn, secs)
+
+    def on_event(self, event, msg):
+        names = [name for name in msg if name.startswith(self.prefix)]
+        if len(names) == 0:
+            return True
+
+        def count(conns):
+            for name in names:
+                conn = self.get_conn(conns, name)
+                if event == "child-updown":
+                    self.trap_connected(conn, msg.get("up") == "yes")
+                elif event == "ike-rekey":
+                    conn["ike_rekeys"] += 1
+                elif event == "child-rekey":
+                    conn["child_rekeys"] += 1
+                elif msg.get("up") == "yes":
+                    conn["ike_up"] += 1
+                elif "established" in msg[name]:
+                    conn["ike_down"] += 1
+                else:
+                    # torn down before it was ever established
+                    conn["failures"] += 1
+        self.LogDebug("SA event %s: %s" % (event, ",".join(names)))
+        return self.update(count) is not None
+
+    # time taken to initiate the SA before a mount
+    def record_connect(self, name, secs, ok):
+        def record(conns):
+            conn = self.get_conn(conns, name)
+            if not ok:
+                conn["connect_failures"] += 1
+                return
+            self.add_connect(conn, secs)
+        return self.update(record) is not None
+
+    # the mount is about to trigger the SA of the trap policy, the
+    # watcher takes the time until its child-updown event
+    def record_trap(self, names):
+        def record(conns):
+            for name in names:
+                self.get_conn(conns, name)["trapped_at"] = time.time()
+        return self.update(record) is not None
+
+    # current state and traffic of each SA from list-sas
+    def poll(self, session):
+        sas = session.list_sas()
+        if sas is None:
+            return None
+
+        def refresh(conns):
+            for conn in conns.values():
+                self.clear_state(conn)
+            for event in sas:
+                for name, sa in event.items():
+                    if not name.startswith(self.prefix):
+                        continue
+                    conn = self.get_conn(conns, name)
+                    conn["state"] = sa.get("state", "")
+                    if "established" in sa:
+                        conn["established_secs"] = to_int(sa["established"])
+                    for child in sa.get("child-sas", {}).values():
+                        for key in self.TRAFFIC:
+                            conn[key] += to_int(child.get(key.replace("_", "-"), "0"))
+        return self.update(refresh)
+
+    # runs in the watcher service, reconnects when charon restarts
+    def listen(self, socket_path, max_events=-1):
+        while True:
+            with vici.ViciSession(socket_path) as session:
+                if session.listen(self.EVENTS, self.on_event, max_events):
+                    return True
+            time.sleep(self.RETRY_SECS)
+
+    def show(self, conns):
+        self.LogUser("%-32s %-12s %10s %7s %7s %7s %14s %14s %8s" % (
+            "Connection", "State", "Up(secs)", "IkeUp", "Rekeys", "Fails",
+            "BytesIn", "BytesOut", "Init(ms)"))
+        for name in sorted(conns):
+            conn = conns[name]
+            self.LogUser("%-32s %-12s %10s %7d %7d %7d %14d %14d %8s" % (
+                name, conn.get("state", ""),
+                conn.get("established_secs") or "-",
+                conn["ike_up"], conn["ike_rekeys"] + conn["child_rekeys"],
+                conn["failures"] + conn["connect_failures"],
+                conn.get("bytes_in", 0), conn.get("bytes_out", 0),
+                conn["connect_ms_last"] if conn["connect_ms_last"] is not None else "-"))
+        self.LogUser("Metrics file: " + self.METRICS_FILE)
+        return True
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+
+from collections import OrderedDict
+from common import *
+import socket
+import struct
+
+
+# VICI is the strongswan charon control protocol, each packet is
+# sent with a 32 bit length and holds a type, an optional name and
+# an optional message of sections, key values and lists.
+class ViciMessage:
+    # packet types
+    CMD_REQUEST = 0
+    CMD_RESPONSE = 1
+    CMD_UNKNOWN = 2
+    EVENT_REGISTER = 3
+    EVENT_UNREGISTER = 4
+    EVENT_CONFIRM = 5
+    EVENT_UNKNOWN = 6
+    EVENT = 7
+    NAMED_TYPES = [CMD_REQUEST, EVENT_REGISTER, EVENT_UNREGISTER, EVENT]
+    MESSAGE_TYPES = [CMD_REQUEST, CMD_RESPONSE, EVENT]
+
+    # message elements
+    SECTION_START = 1
+    SECTION_END = 2
+    KEY_VALUE = 3
+    LIST_START = 4
+    LIST_ITEM = 5
+    LIST_END = 6
+
+    @staticmethod
+    def encode_name(name):
+        name = name.encode()
+        if len(name) > 255:
+            raise ValueError("Vici name too long: %d" % len(name))
+        return struct.pack("!B", len(name)) + name
+
+    @staticmethod
+    def encode_value(value):
+        if not isinstance(value, bytes):
+            value = str(value).encode()
+        if len(value) > 65535:
+            raise ValueError("Vici value too long: %d" % len(value))
+        return struct.pack("!H", len(value)) + value
+
+    @staticmethod
+    def encode(msg):
+        out = b""
+        for name, value in msg.items():
+            if isinstance(value, dict):
+                out += struct.pack("!B", ViciMessage.SECTION_START)
+                out += ViciMessage.encode_name(name)
+                out += ViciMessage.encode(value)
+                out += struct.pack("!B", ViciMessage.SECTION_END)
+            elif isinstance(value, list):
+                out += struct.pack("!B", ViciMessage.LIST_START)
+                out += ViciMessage.encode_name(name)
+                for item in value:
+                    out += struct.pack("!B", ViciMessage.LIST_ITEM)
+                    out += ViciMessage.encode_value(item)
+                out += struct.pack("!B", ViciMessage.LIST_END)
+            else:
+                out += struct.pack("!B", ViciMessage.KEY_VALUE)
+                out += ViciMessage.encode_name(name)
+                out += ViciMessage.encode_value(value)
+        return out
+
+    # values are returned as text, binary data is kept with surrogates
+    @staticmethod
+    def decode(data):
+        msg = OrderedDict()
+        stack = [msg]
+        items = None
+        pos = 0
+
+        def read(size):
+            nonlocal pos
+            if pos + size > len(data):
+                raise ValueError("Vici message truncated")
+            pos += size
+            return data[pos - size:pos]
+
+        def read_name():
+            return read(read(1)[0]).decode(errors="surrogateescape")
+
+        def read_value():
+            size = struct.unpack("!H", read(2))[0]
+            return read(size).decode(errors="surrogateescape")
+
+        while pos < len(data):
+            kind = read(1)[0]
+            if kind == ViciMessage.SECTION_START:
+                section = OrderedDict()
+                stack[-1][read_name()] = section
+                stack.append(section)
+            elif kind == ViciMessage.SECTION_END:
+                if len(stack) == 1:
+                    raise ValueError("Vici section end without start")
+                stack.pop()
+            elif kind == ViciMessage.KEY_VALUE:
+                name = read_name()
+                stack[-1][name] = read_value()
+            elif kind == ViciMessage.LIST_START:
+                items = []
+                stack[-1][read_name()] = items
+            elif kind == ViciMessage.LIST_ITEM and items is not None:
+                items.append(read_value())
+            elif kind == ViciMessage.LIST_END and items is not None:
+                items = None
+            else:
+                raise ValueError("Vici message element invalid: %d" % kind)
+        if len(stack) != 1 or items is not None:
+            raise ValueError("Vici message not terminated")
+        return msg
+
+    @staticmethod
+    def encode_packet(ptype, name=None, msg=None):
+        out = struct.pack("!B", ptype)
+        if ptype in ViciMessage.NAMED_TYPES:
+            out += ViciMessage.encode_name(name)
+        if msg:
+            out += ViciMessage.encode(msg)
+        return struct.pack("!I", len(out)) + out
+
+    # packet without the length - type, name, message
+    @staticmethod
+    def decode_packet(data):
+        if len(data) == 0:
+            raise ValueError("Vici packet empty")
+        ptype = data[0]
+        pos = 1
+        name = None
+        if ptype in ViciMessage.NAMED_TYPES:
+            if len(data) < 2 or len(data) < 2 + data[1]:
+                raise ValueError("Vici packet truncated")
+            name = data[2:2 + data[1]].decode()
+            pos = 2 + data[1]
+        msg = None
+        if ptype in ViciMessage.MESSAGE_TYPES:
+            msg = ViciMessage.decode(data[pos:])
+        return ptype, name, msg
+
+
+class ViciSession(MountHelperBase):
+    # upstream default, StrongSwanConfig.CHARON_SOCKET is the installed one
+    SOCKET_PATH = "/var/run/charon.vici"
+    TIMEOUT_SECS = 30
+    MAX_PACKET_SIZE = 512 * 1024
+
+    def __init__(self, path=None, timeout=None):
+        self.path = path if path else self.SOCKET_PATH
+        self.timeout = timeout if timeout else self.TIMEOUT_SECS
+        self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.path)
+            return True
+        except OSError as ex:
+            self.LogDebug("Vici connect failed: %s (%s)" % (self.path, str(ex)))
+            self.close()
+        return False
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def send_packet(self, ptype, name=None, msg=None):
+        self.sock.sendall(ViciMessage.encode_packet(ptype, name, msg))
+
+    def recv_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise OSError("Vici connection closed")
+            data += chunk
+        return data
+
+    def recv_packet(self):
+        size = struct.unpack("!I", self.recv_exact(4))[0]
+        if size > self.MAX_PACKET_SIZE:
+            raise ValueError("Vici packet too large: %d" % size)
+        return ViciMessage.decode_packet(self.recv_exact(size))
+
+    # events already registered can arrive before the confirm, they go to callback
+    def register(self, event, ptype=ViciMessage.EVENT_REGISTER, callback=None):
+        self.send_packet(ptype, event)
+        while True:
+            rtype, name, msg = self.recv_packet()
+            if rtype == ViciMessage.EVENT_CONFIRM:
+                return
+            if rtype != ViciMessage.EVENT or not callback:
+                raise ValueError("Vici event not confirmed: " + event)
+            callback(name, msg)
+
+    # send a command, the events it streams are collected until the response,
+    # events still queued for an earlier command are dropped
+    def request(self, cmd, msg=None, event=None):
+        if not self.sock and not self.connect():
+            return None, None
+        events = []
+        try:
+            if event:
+                self.register(event)
+            self.send_packet(ViciMessage.CMD_REQUEST, cmd, msg)
+            while True:
+                ptype, name, reply = self.recv_packet()
+                if ptype == ViciMessage.EVENT:
+                    if name == event:
+                        events.append(reply)
+                elif ptype == ViciMessage.CMD_RESPONSE:
+                    break
+                elif ptype == ViciMessage.CMD_UNKNOWN:
+                    self.LogError("Vici command unknown: " + cmd)
+                    return None, None
+                else:
+                    raise ValueError("Vici packet unexpected: %d" % ptype)
+            if event:
+                self.register(event, ViciMessage.EVENT_UNREGISTER,
+                              callback=lambda name, msg: None)
+            return reply, events
+        except (OSError, ValueError) as ex:
+            self.LogError("Vici %s failed (%s)" % (cmd, str(ex)))
+            self.close()
+        return None, None
+
+    # hand each event to callback(name, msg) until the connection drops
+    def listen(self, events, callback, max_events=-1):
+        if not self.sock and not self.connect():
+            return False
+        early = []
+        try:
+            for event in events:
+                self.register(event, callback=lambda name, msg: early.append((name, msg)))
+            self.sock.settimeout(None)
+            while max_events != 0:
+                if len(early) > 0:
+                    ptype = ViciMessage.EVENT
+                    name, msg = early.pop(0)
+                else:
+                    ptype, name, msg = self.recv_packet()
+                if ptype == ViciMessage.EVENT:
+                    callback(name, msg)
+                    max_events -= 1
+            return True
+        except (OSError, ValueError) as ex:
+            self.LogDebug("Vici events stopped (%s)" % str(ex))
+            self.close()
+        return False
+
+    def command(self, cmd, msg=None):
+        reply, _ = self.request(cmd, msg)
+        if reply is None:
+            return False
+        if reply.get("success", "yes") != "yes":
+            return self.LogError("Vici %s failed: %s" % (cmd, reply.get("errmsg", "")))
+        return True
+
+    def version(self):
+        reply, _ = self.request("version")
+        return reply
+
+    def load_conn(self, name, conn):
+        self.LogDebug("Vici load-conn: " + name)
+        return self.command("load-conn", {name: conn})
+
+    def unload_conn(self, name):
+        self.LogDebug("Vici unload-conn: " + name)
+        return self.command("unload-conn", {"name": name})
+
+    def load_cert(self, data, ca=False):
+        return self.command("load-cert", {"type": "X509",
+                                          "flag": "CA" if ca else "NONE",
+                                          "data": data})
+
+    def load_key(self, data, key_type="any"):
+        return self.command("load-key", {"type": key_type, "data": data})
+
+    # list of {name: connection}
+    def list_conns(self, ike=None):
+        _, events = self.request("list-conns", {"ike": ike} if ike else None,
+                                 event="list-conn")
+        return events
+
+    def reload_settings(self):
+        return self.command("reload-settings")
+
+    def get_conns(self):
+        reply, _ = self.request("get-conns")
+        return reply.get("conns", []) if reply is not None else None
+
+    # list of {name: ike sa}
+    def list_sas(self, ike=None):
+        _, events = self.request("list-sas", {"ike": ike} if ike else None,
+                                 event="list-sa")
+        return events
+
+    def initiate(self, child, ike=None, timeout_ms=0):
+        msg = OrderedDict()
+        msg["child"] = child
+        if ike:
+            msg["ike"] = ike
+        msg["timeout"] = timeout_ms
+        reply, _ = self.request("initiate", msg, event="control-log")
+        if reply is None:
+            return False
+        if reply.get("success") != "yes":
+            return self.LogError("Vici initiate failed: %s %s" % (child, reply.get("errmsg", "")))
+        return True
+
+
+# Reads the swanctl.conf format so the config files can be loaded
+# with vici the same way swanctl does.
+class SwanctlConf(MountHelperBase):
+    # swanctl sends these comma separated settings as lists
+    LIST_KEYS = ["local_addrs", "remote_addrs", "proposals", "esp_proposals",
+                 "ah_proposals", "local_ts", "remote_ts", "vips", "pools",
+                 "groups", "cert_policy"]
+    # swanctl sends the data of these files
+    FILE_KEYS = ["certs", "cacerts", "pubkeys"]
+
+    @staticmethod
+    def parse(text):
+        conf = OrderedDict()
+        stack = [conf]
+        for line in text.splitlines():
+            line = line.split("#")[0].strip()
+            if len(line) == 0 or line.startswith("include "):
+                continue
+            if line.endswith("{"):
+                section = OrderedDict()
+                stack[-1][line[:-1].strip()] = section
+                stack.append(section)
+            elif line == "}":
+                if len(stack) == 1:
+                    raise ValueError("Swanctl conf unbalanced '}'")
+                stack.pop()
+            elif "=" in line:
+                name, value = line.split("=", 1)
+                stack[-1][name.strip()] = value.strip()
+            else:
+                raise ValueError("Swanctl conf invalid line: " + line)
+        if len(stack) != 1:
+            raise ValueError("Swanctl conf missing '}'")
+        return conf
+
+    @staticmethod
+    def read_data(fname):
+        with open(fname, "rb") as fd:
+            return fd.read()
+
+    # connection settings as load-conn expects them
+    @staticmethod
+    def to_vici(section):
+        out = OrderedDict()
+        for name, value in section.items():
+            if isinstance(value, dict):
+                out[name] = SwanctlConf.to_vici(value)
+            elif name in SwanctlConf.LIST_KEYS:
+                out[name] = [val.strip() for val in value.split(",")]
+            elif name in SwanctlConf.FILE_KEYS:
+                out[name] = [SwanctlConf.read_data(val.strip())
+                             for val in value.split(",")]
+            else:
+                out[name] = value
+        return out
+
+    # {name: connection} of a config file
+    def load_connections(self, fname):
+        data = self.ReadFile(fname)
+        if data is None:
+            return None
+        try:
+            conns = SwanctlConf.parse(data).get("connections", {})
+            return OrderedDict((name, SwanctlConf.to_vici(conn))
+                               for name, conn in conns.items())
+        except (OSError, ValueError) as ex:
+            self.LogError("Config file not loaded: %s (%s)" % (fname, str(ex)))
+        return None
@@ -5,6 +5,7 @@
 from args_handler import ArgsHandler
 import sys
 import unittest
+from test_common import *
 
 ARGV = ['/sbin/mount.ibmshare', '-o', 'rw,args1,arg2=test2,arg3=test3',
         '192.168.1.1:/path1', '/my_mount1']
@@ -131,5 +132,102 @@ class TestArgsHandler(unittest.TestCase):
         self.assertTrue(len(cmd) > 0)
 
 
+class TestArgsHandlerBatch(unittest.TestCase):
+
+    def test_batch_run_type(self):
+        sys.argv = ['app', '-MOUNT_BATCH', '1.1.1.1:/p1', '/mnt1']
+        self.assertTrue(ArgsHandler.get_app_run_type().is_batch())
+
+    def test_batch_args(self):
+        sys.argv = ['app', '-MOUNT_BATCH', '-o', 'secure=true',
+                    '1.1.1.1:/p1', '/mnt1', '1.1.1.2:/p2', '/mnt2']
+        shares = ArgsHandler.get_batch_mount_args()
+        self.assertEqual(len(shares), 2)
+        self.assertEqual(shares[1].ip_address, '1.1.1.2')
+        self.assertEqual(shares[1].mount_point, '/mnt2')
+        self.assertTrue(shares[0].is_secure)
+
+    def test_batch_args_missing_mount_point(self):
+        sys.argv = ['app', '-MOUNT_BATCH', '1.1.1.1:/p1', '/mnt1', '1.1.1.2:/p2']
+        self.assertFalse(ArgsHandler.get_batch_mount_args())
+
+    def test_batch_args_none(self):
+        sys.argv = ['app', '-MOUNT_BATCH']
+        self.assertFalse(ArgsHandler.get_batch_mount_args())
+
+    def test_batch_args_manifest(self):
+        fname = test_folder.get_temp_filename("shares")
+        write_file(fname, "# shares\n1.1.1.1:/p1 /mnt1 secure=true\n\n1.1.1.2:/p2 /mnt2\n")
+        sys.argv = ['app', '-MOUNT_BATCH', '-f', fname, '1.1.1.3:/p3', '/mnt3']
+        shares = ArgsHandler.get_batch_mount_args()
+        self.assertEqual([a.mount_point for a in shares], ['/mnt3', '/mnt1', '/mnt2'])
+        self.assertEqual([a.is_secure for a in shares], [False, True, False])
+
+    def test_batch_args_manifest_missing(self):
+        sys.argv = ['app', '-MOUNT_BATCH', '-f', '/tmp/not/exists']
+        self.assertFalse(ArgsHandler.get_batch_mount_args())
+
+
+FSTAB_DATA = """# /etc/fstab
+UUID=abcd / ext4 defaults 0 1
+1.1.1.1:/p1 /mnt/one ibmshare secure=true,_netdev,nofail 0 0
+1.1.1.2:/p2 /mnt/two\\040share ibmshare defaults,x-systemd.automount
+1.1.1.3:/p3 /mnt/three ibmshare noauto,secure=true 0 0
+1.1.1.4:/p4 /mnt/four nfs4 defaults 0 0
+"""
+
+
+class TestArgsHandlerFstab(unittest.TestCase):
+
+    def test_sa_status_run_type(self):
+        sys.argv = ['app', '-SA_STATUS']
+        self.assertTrue(ArgsHandler.get_app_run_type().is_status())
+
+    def test_mtu_check_run_type(self):
+        sys.argv = ['app', '-MTU_CHECK', 'nfs.host']
+        self.assertTrue(ArgsHandler.get_app_run_type().is_mtu_check())
+
+    def test_mount_all_run_type(self):
+        sys.argv = ['app', '-MOUNT_ALL']
+        self.assertTrue(ArgsHandler.get_app_run_type().is_mount_all())
+
+    def test_read_fstab(self):
+        fname = test_folder.get_temp_filename("fstab")
+        write_file(fname, FSTAB_DATA)
+        shares = ArgsHandler().read_fstab(fname)
+        self.assertEqual(shares, [("1.1.1.1:/p1", "/mnt/one", "secure=true"),
+                                  ("1.1.1.2:/p2", "/mnt/two share", "")])
+
+    def test_fstab_mount_args(self):
+        fname = test_folder.get_temp_filename("fstab")
+        write_file(fname, FSTAB_DATA)
+        with mock.patch("args_handler.FSTAB_FILE", fname):
+            shares = ArgsHandler.get_fstab_mount_args()
+        self.assertEqual([a.ip_address for a in shares], ["1.1.1.1", "1.1.1.2"])
+        self.assertEqual([a.is_secure for a in shares], [True, False])
+
+    def test_fstab_unresolved_skipped(self):
+        fname = test_folder.get_temp_filename("fstab")
+        write_file(fname, FSTAB_DATA + "nohost.example:/p5 /mnt/five ibmshare defaults\n")
+        args = ArgsHandler()
+        args.EnableLogStore()
+        with mock.patch("args_handler.FSTAB_FILE", fname), \
+                mock.patch("common.HostResolver.resolve",
+                           side_effect=lambda host: None if host == "nohost.example" else host):
+            shares = args.parse_fstab()
+        self.assertEqual([a.ip_address for a in shares], ["1.1.1.1", "1.1.1.2"])
+        self.assertTrue(args.HasLogMessage("Skipping share: nohost.example:/p5 /mnt/five"))
+
+    def test_fstab_no_shares(self):
+        fname = test_folder.get_temp_filename("fstab")
+        write_file(fname, "UUID=abcd / ext4 defaults 0 1\n")
+        with mock.patch("args_handler.FSTAB_FILE", fname):
+            self.assertEqual(ArgsHandler.get_fstab_mount_args(), [])
+
+    def test_fstab_missing(self):
+        with mock.patch("args_handler.FSTAB_FILE", "/tmp/not/exists"):
+            self.assertIsNone(ArgsHandler.get_fstab_mount_args())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,6 +4,7 @@
 
 import certificate_handler
 import os
+import time
 import unittest
 from unittest.mock import MagicMock
 from test_common import *
@@ -45,6 +46,64 @@ def set_current_time(co, str_date):
     co.get_current_time = MagicMock(return_value=to_utc(dt))
 
 
+def openssl_cert(subject, days=30, outform="PEM"):
+    key = test_folder.get_temp_filename("x509.key")
+    cert = test_folder.get_temp_filename("x509.crt")
+    out = SubProcess(["openssl", "req", "-x509", "-nodes", "-newkey", "ec",
+                      "-pkeyopt", "ec_paramgen_curve:prime256v1", "-keyout", key,
+                      "-out", cert, "-outform", outform, "-days", str(days),
+                      "-subj", subject, "-utf8"]).run()
+    assert not out.is_error(), out.stderr
+    with open(cert, "rb") as fd:
+        data = fd.read()
+    out = SubProcess(["openssl", "x509", "-in", cert, "-inform", outform,
+                      "-noout", "-dates", "-subject", "-issuer"]).run()
+    return data, [out.get_stdout_val("notBefore=", True), out.get_stdout_val("notAfter=", True),
+                  out.get_stdout_val("subject=", True), out.get_stdout_val("issuer=", True)]
+
+
+class TestX509Reader(unittest.TestCase):
+
+    def check_openssl(self, subject, days=30, outform="PEM"):
+        data, expected = openssl_cert(subject, days, outform)
+        fields = certificate_handler.X509Reader.parse(data)
+        crt = certificate_handler.CryptoX509()
+        for pos in [0, 1]:
+            self.assertEqual(crt.convert_date(fields[pos]), crt.convert_date(expected[pos]))
+        self.assertEqual(fields[2:], expected[2:])
+
+    def test_matches_openssl(self):
+        self.check_openssl("/CN=localhost")
+        self.check_openssl(certificate_handler.OPENSSL_CSR_SUBJECT + "/CN=share.example.com")
+        self.check_openssl("/O=IBM, Inc./OU=a+b \\\"q\\\"/CN= lead;trail ")
+        self.check_openssl("/DC=com/DC=example/UID=user1/emailAddress=u@example.com")
+        self.check_openssl("/CN=multi+OU=valued")
+        self.check_openssl("/CN=caf\xc3\xa9")
+
+    def test_der_and_generalized_time(self):
+        # not after beyond 2049 is a GeneralizedTime
+        self.check_openssl("/CN=long lived", days=30000)
+        self.check_openssl("/CN=der", outform="DER")
+
+    def test_invalid(self):
+        der = certificate_handler.X509Reader.to_der(TEST_CERT)
+        for data in [b"", b"\x30\x82\x01", der[:100], "no pem here",
+                     TEST_CERT.replace("MIID", "!!!!")]:
+            with self.assertRaises(ValueError):
+                certificate_handler.X509Reader.parse(data)
+
+    def test_load_cert_in_memory(self):
+        co = certificate_handler.CertificateHandler()
+        with mock.patch("common.TempFile") as temp_file:
+            self.assertTrue(co.load_cert(TEST_CERT))
+            temp_file.assert_not_called()
+        self.assertEqual(co.get_issuer(), "CN = rfos-intermediate-ca1")
+        co.EnableLogStore()
+        self.assertFalse(co.load_cert("not a cert"))
+        self.assertFalse(co.is_loaded())
+        self.assertTrue(co.HasLogMessage("Certificate could not be read"))
+
+
 class TestCertificateHandler(unittest.TestCase):
     def test_get_certificate_not_after_date(self):
         write_cert_file()
@@ -53,6 +112,46 @@ class TestCertificateHandler(unittest.TestCase):
         not_after = co.get_certificate_not_after_date()
         self.assertEqual(date_to_str(not_after), expected)
 
+    @mock.patch("common.LocalInstall.exists", return_value=True)
+    def test_load_certificate_cached(self, exists):
+        fname = test_folder.get_temp_filename("cert.pem")
+        write_file(fname, TEST_CERT)
+        cache = StateCache()
+        cache.CACHE_FILE = test_folder.get_temp_filename("state.bin")
+        with mock.patch("common.StateCache.state_obj", cache):
+            co = certificate_handler.CertificateHandler()
+            co.read_cert_fields = MagicMock(side_effect=co.read_cert_fields)
+            self.assertTrue(co.load_certificate_by_filename(fname))
+            self.assertTrue(co.load_certificate_by_filename(fname))
+            self.assertEqual(co.read_cert_fields.call_count, 1)
+            self.assertEqual(date_to_str(co.get_certificate_not_after_date()),
+                             'Nov-11-2022 02:52:57')
+            self.assertEqual(co.get_subject(), "CN = localhost")
+
+            # cert file replaced - read again
+            write_file(fname, TEST_CERT + "\n")
+            self.assertTrue(co.load_certificate_by_filename(fname))
+            self.assertEqual(co.read_cert_fields.call_count, 2)
+
+    @mock.patch("common.LocalInstall.exists", return_value=True)
+    def test_load_private_key_cached(self, exists):
+        fname = test_folder.get_temp_filename("type_ibmshare.key")
+        write_file(fname, TEST_PRIVATE_KEY)
+        cache = StateCache()
+        cache.CACHE_FILE = test_folder.get_temp_filename("state.bin")
+        with mock.patch("common.StateCache.state_obj", cache):
+            co = certificate_handler.CertificateHandler()
+            co.run_openssl = MagicMock(side_effect=co.run_openssl)
+            self.assertTrue(co.load_private_key(TEST_PRIVATE_KEY, fname))
+            self.assertTrue(co.load_private_key(TEST_PRIVATE_KEY, fname))
+            self.assertEqual(co.run_openssl.call_count, 1)
+            # not the content of the file
+            self.assertFalse(co.load_private_key("invalid private key", fname))
+            self.assertEqual(co.run_openssl.call_count, 2)
+            # no file - always checked
+            self.assertTrue(co.load_private_key(TEST_PRIVATE_KEY))
+            self.assertEqual(co.run_openssl.call_count, 3)
+
     def test_fake_certificate_dates_are_none(self):
         co = load_fake_cert()
         self.assertFalse(co.is_loaded())
@@ -103,6 +202,26 @@ class TestCertificateHandler(unittest.TestCase):
         pkey = co.generate_private_key()
         self.assertTrue(len(pkey) > 0)
 
+    def test_generate_private_key_ecdsa(self):
+        co = certificate_handler.CertificateHandler()
+        for algorithm in ["ecdsa-p256", "ecdsa-p384"]:
+            pkey = co.generate_private_key(algorithm)
+            self.assertEqual(co.private_key_algorithm(pkey), algorithm)
+            self.assertTrue(co.load_private_key(pkey))
+            self.assertTrue(co.validate_csr(co.generate_csr(pkey)))
+        self.assertEqual(co.private_key_algorithm(TEST_PRIVATE_KEY), "rsa")
+        self.assertIsNone(co.private_key_algorithm("invalid private key"))
+
+    def test_key_algorithm(self):
+        co = certificate_handler.CertificateHandler()
+        co.EnableLogStore()
+        with mock.patch("common.ShareConfig.get_str", return_value="ECDSA-P384") as get_str:
+            self.assertEqual(co.key_algorithm(), "ecdsa-p384")
+            get_str.assert_called_with("key_algorithm", "rsa")
+            get_str.return_value = "dsa"
+            self.assertEqual(co.key_algorithm(), "rsa")
+            self.assertTrue(co.HasLogMessage("Key algorithm unknown"))
+
     def test_generate_csr(self):
         co = load_test_cert()
         pkey = co.generate_private_key()
@@ -110,6 +229,16 @@ class TestCertificateHandler(unittest.TestCase):
         self.assertTrue(len(csr) > 0)
         self.assertTrue(co.validate_csr(csr))
 
+    def test_no_temp_files(self):
+        co = certificate_handler.CertificateHandler()
+        with mock.patch("common.TempFile") as temp_file:
+            pkey = co.generate_private_key("ecdsa-p256")
+            self.assertTrue(co.load_private_key(pkey))
+            csr = co.generate_csr(pkey)
+            self.assertTrue(co.validate_csr(csr))
+            temp_file.assert_not_called()
+        self.assertTrue(csr.startswith("-----BEGIN CERTIFICATE REQUEST-----\\n"))
+
     def test_generate_csr_bad_private_key(self):
         co = load_test_cert()
         csr = co.generate_csr("")
@@ -129,5 +258,80 @@ class TestCertificateHandler(unittest.TestCase):
         self.assertTrue(co.is_certificate_eligible_for_renewal())
 
 
+def new_key_pool():
+    pool = certificate_handler.KeyPool()
+    pool.KEY_FILE = test_folder.get_temp_filename("next.key")
+    pool.RENEWALS_FILE = test_folder.get_temp_filename("key_renewals")
+    for fname in [pool.KEY_FILE, pool.tmp_filename(), pool.RENEWALS_FILE]:
+        if os.path.exists(fname):
+            os.remove(fname)
+    return pool
+
+
+@mock.patch("common.LocalInstall.exists", return_value=True)
+class TestKeyPool(unittest.TestCase):
+
+    def test_fill_take(self, exists):
+        pool = new_key_pool()
+        self.assertIsNone(pool.take())
+        self.assertTrue(pool.fill())
+        # one fill at a time
+        self.assertFalse(pool.fill())
+        end_at = time.time() + 60
+        while not os.path.exists(pool.KEY_FILE) and time.time() < end_at:
+            time.sleep(0.1)
+        self.assertEqual(os.stat(pool.KEY_FILE).st_mode & 0o777, 0o600)
+        self.assertFalse(os.path.exists(pool.tmp_filename()))
+        self.assertFalse(pool.fill())
+        data = pool.take()
+        self.assertTrue(certificate_handler.CertificateHandler().load_private_key(data))
+        self.assertFalse(os.path.exists(pool.KEY_FILE))
+
+    def test_take_once(self, exists):
+        pool = new_key_pool()
+        write_file(pool.KEY_FILE, TEST_PRIVATE_KEY)
+        # another process claimed the key first
+        with mock.patch("os.rename", side_effect=FileNotFoundError):
+            self.assertIsNone(pool.take())
+        self.assertEqual(pool.take(), TEST_PRIVATE_KEY)
+        self.assertIsNone(pool.take())
+        self.assertFalse(os.path.exists("%s.%d" % (pool.KEY_FILE, os.getpid())))
+
+    def test_fill_cmd(self, exists):
+        pool = new_key_pool()
+        with mock.patch("shutil.which", return_value=None):
+            cmd = pool.fill_cmd()
+        self.assertEqual(cmd[:5], ["sh", "-c", pool.FILL_SCRIPT, "sh", pool.KEY_FILE])
+        self.assertEqual(cmd[5:7], ["openssl", "genpkey"])
+        with mock.patch("shutil.which", return_value="/usr/bin/x"):
+            cmd = pool.fill_cmd()
+        self.assertEqual(cmd[5:12], pool.NICE_CMD + pool.IONICE_CMD + ["openssl"])
+
+    def test_stale_fill(self, exists):
+        pool = new_key_pool()
+        write_file(pool.tmp_filename(), "")
+        self.assertTrue(pool.is_filling())
+        old = time.time() - pool.FILL_TIMEOUT_SECS - 1
+        os.utime(pool.tmp_filename(), (old, old))
+        self.assertFalse(pool.is_filling())
+
+    def test_rotation(self, exists):
+        pool = new_key_pool()
+        pool.fill = MagicMock()
+        with mock.patch("common.ShareConfig.get_int", return_value=0):
+            pool.renewed(False)
+            self.assertEqual(pool.renewals(), 1)
+            self.assertFalse(pool.is_rotation_due())
+            pool.fill.assert_not_called()
+        with mock.patch("common.ShareConfig.get_int", return_value=2) as get_int:
+            pool.renewed(False)
+            self.assertTrue(pool.is_rotation_due())
+            get_int.assert_called_with("key_rotate_renewals", 0)
+            self.assertEqual(pool.fill.call_count, 1)
+            pool.renewed(True)
+            self.assertEqual(pool.renewals(), 0)
+            self.assertFalse(pool.is_rotation_due())
+
+
 if __name__ == "__main__":
     unittest.main()
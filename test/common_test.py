@@ -39,6 +39,11 @@ class TestCommonCode(unittest.TestCase):
         out = proc.run()
         self.assertEqual(out.returncode, 0)
 
+    def test_subprocess_run_input(self):
+        out = SubProcess(["cat"]).run("key data")
+        self.assertEqual(out.returncode, 0)
+        self.assertEqual(out.stdout, "key data")
+
     def test_subprocess_run_stream(self):
         cmd = ["ls", "/tmp"]
         proc = SubProcess(cmd)
@@ -63,5 +68,246 @@ class TestCommonCode(unittest.TestCase):
         self.assertIsNone(version)
 
 
+class TestNfsMount(unittest.TestCase):
+
+    def test_unescape_mount_field(self):
+        self.assertEqual(unescape_mount_field("/mnt/a\\040b"), "/mnt/a b")
+        self.assertEqual(unescape_mount_field("/mnt/a\\134b"), "/mnt/a\\b")
+        self.assertEqual(unescape_mount_field("/mnt/ab"), "/mnt/ab")
+
+    def test_get_mount_info_nfs(self):
+        line = "39 28 0:49 / /mnt/my\\040share rw shared:1 master:2 - nfs4 1.1.1.1:/my\\040path rw\n"
+        mount = NfsMount().get_mount_info(line)
+        self.assertEqual(mount.ip, "1.1.1.1")
+        self.assertEqual(mount.mount_path, "/my path")
+        self.assertEqual(mount.mounted_at, "/mnt/my share")
+
+    def test_get_mount_info_not_nfs(self):
+        lines = ["23 28 0:22 / /proc rw,relatime - proc proc rw",
+                 "24 28 0:49 / /mnt rw - cifs 1.1.1.1:/path rw",
+                 "bad line"]
+        for line in lines:
+            self.assertIsNone(NfsMount().get_mount_info(line))
+
+    def test_load_nfs_mounts_fallback(self):
+        data = "1.1.1.1:/path1 on /mnt/one type nfs4 (rw)"
+        with mock.patch("common.NfsMount.MOUNT_INFO_FILE", "/proc/not/exists"):
+            with MySubProcess(0, data) as run:
+                mounts = NfsMount().load_nfs_mounts()
+                self.assertEqual(run.func.call_count, 1)
+        self.assertEqual(len(mounts), 1)
+        self.assertEqual(mounts[0].mounted_at, "/mnt/one")
+
+
+def new_resolver():
+    resolver = HostResolver()
+    resolver.CACHE_FILE = test_folder.get_temp_filename("host_cache.json")
+    return resolver
+
+
+class TestHostResolver(unittest.TestCase):
+
+    @mock.patch("socket.gethostbyname")
+    def test_literal_ip_no_dns(self, gethost):
+        resolver = new_resolver()
+        self.assertEqual(resolver.resolve("10.1.1.1"), "10.1.1.1")
+        self.assertEqual(gethost.call_count, 0)
+        self.assertFalse(os.path.exists(resolver.CACHE_FILE))
+
+    @mock.patch("socket.gethostbyname", return_value="10.2.2.2")
+    def test_resolve_cached(self, gethost):
+        resolver = new_resolver()
+        self.assertEqual(resolver.resolve("myhost"), "10.2.2.2")
+        self.assertEqual(resolver.resolve("myhost"), "10.2.2.2")
+        self.assertEqual(gethost.call_count, 1)
+
+        # cache is kept on disk for the next run
+        resolver2 = HostResolver()
+        resolver2.CACHE_FILE = resolver.CACHE_FILE
+        self.assertEqual(resolver2.lookup("myhost"), "10.2.2.2")
+
+    @mock.patch("socket.gethostbyname", return_value="10.2.2.2")
+    def test_resolve_expired(self, gethost):
+        resolver = new_resolver()
+        resolver.CACHE_TTL_SECS = -1
+        resolver.resolve("myhost")
+        self.assertIsNone(resolver.lookup("myhost"))
+        resolver.resolve("myhost")
+        self.assertEqual(gethost.call_count, 2)
+
+    @mock.patch("socket.gethostbyname", side_effect=Exception("not found"))
+    def test_resolve_fails(self, gethost):
+        resolver = new_resolver()
+        self.assertIsNone(resolver.resolve("myhost"))
+        self.assertEqual(len(resolver.cache), 0)
+
+    @mock.patch("socket.gethostbyname", side_effect=lambda h: "10.0.0." + h[4:])
+    def test_resolve_all_max_entries(self, gethost):
+        resolver = new_resolver()
+        resolver.CACHE_MAX_ENTRIES = 5
+        hosts = ["host%d" % i for i in range(10)]
+        ips = resolver.resolve_all(hosts + ["1.1.1.1", "host1"])
+        self.assertEqual(gethost.call_count, 10)
+        self.assertEqual(ips["host3"], "10.0.0.3")
+        self.assertEqual(ips["1.1.1.1"], "1.1.1.1")
+        self.assertEqual(len(resolver.cache), 5)
+
+    def test_load_nfs_mounts_resolves_hosts_once(self):
+        fname = test_folder.get_temp_filename("mountinfo")
+        write_file(fname, "".join(
+            "%d 28 0:49 / /mnt/%d rw - nfs4 myhost:/path%d rw\n" % (i, i, i) for i in range(3)))
+        resolver = new_resolver()
+        with mock.patch("common.NfsMount.MOUNT_INFO_FILE", fname):
+            with mock.patch("common.HostResolver.resolver_obj", resolver):
+                with mock.patch("socket.gethostbyname", return_value="10.2.2.2") as gethost:
+                    mounts = NfsMount().load_nfs_mounts()
+                    self.assertEqual(gethost.call_count, 1)
+        self.assertEqual(len(mounts), 3)
+        self.assertEqual(mounts[2].ip, "10.2.2.2")
+
+
+class TestMountInventory(unittest.TestCase):
+
+    def test_index(self):
+        inv = MountInventory([MountRecord("1.1.1.1", "/p1", "/mnt/1", None),
+                              MountRecord("1.1.1.1", "/p2", "/mnt/2", None),
+                              NfsMount("2.2.2.2", "/p1", "/mnt/3")])
+        self.assertEqual(len(inv), 3)
+        self.assertEqual(inv.find("1.1.1.1", "/p2").mounted_at, "/mnt/2")
+        self.assertIsNone(inv.find("2.2.2.2", "/p2"))
+        self.assertTrue(inv.has_ip("2.2.2.2"))
+        self.assertFalse(inv.has_ip("3.3.3.3"))
+        self.assertEqual(inv.get_ips(), set(["1.1.1.1", "2.2.2.2"]))
+
+    def test_load_shared(self):
+        MountInventory.reset()
+        with mock.patch("common.NfsMount.load_nfs_mounts",
+                        return_value=[MountRecord("1.1.1.1", "/p1", "/mnt/1", None)]) as load:
+            inv = MountInventory.load()
+            self.assertIs(MountInventory.load(), inv)
+            self.assertEqual(load.call_count, 1)
+            self.assertIsNot(MountInventory.load(refresh=True), inv)
+        MountInventory.reset()
+
+    def test_load_fails(self):
+        MountInventory.reset()
+        with mock.patch("common.NfsMount.load_nfs_mounts", return_value=None):
+            self.assertIsNone(MountInventory.load())
+
+
+def new_state_cache():
+    cache = StateCache()
+    cache.CACHE_FILE = test_folder.get_temp_filename("state.bin")
+    return cache
+
+
+@mock.patch("common.LocalInstall.exists", return_value=True)
+class TestStateCache(unittest.TestCase):
+
+    def test_store_lookup(self, exists):
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        self.assertIsNone(cache.lookup("key1", fname))
+        self.assertTrue(cache.store("key1", fname, "value1"))
+        self.assertTrue(cache.store("key2", fname, "value2"))
+        self.assertEqual(cache.lookup("key1", fname), "value1")
+        self.assertEqual(cache.lookup("key2", fname), "value2")
+        self.assertEqual(os.path.getsize(cache.CACHE_FILE), cache.file_size())
+
+        # shared with the next run
+        cache2 = StateCache()
+        cache2.CACHE_FILE = cache.CACHE_FILE
+        self.assertEqual(cache2.lookup("key1", fname), "value1")
+
+    def test_file_changed(self, exists):
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        cache.store("key1", fname, "value1")
+        write_file(fname, "new data")
+        self.assertIsNone(cache.lookup("key1", fname))
+        os.remove(fname)
+        self.assertIsNone(cache.lookup("key1", fname))
+
+    def test_max_age(self, exists):
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        cache.store("key1", fname, "value1")
+        self.assertEqual(cache.lookup("key1", fname, 60), "value1")
+        self.assertIsNone(cache.lookup("key1", fname, -1))
+
+    def test_reboot_invalidates(self, exists):
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        cache.store("key1", fname, "value1")
+        cache.boot_id = b"1" * 16
+        self.assertIsNone(cache.lookup("key1", fname))
+
+    def test_bad_file_replaced(self, exists):
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        write_file(cache.CACHE_FILE, "")
+        self.assertIsNone(cache.lookup("key1", fname))
+        self.assertTrue(cache.store("key1", fname, "value1"))
+        self.assertEqual(cache.lookup("key1", fname), "value1")
+
+    def test_remove(self, exists):
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        cache.store("key1", fname, "value1")
+        cache.store("key2", fname, "value2")
+        self.assertTrue(cache.remove("key1"))
+        self.assertFalse(cache.remove("key1"))
+        self.assertIsNone(cache.lookup("key1", fname))
+        self.assertEqual(cache.lookup("key2", fname), "value2")
+
+    def test_same_slot(self, exists):
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        slot = StateCache.key_hash("key0") % cache.SLOTS
+        keys = ["key0"] + [key for key in ["key%d" % i for i in range(1, 1000)]
+                           if StateCache.key_hash(key) % cache.SLOTS == slot][:2]
+        for key in keys:
+            self.assertTrue(cache.store(key, fname, "value " + key))
+        for key in keys:
+            self.assertEqual(cache.lookup(key, fname), "value " + key)
+        # a removed key leaves the others found
+        self.assertTrue(cache.remove(keys[0]))
+        self.assertIsNone(cache.lookup(keys[0], fname))
+        self.assertEqual(cache.lookup(keys[2], fname), "value " + keys[2])
+
+    def test_full_evicts_oldest(self, exists):
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        for i in range(cache.SLOTS):
+            cache.store("key%d" % i, fname, "value%d" % i)
+        self.assertTrue(cache.store("new", fname, "new value"))
+        self.assertIsNone(cache.lookup("key0", fname))
+        self.assertEqual(cache.lookup("new", fname), "new value")
+        for i in range(1, cache.SLOTS):
+            self.assertEqual(cache.lookup("key%d" % i, fname), "value%d" % i)
+
+    def test_value_too_long(self, exists):
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        self.assertFalse(cache.store("key1", fname, "x" * (cache.VALUE_SIZE + 1)))
+
+    def test_not_installed(self, exists):
+        exists.return_value = False
+        cache = new_state_cache()
+        fname = test_folder.get_temp_filename("fact")
+        write_file(fname, "data")
+        self.assertFalse(cache.store("key1", fname, "value1"))
+        self.assertFalse(os.path.exists(cache.CACHE_FILE))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,11 +5,16 @@
 from unittest.mock import MagicMock
 from unittest import mock
 import unittest
+import ipaddress
 import os
 import time
+import threading
 import config
+import crypto_profile
+import vici
 from  common import *
 from test_common import *
+from vici_server import ViciServer
 
 
 MY_STRONGSWAN_CONFIG = """
@@ -58,6 +63,7 @@ def ss_setup(mins=0):
     ss.SetDebugEnabled()
     ss.CLEANUP_FILE_MIN_AGE_MINS = mins
     ss.flatten_paths(test_folder.name)
+    ss.CHARON_SOCKET = make_test_filename("charon.vici")
     ss.get_config_template_text = MagicMock()
     ss.get_config_template_text.return_value = MY_STRONGSWAN_CONFIG
     return ss, []
@@ -79,6 +85,38 @@ class TestConfigOther(unittest.TestCase):
         ss.cleanup_unused_configs(mounts)
         self.assertFalse(os.path.exists(my_file))
 
+    def test_cleanup_unused_configs_inventory(self):
+        ip = random_ip()
+        ss, _ = ss_setup()
+        my_file = create_file(ip)
+        other_file = create_file()
+        mounts = MountInventory([MountRecord(ip, "/path1", "here", None)])
+        self.assertTrue(ss.cleanup_unused_configs(mounts))
+        self.assertTrue(os.path.exists(my_file))
+        self.assertFalse(os.path.exists(other_file))
+
+    def test_cleanup_unused_configs_mounts_unknown(self):
+        ss, _ = ss_setup()
+        my_file = create_file()
+        with mock.patch("common.MountInventory.load", return_value=None):
+            self.assertTrue(ss.cleanup_unused_configs(None))
+        self.assertTrue(os.path.exists(my_file))
+
+    def test_cleanup_unused_configs_mounts_read_again(self):
+        ss, _ = ss_setup()
+        my_file = create_file("1.1.1.1")
+        fname = make_test_filename("mountinfo")
+        write_file(fname, "39 28 0:49 / /mnt/one rw - nfs4 1.1.1.1:/path1 rw\n")
+        MountInventory.reset()
+        with mock.patch("common.NfsMount.MOUNT_INFO_FILE", fname):
+            self.assertTrue(ss.cleanup_unused_configs(None))
+            self.assertTrue(os.path.exists(my_file))
+            # unmounted before the next retry
+            write_file(fname, "")
+            self.assertFalse(ss.cleanup_unused_configs(None))
+        self.assertFalse(os.path.exists(my_file))
+        MountInventory.reset()
+
     def test_cleanup_unused_configs_recent_file_not_removed(self):
         ss, mounts = ss_setup(5)
         my_file = create_file()
@@ -127,6 +165,133 @@ class TestConfigOther(unittest.TestCase):
         st_new = os.stat(my_file)
         self.assertNotEqual(st_old.st_mtime, st_new.st_mtime)
 
+    def test_create_cfg_crypto_profile(self):
+        ss, _ = ss_setup()
+        ss.get_config_template_text.return_value = config.StrongSwanConfig.IPSEC_CONFIG_TEXT
+        ss.create_config("1.1.1.1")
+        txt = read_file(make_cfg_file_name("1.1.1.1"))
+        self.assertIn("esp_proposals = aes256gcm16\n", txt)
+        self.assertIn("proposals = aes256-sha384-ecp384\n", txt)
+        self.assertIn("rekey_bytes = 0\n            }", txt)
+        self.assertNotIn("<", txt)
+
+        ss.crypto = crypto_profile.CryptoProfile.PROFILES["aes128"]
+        ss.create_config("2.2.2.2")
+        txt = read_file(make_cfg_file_name("2.2.2.2"))
+        self.assertIn("esp_proposals = aes128gcm16,aes256gcm16\n", txt)
+        self.assertIn("rekey_bytes = 0\n                replay_window = 1024\n"
+                      "                hw_offload = auto\n            }", txt)
+        conn = vici.SwanctlConf.parse(txt)["connections"]["ibmshare-ipsec-to-2-2-2-2"]
+        self.assertEqual(conn["children"]["ibmshare-ipsec-to-2-2-2-2"]["hw_offload"], "auto")
+
+    def test_create_cfg_encap(self):
+        ss, _ = ss_setup()
+        ss.get_config_template_text.return_value = config.StrongSwanConfig.IPSEC_CONFIG_TEXT
+        ss.create_config("1.1.1.1")
+        self.assertIn("encap = yes\n", read_file(make_cfg_file_name("1.1.1.1")))
+
+        def share_conf(name, default):
+            return {"udp_encap": "auto", "udp_encap_hosts": "2.2.2.2:yes,3.3.3.3:bad"}[name]
+        with mock.patch("common.ShareConfig.get_str", side_effect=share_conf):
+            self.assertFalse(ss.is_encap("1.1.1.1"))
+            self.assertTrue(ss.is_encap("2.2.2.2"))
+            self.assertFalse(ss.is_encap("2.2.2.22"))
+            ss.EnableLogStore()
+            self.assertTrue(ss.is_encap("3.3.3.3"))
+            self.assertTrue(ss.HasLogMessage("Invalid udp_encap: bad"))
+            ss.create_config("1.1.1.1")
+        self.assertIn("encap = no\n", read_file(make_cfg_file_name("1.1.1.1")))
+
+    def test_create_cfg_subnet(self):
+        ss, _ = ss_setup()
+        ss.subnets = [ipaddress.ip_network("10.240.0.0/24")]
+        ss.create_config("10.240.0.5")
+        ss.create_config("10.240.0.6")
+        ss.create_config("10.240.1.5")
+        name = "ibmshare-ipsec-to-10-240-0-0-24"
+        self.assertEqual(ss.connection_name("10.240.0.6"), name)
+        self.assertEqual(ss.conn_changes, {"10.240.0.0_24": True, "10.240.1.5": True})
+        my_file = make_cfg_file_name("10.240.0.0_24")
+        txt = read_file(my_file)
+        self.assertIn(name + " {", txt)
+        self.assertIn("remote_ts = 10.240.0.0/24[tcp/2049]", txt)
+        self.assertIn("remote_addrs = 10.240.0.0/24", txt)
+        self.assertFalse(os.path.exists(make_cfg_file_name("10.240.0.5")))
+        self.assertFalse(ss.connect("10.240.0.5"))
+
+        # shared - not removed for one server
+        ss.remove_config("10.240.0.5")
+        self.assertTrue(os.path.exists(my_file))
+        mounts = MountInventory([MountRecord("10.240.0.6", "/path1", "here", None)])
+        ss.cleanup_unused_configs(mounts)
+        self.assertTrue(os.path.exists(my_file))
+        self.assertFalse(os.path.exists(make_cfg_file_name("10.240.1.5")))
+        mounts = MountInventory([MountRecord("10.240.1.6", "/path1", "here", None)])
+        ss.cleanup_unused_configs(mounts)
+        self.assertFalse(os.path.exists(my_file))
+        self.assertEqual(ss.conn_changes, {"10.240.0.0_24": False, "10.240.1.5": False})
+
+    def test_server_config_before_subnet(self):
+        ss, _ = ss_setup()
+        write_file(ss.cert_filename(), TEST_CERT)
+        ss.create_config("10.240.0.5")
+        ss.subnets = [ipaddress.ip_network("10.240.0.0/24")]
+        ss.create_config("10.240.0.6")
+        old_file = make_cfg_file_name("10.240.0.5")
+        with ViciServer(ss.CHARON_SOCKET) as server:
+            self.assertTrue(ss.reload_config())
+            self.assertEqual(ss.get_config("10.240.0.5"), old_file)
+            ss.cleanup_unused_configs(MountInventory())
+            self.assertFalse(os.path.exists(old_file))
+            self.assertFalse(os.path.exists(make_cfg_file_name("10.240.0.0_24")))
+            self.assertEqual(ss.conn_changes, {"10.240.0.0_24": False, "10.240.0.5": False})
+            self.assertTrue(ss.reload_config())
+            self.assertEqual(list(server.conns), [])
+
+    def test_subnets_share_conf(self):
+        ss, _ = ss_setup()
+        ss.EnableLogStore()
+        with mock.patch("common.ShareConfig.get_str", return_value="10.240.0.0/24,bad,10.240.64.9/18"):
+            self.assertEqual(ss.config_key("10.240.0.9"), "10.240.0.0_24")
+            self.assertEqual(ss.config_key("10.240.100.1"), "10.240.64.0_18")
+            self.assertEqual(ss.config_key("10.241.0.1"), "10.241.0.1")
+        self.assertTrue(ss.HasLogMessage("Invalid ipsec_subnets entry: bad"))
+
+    def test_create_cfg_rekey_jitter(self):
+        ss, _ = ss_setup()
+        ss.get_config_template_text.return_value = config.StrongSwanConfig.IPSEC_CONFIG_TEXT
+        ss.MACHINE_ID_FILE = make_test_filename("machine-id")
+        write_file(ss.MACHINE_ID_FILE, "host1\n")
+        offsets = set()
+        for ip in ["1.1.1.%d" % n for n in range(1, 9)]:
+            ss.create_config(ip)
+            conn = vici.SwanctlConf.parse(read_file(make_cfg_file_name(ip)))["connections"]
+            conn = conn[ss.connection_name(ip)]
+            child = conn["children"][ss.connection_name(ip)]
+            for secs in [int(conn["rekey_time"]), int(child["rekey_time"])]:
+                self.assertGreater(secs, 3600 - 600)
+                self.assertLessEqual(secs, 3600)
+            self.assertEqual(conn["rand_time"], "300")
+            self.assertEqual(child["rekey_bytes"], "0")
+            self.assertNotIn("rand_bytes", child)
+            offsets.add(conn["rekey_time"])
+        self.assertGreater(len(offsets), 1)
+
+        # unchanged for the host, differs on another host
+        ss.EnableLogStore()
+        ss.create_config("1.1.1.1")
+        self.assertTrue(ss.HasLogMessage("Config data unchanged"))
+        offset = ss.rekey_offset("conn1")
+        write_file(ss.MACHINE_ID_FILE, "host2\n")
+        self.assertNotEqual(ss.rekey_offset("conn1"), offset)
+
+        with mock.patch("common.ShareConfig.get_int", return_value=10000000000):
+            ss.create_config("2.2.2.2")
+        child = vici.SwanctlConf.parse(read_file(make_cfg_file_name("2.2.2.2")))["connections"]
+        child = child[ss.connection_name("2.2.2.2")]["children"][ss.connection_name("2.2.2.2")]
+        self.assertEqual(child["rekey_bytes"], "10000000000")
+        self.assertEqual(child["rand_bytes"], "1000000000")
+
     def test_reload_certs_error(self):
         with MySubProcess(-99, ""):
             ss, _ = ss_setup(True)
@@ -164,6 +329,253 @@ class TestConfigOther(unittest.TestCase):
             self.assertFalse(ss.is_reload)
             self.assertTrue(SysApp.is_none())
 
+    def test_is_connection_loaded(self):
+        ss, _ = ss_setup()
+        conns = ("ibmshare-ipsec-to-1-1-1-1: IKEv2, no reauthentication, rekeying every 3600s\n"
+                 "  local:  %any\n"
+                 "  ibmshare-ipsec-to-1-1-1-1: TRANSPORT, rekeying every 3600s\n"
+                 "ibmshare-ipsec-to-2-2-2-2: IKEv2, no reauthentication\n")
+        ss.RunCmd = MagicMock(return_value=SubProcess([]).set_output(0, conns.encode(), b""))
+        self.assertTrue(ss.is_connection_loaded(["1.1.1.1", "2.2.2.2"]))
+        self.assertFalse(ss.is_connection_loaded(["1.1.1.1", "3.3.3.3"]))
+        ss.RunCmd.return_value = None
+        self.assertFalse(ss.is_connection_loaded(["1.1.1.1"]))
+
+    @mock.patch("common.LocalInstall.exists", return_value=True)
+    def test_write_cert_drops_cached(self, exists):
+        ss, _ = ss_setup()
+        cache = StateCache()
+        cache.CACHE_FILE = test_folder.get_temp_filename("state.bin")
+        with mock.patch("common.StateCache.state_obj", cache):
+            fname = ss.cert_filename()
+            ss.write_cert(fname, TEST_CERT)
+            cache.store(StateCache.file_key("x509", fname), fname, "fields")
+            ss.write_cert(fname, TEST_CERT)
+            self.assertEqual(cache.lookup(StateCache.file_key("x509", fname), fname), "fields")
+            ss.write_cert(fname, TEST_CERT + "\n")
+            self.assertIsNone(cache.lookup(StateCache.file_key("x509", fname), fname))
+
+    def test_reload_config_vici(self):
+        ss, _ = ss_setup()
+        ss.write_cert(ss.cert_filename(), TEST_CERT)
+        ss.write_cert(ss.private_key_filename(), TEST_PRIVATE_KEY)
+        ss.create_config("1.1.1.1")
+        ss.create_config("2.2.2.2")
+        self.assertTrue(ss.is_full_reload)
+        with ViciServer(ss.CHARON_SOCKET) as server:
+            server.conns["ibmshare-ipsec-to-3-3-3-3"] = {}
+            server.conns["user-conn"] = {}
+            with MySubProcess(0, "") as run:
+                self.assertTrue(ss.reload_config())
+                self.assertEqual(run.func.call_count, 0)
+            self.assertFalse(ss.is_reload)
+            self.assertEqual(list(server.conns), ["user-conn",
+                                                  "ibmshare-ipsec-to-1-1-1-1",
+                                                  "ibmshare-ipsec-to-2-2-2-2"])
+            conn = server.conns["ibmshare-ipsec-to-1-1-1-1"]
+            self.assertEqual(conn["remote_addrs"], ["1.1.1.1"])
+            self.assertEqual(conn["local"]["certs"], [TEST_CERT])
+            self.assertEqual(len(server.certs), 1)
+            self.assertEqual(len(server.keys), 1)
+            self.assertTrue(ss.is_connection_loaded(["1.1.1.1", "2.2.2.2"]))
+            self.assertTrue(ss.list_connections())
+
+    def test_reload_config_vici_incremental(self):
+        ss, _ = ss_setup()
+        write_file(ss.cert_filename(), TEST_CERT)
+        ss.create_config("1.1.1.1")
+        ss.create_config("2.2.2.2")
+        with ViciServer(ss.CHARON_SOCKET) as server:
+            self.assertTrue(ss.reload_config())
+            # the charon drop-in is new as well
+            self.assertEqual(server.commands, ["load-conn", "load-conn", "reload-settings"])
+            self.assertEqual(ss.conn_changes, {})
+
+            # unchanged config - nothing to do
+            ss.create_config("1.1.1.1")
+            self.assertFalse(ss.is_reload)
+
+            server.commands = []
+            ss.remove_config("1.1.1.1")
+            ss.remove_config("2.2.2.2")
+            ss.create_config("3.3.3.3")
+            self.assertTrue(ss.reload_config())
+            self.assertEqual(server.commands, ["get-conns", "unload-conn",
+                                               "unload-conn", "load-conn"])
+            self.assertEqual(list(server.conns), ["ibmshare-ipsec-to-3-3-3-3"])
+            self.assertEqual(len(server.certs), 0)
+
+    def test_load_missing_connections(self):
+        ss, _ = ss_setup()
+        write_file(ss.cert_filename(), TEST_CERT)
+        ss.create_config("1.1.1.1")
+        ss.create_config("2.2.2.2")
+        with ViciServer(ss.CHARON_SOCKET) as server:
+            ss.reload_config()
+            ss.load_missing_connections(["1.1.1.1", "2.2.2.2"])
+            self.assertFalse(ss.is_reload)
+
+            # charon restarted
+            server.conns.clear()
+            ss.load_missing_connections(["1.1.1.1", "2.2.2.2"])
+            self.assertEqual(ss.conn_changes, {"1.1.1.1": True, "2.2.2.2": True})
+            self.assertTrue(ss.reload_config())
+            self.assertEqual(len(server.conns), 2)
+
+    def test_load_missing_connections_creds(self):
+        ss, _ = ss_setup()
+        ss.write_cert(ss.cert_filename(), TEST_CERT)
+        ss.write_cert(ss.private_key_filename(), TEST_PRIVATE_KEY)
+        ss.create_config("1.1.1.1")
+        with ViciServer(ss.CHARON_SOCKET) as server:
+            self.assertTrue(ss.reload_config())
+        # restarted charon without the conns, the key or the certs
+        with ViciServer(ss.CHARON_SOCKET) as server:
+            ss.load_missing_connections(["1.1.1.1"])
+            self.assertTrue(ss.reload_config())
+            self.assertEqual(list(server.conns), ["ibmshare-ipsec-to-1-1-1-1"])
+            self.assertEqual(len(server.certs), 1)
+            self.assertEqual(len(server.keys), 1)
+
+    def test_charon_tuning_text(self):
+        ss, _ = ss_setup()
+        settings = vici.SwanctlConf.parse(ss.charon_tuning_text(3, 2))["charon"]
+        self.assertEqual(settings["threads"], "22")
+        self.assertEqual(settings["ikesa_table_size"], "32")
+        self.assertEqual(settings["ikesa_table_segments"], "2")
+        self.assertEqual(settings["make_before_break"], "yes")
+        settings = vici.SwanctlConf.parse(ss.charon_tuning_text(300, 48))["charon"]
+        self.assertEqual(settings["threads"], "64")
+        self.assertEqual(settings["ikesa_table_size"], "1024")
+        self.assertEqual(settings["ikesa_table_segments"], "64")
+        # same size bucket - same file
+        self.assertEqual(ss.charon_tuning_text(17, 4), ss.charon_tuning_text(32, 4))
+
+    def test_charon_tuning_setup(self):
+        ss, _ = ss_setup()
+        ss.start = MagicMock(return_value=True)
+        fname = ss.charon_tuning_filename()
+        self.assertTrue(ss.setup())
+        self.assertIn("ikesa_table_size = 32", read_file(fname))
+        self.assertFalse(ss.write_charon_tuning())
+
+        # resized once the connections grow, with the reload
+        for n in range(1, 18):
+            ss.create_config("1.1.1.%d" % n)
+        with MySubProcess(0, ""):
+            self.assertTrue(ss.reload_config())
+        self.assertIn("ikesa_table_size = 64", read_file(fname))
+        ss.remove_all_configs()
+        self.assertFalse(os.path.exists(fname))
+
+        # strongswan not installed
+        ss.SETTINGS_PATH = make_test_filename("not_exists")
+        self.assertFalse(ss.write_charon_tuning())
+
+    def test_charon_tuning_reload(self):
+        ss, _ = ss_setup()
+        write_file(ss.cert_filename(), TEST_CERT)
+        fname = ss.charon_tuning_filename()
+        ss.create_config("1.1.1.1")
+        with ViciServer(ss.CHARON_SOCKET) as server:
+            self.assertTrue(ss.reload_config())
+            self.assertIn("ikesa_table_size = 32", read_file(fname))
+            self.assertEqual(server.commands[-1], "reload-settings")
+
+            # same size - no settings reload
+            server.commands = []
+            ss.create_config("2.2.2.2")
+            self.assertTrue(ss.reload_config())
+            self.assertEqual(server.commands, ["load-conn"])
+
+    def test_start_already_running(self):
+        ss, _ = ss_setup()
+        with ViciServer(ss.CHARON_SOCKET):
+            with MySubProcess(0, "active") as run:
+                self.assertTrue(ss.start())
+                self.assertEqual(run.func.call_count, 0)
+
+    def test_start_waits_for_socket(self):
+        ss, _ = ss_setup()
+        ss.list_connections = MagicMock(return_value=False)
+        server = ViciServer(ss.CHARON_SOCKET)
+        timer = threading.Timer(0.2, server.start)
+        timer.start()
+        try:
+            with MySubProcess(0, "active") as run:
+                started = time.time()
+                self.assertTrue(ss.start(max_secs=5))
+                self.assertLess(time.time() - started, 1)
+                # systemctl is-active only
+                self.assertEqual(run.func.call_count, 1)
+        finally:
+            timer.join()
+            server.stop()
+
+    def test_start_timeout(self):
+        ss, _ = ss_setup()
+        ss.list_connections = MagicMock(return_value=False)
+        with MySubProcess(0, "active"):
+            self.assertFalse(ss.start(max_secs=0.2))
+
+    def test_start_no_socket(self):
+        ss, _ = ss_setup()
+        # swanctl --list-conns answers
+        with MySubProcess(0, "") as run, \
+                mock.patch.object(ss, "list_connections", wraps=ss.list_connections) as list_conns:
+            self.assertTrue(ss.start(max_secs=0.2))
+            self.assertEqual(run.func.call_count, 1)
+            self.assertEqual(list_conns.call_count, 1)
+
+    def test_charon_socket(self):
+        found = {"/run/strongswan/charon.vici"}
+        with mock.patch("os.path.exists", side_effect=lambda path: path in found):
+            self.assertEqual(config.StrongSwanConfig.charon_socket(), "/run/strongswan/charon.vici")
+            # not running - the one of the install layout
+            found = {"/etc/swanctl"}
+            self.assertEqual(config.StrongSwanConfig.charon_socket(), "/var/run/charon.vici")
+            found = set()
+            self.assertEqual(config.StrongSwanConfig.charon_socket(), "/run/strongswan/charon.vici")
+
+    def test_connect(self):
+        ss, _ = ss_setup()
+        self.assertFalse(ss.connect("1.1.1.1"))
+        write_file(ss.cert_filename(), TEST_CERT)
+        ss.create_config("1.1.1.1")
+        with ViciServer(ss.CHARON_SOCKET) as server:
+            self.assertFalse(ss.connect("1.1.1.1"))
+            ss.reload_config()
+            self.assertTrue(ss.connect("1.1.1.1", 2000))
+            self.assertIn("ibmshare-ipsec-to-1-1-1-1", server.sas)
+            # already up - not initiated again
+            self.assertTrue(ss.connect("1.1.1.1", 2000))
+            self.assertEqual(server.commands.count("initiate"), 2)
+
+    def test_reload_config_vici_fails(self):
+        ss, _ = ss_setup()
+        ss.create_config("1.1.1.1")
+        write_file(ss.cert_filename(), TEST_CERT)
+        with ViciServer(ss.CHARON_SOCKET) as server:
+            server.fail.add("load-conn")
+            ss.is_reload = True
+            self.assertFalse(ss.reload_config())
+            self.assertTrue(ss.is_reload)
+            self.assertTrue(SysApp.is_code(SysApp.ERR_IPSEC_CFG))
+
+    def test_is_running_stale_socket(self):
+        ss, _ = ss_setup()
+        # left behind by a charon crash
+        write_file(ss.CHARON_SOCKET, "")
+        ss.list_connections = MagicMock(return_value=False)
+        ss.START_POLL_MAX_SECS = 0.01
+        with MySubProcess(0, "active"), \
+                mock.patch.object(ss, "start", wraps=lambda: config.StrongSwanConfig.start(ss, 0.2)):
+            self.assertFalse(ss.is_running())
+            self.assertFalse(ss.is_running())
+            self.assertEqual(ss.start.call_count, 2)
+        with ViciServer(ss.CHARON_SOCKET):
+            self.assertTrue(ss.is_running())
+
     def test_ipsec_msg_config_ok(self):
         def ok(val):
             self.assertFalse(is_empty(val))
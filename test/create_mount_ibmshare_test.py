@@ -0,0 +1,34 @@
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+import os
+import py_compile
+import re
+import subprocess
+import sys
+import unittest
+from test_common import *
+
+ROOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MERGE_SCRIPT = os.path.join(ROOT_PATH, "scripts", "create_mount_ibmshare.py")
+# a share.conf accessor left without its object once "config." is stripped
+BARE_ACCESSOR = re.compile(r"(?<![\w.])(get_str|get_int|get_val|is_enabled)\(")
+
+
+class TestMergeScript(unittest.TestCase):
+
+    def test_merged_helper(self):
+        fname = test_folder.get_temp_filename("mount.ibmshare")
+        out = subprocess.run([sys.executable, MERGE_SCRIPT, os.path.join(ROOT_PATH, "src"), fname],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(out.returncode, 0, out.stderr)
+        py_compile.compile(fname, doraise=True)
+        with open(fname) as fd:
+            bare = [line for line in fd.read().splitlines()
+                    if BARE_ACCESSOR.search(line) and not line.strip().startswith("def ")]
+        self.assertEqual(bare, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+from unittest.mock import MagicMock
+from unittest import mock
+import unittest
+import crypto_profile
+from common import *
+from test_common import *
+
+SPEED_OUT = """version: 3.0.17
+The 'numbers' are in 1000s of bytes per second processed.
+type          16384 bytes
+AES-256-GCM    %s
+"""
+
+
+def new_profile(flags, kbps="3500000.50k", ret=0):
+    cp = crypto_profile.CryptoProfile()
+    cp.CPUINFO_FILE = test_folder.get_temp_filename("cpuinfo")
+    write_file(cp.CPUINFO_FILE, "processor\t: 0\nflags\t\t: fpu sse2 %s\n" % flags)
+    out = SubProcess([]).set_output(ret, (SPEED_OUT % kbps).encode(), b"")
+    cp.RunSilent = MagicMock(return_value=out)
+    return cp
+
+
+def new_state_cache():
+    cache = StateCache()
+    cache.CACHE_FILE = test_folder.get_temp_filename("state.bin")
+    return cache
+
+
+@mock.patch("common.LocalInstall.exists", return_value=True)
+class TestCryptoProfile(unittest.TestCase):
+
+    def test_cpu_flags(self, exists):
+        cp = new_profile("aes avx2 vaes")
+        self.assertEqual(cp.cpu_flags(), {"fpu", "sse2", "aes", "avx2", "vaes"})
+        write_file(cp.CPUINFO_FILE, "processor\t: 0\nFeatures\t: fp asimd aes pmull\n")
+        self.assertIn("aes", cp.cpu_flags())
+
+    def test_auto_vaes(self, exists):
+        cp = new_profile("aes vaes")
+        self.assertEqual(cp.get_settings("auto").name, "aes256")
+        cp.RunSilent.assert_not_called()
+
+    def test_auto_no_aes(self, exists):
+        cp = new_profile("")
+        settings = cp.get_settings("auto")
+        self.assertEqual(settings.name, "aes128")
+        self.assertEqual(settings.esp_proposals, ["aes128gcm16", "aes256gcm16"])
+        cp.RunSilent.assert_not_called()
+
+    def test_auto_benchmark(self, exists):
+        with mock.patch("common.StateCache.state_obj", new_state_cache()):
+            cp = new_profile("aes")
+            self.assertEqual(cp.get_settings("auto").name, "aes256")
+            # cached for the boot
+            self.assertEqual(cp.get_settings("auto").name, "aes256")
+            self.assertEqual(cp.RunSilent.call_count, 1)
+
+        with mock.patch("common.StateCache.state_obj", new_state_cache()):
+            cp = new_profile("aes", kbps="400000.00k")
+            self.assertEqual(cp.get_settings("auto").name, "aes128")
+            cp = new_profile("aes", ret=1)
+            self.assertEqual(cp.get_settings("auto").name, "aes128")
+
+    def test_named(self, exists):
+        cp = new_profile("")
+        settings = cp.get_settings("default")
+        self.assertEqual(settings.esp_proposals, ["aes256gcm16"])
+        self.assertIsNone(settings.replay_window)
+        self.assertFalse(settings.hw_offload)
+        settings = cp.get_settings("AES256")
+        self.assertEqual(settings.replay_window, 1024)
+        self.assertTrue(settings.hw_offload)
+
+    def test_unknown(self, exists):
+        cp = new_profile("")
+        cp.EnableLogStore()
+        self.assertEqual(cp.get_settings("fastest").name, "default")
+        self.assertTrue(cp.HasLogMessage("Crypto profile unknown"))
+
+    def test_service_proposals_only(self, exists):
+        cp = new_profile("")
+        cp.SERVICE_ESP_PROPOSALS = ["aes256gcm16"]
+        self.assertEqual(cp.get_settings("aes128").esp_proposals, ["aes256gcm16"])
+        cp.SERVICE_ESP_PROPOSALS = ["chacha20poly1305"]
+        self.assertEqual(cp.get_settings("aes128").name, "default")
+
+    def test_share_conf(self, exists):
+        cp = new_profile("")
+        with mock.patch("common.ShareConfig.get_str", return_value="aes128") as get_str:
+            self.assertEqual(cp.get_settings().name, "aes128")
+            get_str.assert_called_with("crypto_profile", "default")
+
+
+if __name__ == '__main__':
+    unittest.main()
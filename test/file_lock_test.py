@@ -4,12 +4,14 @@
 
 import file_lock
 import unittest
+from unittest import mock
 import time
 import threading
 import random
 
 BLOCK_LOCK_FILE = '/tmp/ibm_mount_helper_block.lck'
 NON_BLOCK_LOCK_FILE = '/tmp/ibm_mount_helper_non_block.lck'
+IP_LOCK_FILE = '/tmp/ibm_mount_helper_ip_%s.lck'
 
 
 class TestLockHandler(unittest.TestCase):
@@ -62,6 +64,19 @@ class TestLockHandler(unittest.TestCase):
         lh.release_lock()
         self.assertFalse(lh2.is_locked())
 
+    def test_mount_ip_lock(self):
+        with mock.patch("file_lock.LockHandler.IP_LOCK_FILE", IP_LOCK_FILE):
+            lh = file_lock.LockHandler.mount_ip_lock("1.1.1.1")
+            self.assertTrue(lh.grab_blocking_lock())
+            # other servers are not blocked
+            lh2 = file_lock.LockHandler.mount_ip_lock("2.2.2.2")
+            self.assertTrue(lh2.grab_non_blocking_lock())
+            lh2.release_lock()
+            self.assertTrue(file_lock.LockHandler.mount_ip_lock("1.1.1.1").is_locked())
+            self.assertTrue(file_lock.LockHandler.is_mount_in_progress())
+            lh.release_lock()
+            self.assertFalse(file_lock.LockHandler.is_mount_in_progress())
+
     def test_blocking_lock(self):
         completed = []
 
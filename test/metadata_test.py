@@ -120,6 +120,7 @@ class TestJsonRequest(unittest.TestCase):
             ret = req.do_request("GET")
             self.assertFalse(ret)
             self.assertTrue(req.HasLogMessage(descr))
+        self.assertEqual(req.status, 500)
 
     def test_do_request_ok(self):
         req = newJRequest(data={"field1": "val1"})
@@ -172,6 +173,13 @@ class TestMetadata(unittest.TestCase):
         self.assertTrue(ret)
         self.assertTrue(len(meta.private_key) > 0)
 
+    def test_new_private_key_ecdsa(self):
+        meta = newMetadata()
+        with mock.patch("common.ShareConfig.get_str", return_value="ecdsa-p256"):
+            self.assertTrue(meta.new_private_key())
+        self.assertEqual(meta.private_key_algorithm(meta.private_key), "ecdsa-p256")
+        self.assertTrue(meta.new_certificate_signing_request())
+
     def test_generate_csr_good(self):
         meta = newMetadata()
         meta.new_private_key()
@@ -206,6 +214,10 @@ class TestMetadata(unittest.TestCase):
         ret = meta.generate_certs()
         self.assertFalse(ret)
         self.assertEqual(req.post.call_count, 1)
+        self.assertFalse(meta.csr_rejected)
+        req.status = 400
+        self.assertFalse(meta.generate_certs())
+        self.assertTrue(meta.csr_rejected)
 
     def test_generate_certs_ok(self):
         resp = {"certificates": [
@@ -5,6 +5,8 @@
 from unittest.mock import MagicMock
 from unittest import mock
 import mount_ibmshare
+import file_lock
+import threading
 import common
 import unittest
 import sys
@@ -13,6 +15,11 @@ from renew_certs import RenewCerts
 from args_handler import ArgsHandler
 
 
+MOUNT_INFO_DATA = """23 28 0:22 / /proc rw,relatime - proc proc rw
+39 28 0:49 / /mnt/one rw,relatime shared:1 - nfs4 1.1.1.1:/path1 rw,vers=4.1
+"""
+
+
 def do_mount(ret=0, data=""):
     mo = mount_ibmshare.MountIbmshare()
     mo.is_share_mounted = MagicMock(return_value = False) 
@@ -36,14 +43,28 @@ def init_ocert(ocert, load=True, ncw=True, exp=False, rcw=True,
     ipsec = MagicMock()
     ipsec.create_config = MagicMock(return_value=create_config)
     ipsec.cleanup_unused_configs = MagicMock(return_value=cleanup_config)
+    ipsec.config_key = lambda ip: ip
     ox.get_ipsec_mgr.return_value = ipsec
     ox.ipsec = ipsec
     return ox
 
 def do_already_mounted(ret=0, data="",ip="",path=""):
     mo = mount_ibmshare.MountIbmshare()
-    with MySubProcess(ret, data) as run:
-        ret = mo.is_share_mounted(ip,path)
+    MountInventory.reset()
+    # force the mount command fallback
+    with mock.patch("common.NfsMount.MOUNT_INFO_FILE", "/proc/not/exists"):
+        with MySubProcess(ret, data) as run:
+            ret = mo.is_share_mounted(ip,path)
+    return mo, ret
+
+
+def do_already_mounted_info(data, ip="", path="", early_exit=False):
+    mo = mount_ibmshare.MountIbmshare()
+    MountInventory.reset()
+    fname = test_folder.get_temp_filename("mountinfo")
+    write_file(fname, data)
+    with mock.patch("common.NfsMount.MOUNT_INFO_FILE", fname):
+        ret = mo.is_share_mounted(ip, path, early_exit)
     return mo, ret
 
 
@@ -54,7 +75,7 @@ class TestMountIbmshareOther(unittest.TestCase):
         mo, ret = do_already_mounted(data=data)
         self.assertFalse(ret)
         self.assertEqual(len(mo.mounts), 1)
-        mount = mo.mounts[0]
+        mount = list(mo.mounts)[0]
         self.assertTrue(mount.ip == "1.1.1.1")
         self.assertTrue(mount.mount_path == "mount_path")
         self.assertTrue(mount.mounted_at == "mounted_at")
@@ -74,6 +95,33 @@ class TestMountIbmshareOther(unittest.TestCase):
         mo, ret = do_already_mounted()
         self.assertFalse(ret)
 
+    def test_is_share_mounted_mount_info(self):
+        data = MOUNT_INFO_DATA + \
+            "40 28 0:50 / /mnt/two rw - nfs4 2.2.2.2:/path2 rw,vers=4.1\n"
+        mo, ret = do_already_mounted_info(data, '1.1.1.1', "/path1")
+        self.assertTrue(ret)
+        self.assertEqual(len(mo.mounts), 2)
+        self.assertTrue(mo.mounts.has_ip('2.2.2.2'))
+
+    def test_is_share_mounted_early_exit(self):
+        data = MOUNT_INFO_DATA + \
+            "40 28 0:50 / /mnt/two rw - nfs4 2.2.2.2:/path2 rw,vers=4.1\n"
+        mo, ret = do_already_mounted_info(data, '1.1.1.1', "/path1", early_exit=True)
+        self.assertTrue(ret)
+        # table read up to the share, not kept as the inventory
+        self.assertEqual(len(mo.mounts), 1)
+        self.assertIsNone(MountInventory.inventory_obj)
+
+        mo, ret = do_already_mounted_info(data, '3.3.3.3', "/path3", early_exit=True)
+        self.assertFalse(ret)
+        self.assertEqual(len(mo.mounts), 2)
+        self.assertIs(MountInventory.inventory_obj, mo.mounts)
+
+    def test_share_not_mounted_mount_info(self):
+        mo, ret = do_already_mounted_info(MOUNT_INFO_DATA, '1.1.1.1', "/path2")
+        self.assertFalse(ret)
+        self.assertEqual(len(mo.mounts), 1)
+
     @mock.patch('sys.argv', ["invalid", "args"])
     def test_mount_invalid_args(self):
         mo = mount_ibmshare.MountIbmshare()
@@ -145,6 +193,213 @@ class TestMountIbmshare(unittest.TestCase):
         self.assertTrue(ret)
         o.ipsec.cleanup_unused_configs.assert_called_with([])
 
+    def test_mount_loads_missing_connections(self, ocert):
+        o = init_ocert(ocert)
+        _, ret = do_mount()
+        self.assertTrue(ret)
+        o.ipsec.load_missing_connections.assert_called_with(["192.168.56.1"])
+        self.assertEqual(o.ipsec.reload_config.call_count, 1)
+
+    @mock.patch("common.ShareConfig.is_enabled", return_value=True)
+    @mock.patch("common.ShareConfig.get_int", return_value=5)
+    @mock.patch("sa_metrics.SaMetrics.record_connect")
+    def test_preconnect(self, record, get_int, is_enabled, ocert):
+        o = init_ocert(ocert)
+        o.ipsec.connection_name.return_value = "conn1"
+        mo, ret = do_mount()
+        self.assertTrue(ret)
+        is_enabled.assert_any_call("preconnect")
+        o.ipsec.connect.assert_called_with("192.168.56.1", 5000)
+        self.assertEqual(mo.preconnects, [])
+        self.assertEqual(record.call_args[0][0], "conn1")
+
+    @mock.patch("common.ShareConfig.is_enabled", return_value=True)
+    @mock.patch("common.ShareConfig.get_int", return_value=5)
+    @mock.patch("sa_metrics.SaMetrics.record_connect")
+    def test_preconnect_loaded_before_certs(self, record, get_int, is_enabled, ocert):
+        o = init_ocert(ocert)
+        o.ipsec.connection_name.return_value = "conn1"
+        o.ipsec.get_loaded_connections.return_value = {"conn1"}
+        calls = []
+        started = threading.Event()
+        o.ipsec.connect.side_effect = lambda ip, timeout_ms: calls.append("connect") or started.set()
+        o.load_certificate.side_effect = lambda: (started.wait(5) and calls.append("certs")) or True
+        with mock.patch("mount_ibmshare.MountIbmshare.get_ipsec_mgr", return_value=o.ipsec):
+            _, ret = do_mount()
+        self.assertTrue(ret)
+        # started once, ahead of the cert check
+        self.assertEqual(calls, ["connect", "certs"])
+
+    @mock.patch("common.ShareConfig.is_enabled", return_value=True)
+    @mock.patch("common.ShareConfig.get_int", return_value=5)
+    @mock.patch("sa_metrics.SaMetrics.record_connect")
+    def test_preconnect_not_loaded_after_reload(self, record, get_int, is_enabled, ocert):
+        o = init_ocert(ocert)
+        o.ipsec.connection_name.return_value = "conn1"
+        o.ipsec.get_loaded_connections.return_value = set()
+        calls = []
+        o.ipsec.connect.side_effect = lambda ip, timeout_ms: calls.append("connect")
+        o.ipsec.reload_config.side_effect = lambda: calls.append("reload") or True
+        with mock.patch("mount_ibmshare.MountIbmshare.get_ipsec_mgr", return_value=o.ipsec):
+            _, ret = do_mount()
+        self.assertTrue(ret)
+        self.assertEqual(calls, ["reload", "connect"])
+
+    @mock.patch("common.ShareConfig.is_enabled", return_value=True)
+    @mock.patch("common.ShareConfig.get_int", return_value=0)
+    @mock.patch("sa_metrics.SaMetrics.record_connect")
+    def test_preconnect_wait_bounded(self, record, get_int, is_enabled, ocert):
+        o = init_ocert(ocert)
+        done = threading.Event()
+        o.ipsec.connect.side_effect = lambda ip, timeout_ms: done.wait(10)
+        mo, ret = do_mount()
+        self.assertTrue(ret)
+        self.assertTrue(mo.HasLogMessage("IKE SA not up in 0s"))
+        done.set()
+
+    @mock.patch("common.ShareConfig.is_enabled", side_effect=lambda name: name == "watch_mounts")
+    @mock.patch("sa_metrics.SaMetrics.record_trap")
+    def test_trap_recorded(self, record_trap, is_enabled, ocert):
+        o = init_ocert(ocert)
+        o.ipsec.connection_name.return_value = "conn1"
+        _, ret = do_mount()
+        self.assertTrue(ret)
+        self.assertEqual(o.ipsec.connect.call_count, 0)
+        record_trap.assert_called_with(["conn1"])
+
+    @mock.patch("common.ShareConfig.is_enabled", return_value=False)
+    def test_preconnect_disabled(self, is_enabled, ocert):
+        o = init_ocert(ocert)
+        _, ret = do_mount()
+        self.assertTrue(ret)
+        self.assertEqual(o.ipsec.connect.call_count, 0)
+
+    def test_host_lock_free_during_mount(self, ocert):
+        init_ocert(ocert)
+        locks = []
+
+        def run_mount(args):
+            locks.append(file_lock.LockHandler.mount_share_lock().is_locked())
+            locks.append(file_lock.LockHandler.mount_ip_lock(args.ip_address).is_locked())
+            return True
+
+        with mock.patch("mount_ibmshare.MountIbmshare.run_mount", side_effect=run_mount):
+            mo, ret = do_mount()
+        self.assertTrue(ret)
+        self.assertEqual(locks, [False, True])
+        self.assertEqual(mo.ip_locks, [])
+
+
+
+BATCH_ARGV = ["app", "-MOUNT_BATCH", "-o", "secure=true",
+              "192.168.56.1:/share1", "/media/test1",
+              "192.168.56.1:/share2", "/media/test2",
+              "192.168.56.2:/share3", "/media/test3"]
+
+
+def do_mount_batch(ret=0, data="", mounted=None):
+    mo = mount_ibmshare.MountIbmshare()
+    mo.mounts = MountInventory(mounted)
+    mo.is_share_mounted = MagicMock(
+        side_effect=lambda ip, path: mo.mounts.find(ip, path) is not None)
+    mo.EnableLogStore()
+    with MySubProcess(ret, data) as run:
+        shares = ArgsHandler.get_batch_mount_args()
+        out = mo.mount_batch(shares)
+        mo._run = run
+    return mo, out
+
+
+@mock.patch('sys.argv', BATCH_ARGV)
+@mock.patch('mount_ibmshare.RenewCerts')
+class TestMountIbmshareBatch(unittest.TestCase):
+
+    def test_mount_batch_ok(self, ocert):
+        o = init_ocert(ocert)
+        mo, ret = do_mount_batch()
+        self.assertTrue(ret)
+        # one mount command per share
+        self.assertEqual(mo._run.func.call_count, 3)
+        # certs checked and ipsec reloaded once
+        self.assertEqual(o.load_certificate.call_count, 1)
+        self.assertEqual(o.ipsec.is_running.call_count, 1)
+        self.assertEqual(o.ipsec.reload_config.call_count, 1)
+        self.assertEqual(o.ipsec.cleanup_unused_configs.call_count, 1)
+        o.ipsec.create_config.assert_has_calls(
+            [mock.call("192.168.56.1"), mock.call("192.168.56.2")])
+        self.assertEqual(o.ipsec.create_config.call_count, 2)
+
+    def test_mount_batch_config_removed_meanwhile(self, ocert):
+        o = init_ocert(ocert)
+        o.ipsec.get_config.return_value = None
+        mo, ret = do_mount_batch()
+        self.assertTrue(ret)
+        # written again under the host lock before the reload
+        self.assertEqual(o.ipsec.create_config.call_count, 4)
+
+    def test_mount_batch_skips_mounted(self, ocert):
+        o = init_ocert(ocert)
+        mounted = [MountRecord("192.168.56.1", "/share1", "/media/test1", None)]
+        mo, ret = do_mount_batch(mounted=mounted)
+        self.assertTrue(ret)
+        self.assertEqual(mo._run.func.call_count, 2)
+
+    def test_mount_batch_all_mounted(self, ocert):
+        o = init_ocert(ocert)
+        mounted = [MountRecord("192.168.56.1", "/share1", "/media/test1", None),
+                   MountRecord("192.168.56.1", "/share2", "/media/test2", None),
+                   MountRecord("192.168.56.2", "/share3", "/media/test3", None)]
+        mo, ret = do_mount_batch(mounted=mounted)
+        self.assertTrue(ret)
+        self.assertEqual(o.load_certificate.call_count, 0)
+        self.assertEqual(mo._run.func.call_count, 0)
+
+    def test_mount_batch_config_fails(self, ocert):
+        o = init_ocert(ocert, create_config=False)
+        mo, ret = do_mount_batch()
+        self.assertFalse(ret)
+        self.assertEqual(mo._run.func.call_count, 0)
+
+    def test_mount_batch_mount_fails(self, ocert):
+        init_ocert(ocert)
+        mo, ret = do_mount_batch(ret=32)
+        self.assertFalse(ret)
+        self.assertEqual(mo._run.func.call_count, 3)
+        self.assertTrue(SysApp.is_code(SysApp.ERR_MOUNT + 32))
+
+    def test_mount_batch_first_failure_code(self, ocert):
+        init_ocert(ocert)
+        mo = mount_ibmshare.MountIbmshare()
+        mo.is_share_mounted = MagicMock(return_value=False)
+        shares = ArgsHandler.get_batch_mount_args()
+
+        def run_cmd(cmd, descr, ret_out):
+            ret = {"/media/test2": 32, "/media/test3": 5}.get(cmd[-1], 0)
+            return SubProcess(cmd).set_output(ret, b"", b"")
+        mo.RunCmd = MagicMock(side_effect=run_cmd)
+        self.assertFalse(mo.mount_batch(shares))
+        self.assertEqual(mo.RunCmd.call_count, 3)
+        self.assertTrue(SysApp.is_code(SysApp.ERR_MOUNT + 32))
+
+    def test_mount_all_fstab(self, ocert):
+        o = init_ocert(ocert)
+        fname = test_folder.get_temp_filename("fstab")
+        write_file(fname, "1.1.1.1:/p1 /mnt/one ibmshare secure=true 0 0\n"
+                          "1.1.1.2:/p2 /mnt/two ibmshare secure=true,_netdev 0 0\n")
+        mo = mount_ibmshare.MountIbmshare()
+        mo.is_share_mounted = MagicMock(return_value=False)
+        with mock.patch("args_handler.FSTAB_FILE", fname):
+            with MySubProcess(0, "") as run:
+                self.assertTrue(mo.mount_batch(ArgsHandler.get_fstab_mount_args()))
+                self.assertEqual(run.func.call_count, 2)
+        self.assertEqual(o.ipsec.reload_config.call_count, 1)
+
+    def test_mount_all_fstab_empty(self, ocert):
+        o = init_ocert(ocert)
+        mo = mount_ibmshare.MountIbmshare()
+        self.assertTrue(mo.mount_batch([]))
+        self.assertEqual(o.load_certificate.call_count, 0)
+
 
 if __name__ == '__main__':
     unittest.main()
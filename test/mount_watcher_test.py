@@ -0,0 +1,151 @@
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+from unittest.mock import MagicMock
+from unittest import mock
+import ipaddress
+import unittest
+import file_lock
+import mount_watcher
+from test_common import *
+from common import *
+from config_test import ss_setup, create_file
+
+
+def new_watcher(ips):
+    ss, _ = ss_setup()
+    ss.reload_config = MagicMock(return_value=True)
+    watcher = mount_watcher.MountWatcher(ss)
+    watcher.SetDebugEnabled()
+    watcher.load_ips = MagicMock(return_value=set(ips))
+    watcher.on_change()
+    return watcher, ss
+
+
+class TestMountWatcher(unittest.TestCase):
+
+    def test_subnet_config_kept(self):
+        watcher, ss = new_watcher(["10.240.0.5", "10.240.0.6"])
+        ss.subnets = [ipaddress.ip_network("10.240.0.0/24")]
+        my_file = create_file("10.240.0.0_24")
+        watcher.load_ips.return_value = set(["10.240.0.6"])
+        self.assertTrue(watcher.on_change())
+        self.assertTrue(os.path.exists(my_file))
+        ss.reload_config.assert_not_called()
+
+    def test_subnet_last_mount_removed(self):
+        watcher, ss = new_watcher(["10.240.0.5", "10.240.0.6"])
+        ss.subnets = [ipaddress.ip_network("10.240.0.0/24")]
+        my_file = create_file("10.240.0.0_24")
+        watcher.load_ips.return_value = set()
+        # a mount to another server of the subnet is starting
+        mount_lock = file_lock.LockHandler.mount_ip_lock("10.240.0.7")
+        self.assertTrue(mount_lock.grab_non_blocking_lock())
+        try:
+            self.assertTrue(watcher.on_change())
+        finally:
+            mount_lock.release_lock()
+        self.assertTrue(os.path.exists(my_file))
+        self.assertEqual(len(watcher.pending), 1)
+
+        self.assertTrue(watcher.on_change())
+        self.assertFalse(os.path.exists(my_file))
+        self.assertEqual(ss.conn_changes, {"10.240.0.0_24": False})
+        self.assertEqual(ss.reload_config.call_count, 1)
+
+    def test_server_config_before_subnet_removed(self):
+        watcher, ss = new_watcher(["10.240.0.5", "10.240.0.6"])
+        ss.subnets = [ipaddress.ip_network("10.240.0.0/24")]
+        old_file = create_file("10.240.0.5")
+        my_file = create_file("10.240.0.0_24")
+        watcher.load_ips.return_value = set(["10.240.0.6"])
+        self.assertTrue(watcher.on_change())
+        self.assertFalse(os.path.exists(old_file))
+        self.assertTrue(os.path.exists(my_file))
+        self.assertEqual(ss.conn_changes, {"10.240.0.5": False})
+
+    def test_last_mount_removed(self):
+        watcher, ss = new_watcher(["1.1.1.1", "2.2.2.2"])
+        file1 = create_file("1.1.1.1")
+        file2 = create_file("2.2.2.2")
+        watcher.load_ips.return_value = set(["2.2.2.2"])
+        self.assertTrue(watcher.on_change())
+        self.assertFalse(os.path.exists(file1))
+        self.assertTrue(os.path.exists(file2))
+        self.assertEqual(ss.reload_config.call_count, 1)
+
+    def test_no_config_no_reload(self):
+        watcher, ss = new_watcher(["1.1.1.1"])
+        watcher.load_ips.return_value = set()
+        self.assertTrue(watcher.on_change())
+        self.assertEqual(ss.reload_config.call_count, 0)
+
+    def test_unmounted_at_start_not_removed(self):
+        watcher, ss = new_watcher(["2.2.2.2"])
+        file1 = create_file("1.1.1.1")
+        self.assertTrue(watcher.on_change())
+        self.assertTrue(os.path.exists(file1))
+        self.assertEqual(ss.reload_config.call_count, 0)
+
+    def test_mount_in_progress_deferred(self):
+        watcher, ss = new_watcher(["1.1.1.1"])
+        file1 = create_file("1.1.1.1")
+        watcher.load_ips.return_value = set()
+        mount_lock = file_lock.LockHandler.mount_ip_lock("1.1.1.1")
+        self.assertTrue(mount_lock.grab_non_blocking_lock())
+        try:
+            watcher.on_change()
+        finally:
+            mount_lock.release_lock()
+        self.assertTrue(os.path.exists(file1))
+        self.assertEqual(watcher.pending, set(["1.1.1.1"]))
+
+        # removed on the retry once the mount lock is free
+        watcher.on_change()
+        self.assertFalse(os.path.exists(file1))
+        self.assertEqual(watcher.pending, set())
+
+    def test_locks_held_for_reload(self):
+        watcher, ss = new_watcher(["1.1.1.1"])
+        file1 = create_file("1.1.1.1")
+        watcher.load_ips.return_value = set()
+        locked = []
+        ss.reload_config.side_effect = lambda: locked.extend([
+            file_lock.LockHandler.mount_ip_lock("1.1.1.1").is_locked(),
+            file_lock.LockHandler.mount_share_lock().is_locked()]) or True
+        self.assertTrue(watcher.on_change())
+        self.assertEqual(locked, [True, True])
+        self.assertFalse(file_lock.LockHandler.mount_ip_lock("1.1.1.1").is_locked())
+        self.assertFalse(file_lock.LockHandler.mount_share_lock().is_locked())
+
+    def test_pending_retried_on_timer(self):
+        watcher, ss = new_watcher(["1.1.1.1"])
+        poller = MagicMock()
+        poller.poll.return_value = []
+        fd = MagicMock()
+        watcher.wait_for_change(poller, fd)
+        poller.poll.assert_called_with(None)
+        watcher.pending.add("1.1.1.1")
+        watcher.wait_for_change(poller, fd)
+        poller.poll.assert_called_with(watcher.RETRY_SECS * 1000)
+        fd.read.assert_not_called()
+
+    def test_mount_table_unreadable(self):
+        watcher, ss = new_watcher(["1.1.1.1"])
+        file1 = create_file("1.1.1.1")
+        watcher.load_ips.return_value = None
+        self.assertFalse(watcher.on_change())
+        self.assertTrue(os.path.exists(file1))
+
+    def test_watch_events(self):
+        watcher, ss = new_watcher(["1.1.1.1"])
+        watcher.on_change = MagicMock(return_value=True)
+        watcher.wait_for_change = MagicMock()
+        self.assertTrue(watcher.watch(max_events=2))
+        self.assertEqual(watcher.wait_for_change.call_count, 2)
+        self.assertEqual(watcher.on_change.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+from unittest.mock import MagicMock
+import unittest
+import path_mtu
+from common import *
+from test_common import *
+
+
+class TestPathMtu(unittest.TestCase):
+
+    def test_esp_mtu(self):
+        pm = path_mtu.PathMtu()
+        self.assertEqual(pm.esp_mtu(1500, True), 1458)
+        self.assertEqual(pm.esp_mtu(1500, False), 1466)
+        self.assertEqual(pm.esp_mtu(9000, False), 8966)
+        for mtu in range(1280, 1300):
+            # esp payload and trailer stay 4 byte aligned
+            self.assertEqual((pm.esp_mtu(mtu, True) - pm.IP_HEADER + 2) % 4, 0)
+
+    def test_check(self):
+        pm = path_mtu.PathMtu()
+        pm.path_mtu = MagicMock(return_value=1500)
+        self.assertEqual(pm.check("1.1.1.1", True), (1500, 1458, 1406))
+        self.assertEqual(pm.check("1.1.1.1", False), (1500, 1466, 1414))
+        pm.path_mtu.return_value = 1400
+        self.assertEqual(pm.check("1.1.1.1", True), (1400, 1358, 1306))
+        pm.path_mtu.return_value = None
+        self.assertIsNone(pm.check("1.1.1.1", True))
+
+    def test_path_mtu_local(self):
+        self.assertGreaterEqual(path_mtu.PathMtu().path_mtu("127.0.0.1"), 1280)
+
+    def test_show(self):
+        pm = path_mtu.PathMtu()
+        pm.path_mtu = MagicMock(return_value=1500)
+        pm.EnableLogStore()
+        self.assertTrue(pm.show("1.1.1.1", False))
+        self.assertTrue(pm.HasLogMessage("ESP MTU: 1466 (udp encap no), tcp mss: 1414"))
+        self.assertTrue(pm.HasLogMessage("if NAT is detected"))
+
+
+if __name__ == '__main__':
+    unittest.main()
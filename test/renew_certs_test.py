@@ -116,6 +116,88 @@ class TestRenewCerts(unittest.TestCase):
         self.assertEqual(renew.new_private_key.call_count, 1)
         self.assertEqual(renew.set_private_key.call_count, 0)
 
+    @mock.patch("certificate_handler.KeyPool.rotate_every", return_value=2)
+    def test_renew_cert_rotate_key(self, rotate_every):
+        renew = setup_renew()
+        write_file(renew.get_ipsec_mgr().private_key_filename(), TEST_PRIVATE_KEY)
+        renew.set_private_key = MagicMock(return_value=True)
+        renew.new_private_key = MagicMock(return_value=True)
+        with mock.patch("certificate_handler.KeyPool.renewals", return_value=1), \
+                mock.patch("certificate_handler.KeyPool.renewed") as renewed:
+            self.assertTrue(renew.metadata_renew_cert())
+            self.assertEqual(renew.new_private_key.call_count, 0)
+            renewed.assert_called_once_with(False)
+        with mock.patch("certificate_handler.KeyPool.renewals", return_value=2), \
+                mock.patch("certificate_handler.KeyPool.renewed") as renewed:
+            self.assertTrue(renew.metadata_renew_cert())
+            self.assertEqual(renew.new_private_key.call_count, 1)
+            renewed.assert_called_once_with(True)
+
+    def test_renew_cert_bad_key_replaced(self):
+        renew = setup_renew()
+        write_file(renew.get_ipsec_mgr().private_key_filename(), TEST_PRIVATE_KEY)
+        # the existing key fails its check
+        renew.set_private_key = MagicMock(return_value=False)
+        renew.new_private_key = MagicMock(return_value=True)
+        with mock.patch("certificate_handler.KeyPool.renewed") as renewed:
+            self.assertTrue(renew.metadata_renew_cert())
+            self.assertEqual(renew.new_private_key.call_count, 1)
+            renewed.assert_called_once_with(True)
+
+    @mock.patch("certificate_handler.KEY_REJECTED_FILE", test_folder.get_temp_filename("key_rejected"))
+    def test_renew_cert_ecdsa_rejected(self):
+        renew = setup_renew()
+        renew.get_ipsec_mgr().read_private_key = MagicMock(return_value=None)
+        renew.new_certificate_signing_request = MagicMock(
+            side_effect=renew.new_certificate_signing_request)
+
+        def reject():
+            renew.csr_rejected = renew.private_key_algorithm(renew.private_key) != "rsa"
+            return not renew.csr_rejected
+
+        renew.generate_certs = MagicMock(side_effect=reject)
+        with mock.patch("common.ShareConfig.get_str", return_value="ecdsa-p256"):
+            self.assertTrue(renew.metadata_renew_cert())
+        self.assertEqual(renew.generate_certs.call_count, 2)
+        self.assertEqual(renew.private_key_algorithm(renew.private_key), "rsa")
+        self.assertTrue(renew.HasLogMessage("ecdsa-p256 key rejected"))
+
+        # rsa rejected - no retry
+        renew.generate_certs = MagicMock(return_value=False)
+        renew.csr_rejected = True
+        self.assertFalse(renew.metadata_renew_cert())
+        self.assertEqual(renew.generate_certs.call_count, 1)
+
+    def test_renew_cert_ecdsa_rejected_kept_rsa(self):
+        fname = test_folder.get_temp_filename("key_rejected")
+        renew = setup_renew()
+        renew.get_ipsec_mgr().read_private_key = MagicMock(return_value=None)
+
+        def reject():
+            renew.csr_rejected = renew.private_key_algorithm(renew.private_key) != "rsa"
+            return not renew.csr_rejected
+
+        renew.generate_certs = MagicMock(side_effect=reject)
+        with mock.patch("certificate_handler.KEY_REJECTED_FILE", fname), \
+                mock.patch("common.ShareConfig.get_str", return_value="ecdsa-p256"), \
+                mock.patch("certificate_handler.LocalInstall.exists", return_value=True):
+            self.assertTrue(renew.metadata_renew_cert())
+            self.assertEqual(renew.generate_certs.call_count, 2)
+            rsa_key = renew.private_key
+
+            # next renewal keeps the rsa key, no rejected ecdsa request first
+            renew.get_ipsec_mgr().read_private_key = MagicMock(return_value=rsa_key)
+            renew.generate_certs.reset_mock()
+            self.assertTrue(renew.metadata_renew_cert())
+            self.assertEqual(renew.generate_certs.call_count, 1)
+            self.assertEqual(renew.private_key, rsa_key)
+            self.assertFalse(renew.HasLogMessage("Key algorithm changed"))
+
+        # a different configured algorithm is tried again
+        with mock.patch("certificate_handler.KEY_REJECTED_FILE", fname), \
+                mock.patch("common.ShareConfig.get_str", return_value="ecdsa-p384"):
+            self.assertEqual(renew.key_algorithm(), "ecdsa-p384")
+
     def test_renew_cert_generate_fails(self):
         renew = setup_renew(gc=False)
         self.assertFalse(renew.metadata_renew_cert())
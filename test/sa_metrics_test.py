@@ -0,0 +1,116 @@
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+from collections import OrderedDict
+import threading
+import unittest
+import sa_metrics
+import vici
+from test_common import *
+from vici_server import ViciServer
+
+CONN1 = "ibmshare-ipsec-to-1-1-1-1"
+
+
+def new_metrics():
+    metrics = sa_metrics.SaMetrics("ibmshare-ipsec-to-")
+    metrics.METRICS_FILE = test_folder.get_temp_filename("sa_stats.json")
+    return metrics
+
+
+def new_sa(established=True, bytes_in="100"):
+    sa = OrderedDict([("state", "ESTABLISHED" if established else "CONNECTING")])
+    if established:
+        sa["established"] = "30"
+    sa["child-sas"] = {CONN1 + "-1": {"state": "INSTALLED", "bytes-in": bytes_in,
+                                      "bytes-out": "200", "packets-in": "1",
+                                      "packets-out": "2"}}
+    return sa
+
+
+@mock.patch("common.LocalInstall.exists", return_value=True)
+class TestSaMetrics(unittest.TestCase):
+
+    def test_events(self, exists):
+        metrics = new_metrics()
+        metrics.on_event("ike-updown", {"up": "yes", CONN1: new_sa()})
+        metrics.on_event("ike-updown", {CONN1: new_sa()})
+        metrics.on_event("ike-updown", {CONN1: new_sa(established=False)})
+        metrics.on_event("ike-rekey", {CONN1: new_sa()})
+        metrics.on_event("child-rekey", {CONN1: new_sa()})
+        metrics.on_event("child-rekey", {CONN1: new_sa()})
+        metrics.on_event("ike-updown", {"up": "yes", "user-conn": new_sa()})
+        conns = metrics.load()
+        self.assertEqual(list(conns), [CONN1])
+        conn = conns[CONN1]
+        self.assertEqual((conn["ike_up"], conn["ike_down"], conn["failures"]), (1, 1, 1))
+        self.assertEqual((conn["ike_rekeys"], conn["child_rekeys"]), (1, 2))
+
+    def test_record_connect(self, exists):
+        metrics = new_metrics()
+        metrics.record_connect(CONN1, 0.25, True)
+        metrics.record_connect(CONN1, 0.1, True)
+        metrics.record_connect(CONN1, 5, False)
+        conn = metrics.load()[CONN1]
+        self.assertEqual(conn["connects"], 2)
+        self.assertEqual(conn["connect_failures"], 1)
+        self.assertEqual(conn["connect_ms_last"], 100)
+        self.assertEqual(conn["connect_ms_max"], 250)
+
+    def test_trap_connect(self, exists):
+        metrics = new_metrics()
+        with mock.patch("time.time", return_value=1000.0):
+            metrics.record_trap([CONN1, "ibmshare-ipsec-to-2-2-2-2"])
+        with mock.patch("time.time", return_value=1000.5):
+            metrics.on_event("ike-updown", {"up": "yes", CONN1: new_sa()})
+            metrics.on_event("child-updown", {"up": "yes", CONN1: new_sa()})
+            # only the first child SA after the trap is timed
+            metrics.on_event("child-updown", {"up": "yes", CONN1: new_sa()})
+        # already up - no event until long after
+        with mock.patch("time.time", return_value=1000.0 + metrics.TRAP_MAX_SECS + 1):
+            metrics.on_event("child-updown", {"up": "yes", "ibmshare-ipsec-to-2-2-2-2": new_sa()})
+        conns = metrics.load()
+        self.assertEqual((conns[CONN1]["connects"], conns[CONN1]["connect_ms_last"]), (1, 500))
+        self.assertEqual(conns[CONN1]["ike_up"], 1)
+        self.assertEqual(conns["ibmshare-ipsec-to-2-2-2-2"]["connects"], 0)
+        self.assertIsNone(conns["ibmshare-ipsec-to-2-2-2-2"]["trapped_at"])
+
+    def test_poll(self, exists):
+        metrics = new_metrics()
+        metrics.record_connect("ibmshare-ipsec-to-2-2-2-2", 0.1, True)
+        with ViciServer() as server:
+            server.sas[CONN1] = new_sa(bytes_in="1000")
+            server.sas["user-conn"] = new_sa()
+            with vici.ViciSession(server.path) as session:
+                conns = metrics.poll(session)
+        self.assertEqual(sorted(conns), [CONN1, "ibmshare-ipsec-to-2-2-2-2"])
+        self.assertEqual(conns[CONN1]["state"], "ESTABLISHED")
+        self.assertEqual(conns[CONN1]["established_secs"], 30)
+        self.assertEqual(conns[CONN1]["bytes_in"], 1000)
+        self.assertEqual(conns[CONN1]["packets_out"], 2)
+        self.assertEqual(conns["ibmshare-ipsec-to-2-2-2-2"]["state"], "DOWN")
+        # machine readable copy
+        self.assertEqual(metrics.load(), conns)
+
+        metrics.EnableLogStore()
+        self.assertTrue(metrics.show(conns))
+        self.assertTrue(metrics.HasLogMessage(CONN1))
+
+    def test_listen(self, exists):
+        metrics = new_metrics()
+        with ViciServer() as server:
+            thread = threading.Thread(target=metrics.listen, args=[server.path, 2])
+            thread.daemon = True
+            thread.start()
+            self.assertTrue(server.wait_listeners(event="child-rekey"))
+            server.emit("ike-updown", {"up": "yes", CONN1: new_sa()})
+            server.emit("child-rekey", {CONN1: new_sa()})
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        conn = metrics.load()[CONN1]
+        self.assertEqual((conn["ike_up"], conn["child_rekeys"]), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
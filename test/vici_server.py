@@ -0,0 +1,210 @@
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+# Stand-in for the charon vici socket, used by the tests and to time
+# the vici client without strongswan:
+#     PYTHONPATH=../src python3 vici_server.py [count]
+
+from collections import OrderedDict
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+from vici import ViciMessage, ViciSession
+
+
+class ViciServer(object):
+    def __init__(self, path=None):
+        if not path:
+            path = os.path.join(tempfile.mkdtemp(), "charon.vici")
+        self.path = path
+        self.conns = OrderedDict()
+        self.sas = OrderedDict()
+        self.certs = []
+        self.keys = []
+        self.commands = []  # names of the commands received
+        self.fail = set()   # commands that return success=no
+        self.sock = None
+        self.lock = threading.Lock()
+        self.listeners = []  # (events, send) of each client
+        self.early_events = []  # (name, msg) sent before the next register confirm
+        self.late_events = []  # (name, msg) sent before the next unregister confirm
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(8)
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # send an event to the clients registered for it
+    def emit(self, name, msg):
+        for events, send in list(self.listeners):
+            if name in events:
+                send(ViciMessage.EVENT, name, msg)
+
+    # clients registered for event, any event if None
+    def wait_listeners(self, count=1, secs=5, event=None):
+        end_at = time.time() + secs
+        while time.time() < end_at:
+            found = [events for events, _ in list(self.listeners)
+                     if event is None or event in events]
+            if len(found) >= count:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def accept(self):
+        while self.sock:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.serve, args=[client])
+            thread.daemon = True
+            thread.start()
+
+    def recv(self, client, size):
+        data = b""
+        while len(data) < size:
+            chunk = client.recv(size - len(data))
+            if not chunk:
+                raise OSError("closed")
+            data += chunk
+        return data
+
+    def serve(self, client):
+        events = set()
+        send_lock = threading.Lock()
+
+        def send(ptype, name=None, msg=None):
+            with send_lock:
+                client.sendall(ViciMessage.encode_packet(ptype, name, msg))
+
+        def event(name, msg):
+            if name in events:
+                send(ViciMessage.EVENT, name, msg)
+
+        with client:
+            while True:
+                try:
+                    size = struct.unpack("!I", self.recv(client, 4))[0]
+                    ptype, name, msg = ViciMessage.decode_packet(self.recv(client, size))
+                except OSError:
+                    if (events, send) in self.listeners:
+                        self.listeners.remove((events, send))
+                    return
+                if ptype == ViciMessage.EVENT_REGISTER:
+                    for ename, emsg in list(self.early_events):
+                        if ename in events:
+                            send(ViciMessage.EVENT, ename, emsg)
+                            self.early_events.remove((ename, emsg))
+                    events.add(name)
+                    send(ViciMessage.EVENT_CONFIRM)
+                    if (events, send) not in self.listeners:
+                        self.listeners.append((events, send))
+                elif ptype == ViciMessage.EVENT_UNREGISTER:
+                    while len(self.late_events) > 0:
+                        send(ViciMessage.EVENT, *self.late_events.pop(0))
+                    events.discard(name)
+                    send(ViciMessage.EVENT_CONFIRM)
+                elif ptype == ViciMessage.CMD_REQUEST:
+                    handler = getattr(self, "cmd_" + name.replace("-", "_"), None)
+                    if not handler:
+                        send(ViciMessage.CMD_UNKNOWN)
+                        continue
+                    with self.lock:
+                        self.commands.append(name)
+                        reply = handler(msg, event)
+                    if name in self.fail:
+                        reply = {"success": "no", "errmsg": name + " failed"}
+                    send(ViciMessage.CMD_RESPONSE, msg=reply)
+
+    def cmd_version(self, msg, event):
+        return OrderedDict([("daemon", "charon"), ("version", "5.9.5"),
+                            ("sysname", "Linux")])
+
+    def cmd_load_conn(self, msg, event):
+        for name, conn in msg.items():
+            self.conns[name] = conn
+        return {"success": "yes"}
+
+    def cmd_unload_conn(self, msg, event):
+        if self.conns.pop(msg.get("name"), None) is None:
+            return {"success": "no", "errmsg": "connection not found"}
+        return {"success": "yes"}
+
+    def cmd_reload_settings(self, msg, event):
+        return {"success": "yes"}
+
+    def cmd_get_conns(self, msg, event):
+        return {"conns": list(self.conns)}
+
+    def cmd_list_conns(self, msg, event):
+        ike = msg.get("ike") if msg else None
+        for name, conn in self.conns.items():
+            if not ike or ike == name:
+                event("list-conn", {name: conn})
+        return {}
+
+    def cmd_load_cert(self, msg, event):
+        self.certs.append(msg)
+        return {"success": "yes"}
+
+    def cmd_load_key(self, msg, event):
+        self.keys.append(msg)
+        return {"success": "yes"}
+
+    def cmd_initiate(self, msg, event):
+        child = msg.get("child")
+        ike = msg.get("ike", child)
+        if ike not in self.conns:
+            return {"success": "no", "errmsg": "no config named '%s'" % ike}
+        event("control-log", {"group": "IKE", "level": "1",
+                              "msg": "initiating IKE_SA " + ike})
+        self.sas[ike] = OrderedDict([("state", "ESTABLISHED"),
+                                     ("child-sas", {child: {"state": "INSTALLED"}})])
+        return {"success": "yes"}
+
+    def cmd_list_sas(self, msg, event):
+        ike = msg.get("ike") if msg else None
+        for name, sa in self.sas.items():
+            if not ike or ike == name:
+                event("list-sa", {name: sa})
+        return {}
+
+
+def benchmark(count):
+    with ViciServer() as server:
+        with ViciSession(server.path) as session:
+            session.connect()
+            start = time.time()
+            for _ in range(count):
+                session.version()
+            secs = time.time() - start
+    print("vici version: %d requests %.3f ms/request" % (count, secs * 1000 / count))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
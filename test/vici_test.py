@@ -0,0 +1,183 @@
+# Copyright (c) IBM Corp. 2023. All Rights Reserved.
+# Project name: VPC File Storage Mount Helper
+# This project is licensed under the MIT License, see LICENSE file in the root directory.
+
+from collections import OrderedDict
+import threading
+import unittest
+import vici
+from test_common import *
+from vici_server import ViciServer
+
+CONN_CONF = """connections {
+    ibmshare-ipsec-to-1-1-1-1 {
+        children {
+            ibmshare-ipsec-to-1-1-1-1 {
+                esp_proposals = aes256gcm16
+                remote_ts = 1.1.1.1[any/any]
+            }
+        }
+        remote_addrs = 1.1.1.1  # the nfs server
+        local {
+            certs = %s
+        }
+        remote {
+        id = %%any
+        }
+    }
+}
+"""
+
+
+class TestViciMessage(unittest.TestCase):
+
+    def test_encode_decode(self):
+        msg = OrderedDict([("key", "value"),
+                           ("section", OrderedDict([("sub", {"a": "1"}), ("b", "2")])),
+                           ("list", ["x", "y"]),
+                           ("empty", [])])
+        data = vici.ViciMessage.encode(msg)
+        self.assertEqual(vici.ViciMessage.decode(data), msg)
+
+    def test_encode_format(self):
+        data = vici.ViciMessage.encode(OrderedDict([("k", "v"), ("l", ["i"])]))
+        self.assertEqual(data, b"\x03\x01k\x00\x01v\x04\x01l\x05\x00\x01i\x06")
+
+    def test_decode_bad(self):
+        for data in [b"\x03\x01k\x00\x05v", b"\x01\x01s", b"\x02", b"\x09", b"\x05\x00\x01i"]:
+            with self.assertRaises(ValueError):
+                vici.ViciMessage.decode(data)
+
+    def test_packet(self):
+        data = vici.ViciMessage.encode_packet(vici.ViciMessage.CMD_REQUEST, "version")
+        self.assertEqual(data, b"\x00\x00\x00\x09\x00\x07version")
+        ptype, name, msg = vici.ViciMessage.decode_packet(data[4:])
+        self.assertEqual((ptype, name, msg), (vici.ViciMessage.CMD_REQUEST, "version", {}))
+
+
+class TestViciSession(unittest.TestCase):
+
+    def test_version(self):
+        with ViciServer() as server:
+            with vici.ViciSession(server.path) as session:
+                self.assertEqual(session.version()["daemon"], "charon")
+                self.assertEqual(session.version()["version"], "5.9.5")
+
+    def test_not_running(self):
+        session = vici.ViciSession("/tmp/not/exists/charon.vici")
+        self.assertFalse(session.connect())
+        self.assertIsNone(session.version())
+
+    def test_load_unload_conn(self):
+        with ViciServer() as server:
+            with vici.ViciSession(server.path) as session:
+                self.assertTrue(session.load_conn("conn1", {"remote_addrs": ["1.1.1.1"]}))
+                self.assertTrue(session.load_conn("conn2", {"remote_addrs": ["2.2.2.2"]}))
+                self.assertEqual(session.get_conns(), ["conn1", "conn2"])
+                conns = session.list_conns()
+                self.assertEqual(conns[1], {"conn2": {"remote_addrs": ["2.2.2.2"]}})
+                self.assertEqual(len(session.list_conns("conn1")), 1)
+                self.assertTrue(session.unload_conn("conn1"))
+                self.assertFalse(session.unload_conn("conn1"))
+                self.assertEqual(session.get_conns(), ["conn2"])
+
+    def test_initiate(self):
+        with ViciServer() as server:
+            with vici.ViciSession(server.path) as session:
+                self.assertFalse(session.initiate("conn1"))
+                session.load_conn("conn1", {})
+                self.assertTrue(session.initiate("conn1", timeout_ms=1000))
+                sas = session.list_sas()
+                self.assertEqual(sas[0]["conn1"]["state"], "ESTABLISHED")
+
+    def test_initiate_late_event(self):
+        with ViciServer() as server:
+            server.late_events = [("control-log", {"msg": "late"}), ("ike-updown", {"up": "yes"})]
+            with vici.ViciSession(server.path) as session:
+                session.EnableLogStore()
+                session.load_conn("conn1", {})
+                self.assertTrue(session.initiate("conn1", timeout_ms=1000))
+                self.assertFalse(session.HasLogMessage("failed"))
+                # session still usable
+                self.assertIsNotNone(session.version())
+
+    def test_creds(self):
+        with ViciServer() as server:
+            with vici.ViciSession(server.path) as session:
+                self.assertTrue(session.load_cert(b"\x30\x82 binary", ca=True))
+                self.assertTrue(session.load_key("key data"))
+                self.assertEqual(server.certs[0]["flag"], "CA")
+                self.assertEqual(server.keys[0]["type"], "any")
+
+    def test_command_fails(self):
+        with ViciServer() as server:
+            server.fail.add("load-key")
+            with vici.ViciSession(server.path) as session:
+                session.EnableLogStore()
+                self.assertFalse(session.load_key("key data"))
+                self.assertTrue(session.HasLogMessage("load-key failed"))
+                # session still usable
+                self.assertIsNotNone(session.version())
+
+    def test_listen(self):
+        events = []
+        with ViciServer() as server:
+            with vici.ViciSession(server.path) as session:
+                thread = threading.Thread(target=session.listen, args=[
+                    ["ike-updown"], lambda name, msg: events.append((name, msg)), 1])
+                thread.daemon = True
+                thread.start()
+                self.assertTrue(server.wait_listeners(event="ike-updown"))
+                server.emit("ike-rekey", {"conn1": {}})
+                server.emit("ike-updown", {"up": "yes"})
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+        self.assertEqual(events, [("ike-updown", {"up": "yes"})])
+
+    def test_listen_event_before_confirm(self):
+        events = []
+        with ViciServer() as server:
+            server.early_events = [("ike-updown", {"up": "yes"})]
+            with vici.ViciSession(server.path) as session:
+                self.assertTrue(session.listen(["ike-updown", "ike-rekey"],
+                                               lambda name, msg: events.append(name), 1))
+        self.assertEqual(events, ["ike-updown"])
+
+    def test_listen_not_running(self):
+        session = vici.ViciSession("/tmp/not/exists/charon.vici")
+        self.assertFalse(session.listen(["ike-updown"], None))
+
+    def test_unknown_command(self):
+        with ViciServer() as server:
+            with vici.ViciSession(server.path) as session:
+                reply, _ = session.request("no-such-command")
+                self.assertIsNone(reply)
+                self.assertIsNotNone(session.version())
+
+
+class TestSwanctlConf(unittest.TestCase):
+
+    def test_load_connections(self):
+        cert = test_folder.get_temp_filename("cert.pem")
+        write_file(cert, TEST_CERT)
+        fname = test_folder.get_temp_filename("conn.conf")
+        write_file(fname, CONN_CONF % cert)
+        conns = vici.SwanctlConf().load_connections(fname)
+        conn = conns["ibmshare-ipsec-to-1-1-1-1"]
+        self.assertEqual(conn["remote_addrs"], ["1.1.1.1"])
+        self.assertEqual(conn["remote"]["id"], "%any")
+        self.assertEqual(conn["local"]["certs"], [TEST_CERT.encode()])
+        child = conn["children"]["ibmshare-ipsec-to-1-1-1-1"]
+        self.assertEqual(child["esp_proposals"], ["aes256gcm16"])
+        self.assertEqual(child["remote_ts"], ["1.1.1.1[any/any]"])
+
+    def test_load_connections_bad(self):
+        fname = test_folder.get_temp_filename("conn.conf")
+        write_file(fname, "connections {\n conn1 {\n")
+        self.assertIsNone(vici.SwanctlConf().load_connections(fname))
+        write_file(fname, "connections {\n bad line\n}\n")
+        self.assertIsNone(vici.SwanctlConf().load_connections(fname))
+
+
+if __name__ == '__main__':
+    unittest.main()